@@ -43,7 +43,8 @@ class ContributionForm(forms.ModelForm):
         chama = kwargs.pop('chama', None) # get chama passed from view
         super().__init__(*args, **kwargs)
         if chama:
-            self.fields['member'].queryset = Member.objects.filter(chama=chama)
+            # options print as "user -> chama", so fetch both with the members
+            self.fields['member'].queryset = Member.objects.filter(chama=chama).select_related('user', 'chama')
     
     def clean_amount(self):
         amount = self.cleaned_data.get('amount')
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.6 on 2026-10-17 16:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_remove_virtualaccount_member_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customuser',
+            name='phone_number',
+            field=models.CharField(blank=True, db_index=True, max_length=15, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='contribution',
+            index=models.Index(fields=['member', '-date'], name='app_contrib_member__456bd7_idx'),
+        ),
+    ]
@@ -3,7 +3,7 @@ from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 from django.core.validators import MinValueValidator
 import uuid
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 # Create your models here.
@@ -39,6 +39,12 @@ class Contribution(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHODS)
 
+    class Meta:
+        indexes = [
+            # latest contributions per member (dashboard, contributions list)
+            models.Index(fields=["member", "-date"]),
+        ]
+
     def __str__(self):
         return f"{self.member.user.username} - {self.amount} via {self.payment_method}"
 
@@ -90,7 +96,8 @@ class Chama(models.Model):
 
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)
-    phone_number = models.CharField(max_length=15, blank=True, null=True)
+    # payment callbacks find the paying member by phone number
+    phone_number = models.CharField(max_length=15, blank=True, null=True, db_index=True)
 
     def __str__(self):
         return self.username
@@ -102,3 +109,33 @@ def create_virtual_account(sender, instance, created, **kwargs):
             chama = instance,
             account_number = instance.account_number
         )
+
+# dashboard summaries are cached per user; these drop exactly the ones a change shows up in
+@receiver([post_save, post_delete], sender=Chama)
+@receiver([post_save, post_delete], sender=VirtualAccount)
+def invalidate_chama_dashboards(sender, instance, **kwargs):
+    from payments.utils.dashboard import invalidate_chamas
+    invalidate_chamas([instance.pk if sender is Chama else instance.chama_id])
+
+@receiver([post_save, post_delete], sender=Member)
+def invalidate_member_dashboards(sender, instance, **kwargs):
+    from payments.utils.dashboard import invalidate_chamas, invalidate_users
+    # member counts change for the whole chama, the membership list for the user
+    invalidate_chamas([instance.chama_id])
+    invalidate_users([instance.user_id])
+
+@receiver([post_save, post_delete], sender=Contribution)
+def invalidate_contribution_dashboards(sender, instance, **kwargs):
+    from payments.utils.dashboard import invalidate_users
+    invalidate_users(Member.objects.filter(pk=instance.member_id).values_list('user_id', flat=True))
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_dashboards(sender, instance, created, update_fields=None, **kwargs):
+    from payments.utils.dashboard import invalidate_chamas
+    # summaries print usernames (chama leaders, contributors); a save that
+    # can't have renamed the user, like a login stamping last_login, is skipped
+    if created or (update_fields is not None and "username" not in update_fields):
+        return
+    chama_ids = set(Member.objects.filter(user=instance).values_list('chama_id', flat=True))
+    chama_ids.update(Chama.objects.filter(created_by=instance).values_list('id', flat=True))
+    invalidate_chamas(chama_ids)
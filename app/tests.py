@@ -1,3 +1,412 @@
-from django.test import TestCase
+import base64
+import json
+import re
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from payments import urls as payments_urls
+from payments.models import AuditLog, Transaction
+from payments.utils.dashboard import build_summary, get_summary, summary_key
+from payments.utils.pagination import encode_cursor, keyset_page
+from payments.utils.sql_budget import SQLBudgetMiddleware, query_budget, query_budgets
+from . import urls as app_urls
+from .models import Chama, Member, Contribution, CustomUser, VirtualAccount
+
+
+class AccountsViewTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="wanjiku", email="wanjiku@example.com", password="pw")
+        self.client.force_login(self.user)
+
+    def join_chamas(self, count, role='member'):
+        for i in range(count):
+            chama = Chama.objects.create(name=f"Chama {Chama.objects.count() + 1}", created_by=self.user)
+            Member.objects.create(user=self.user, chama=chama, role=role)
+
+    def test_query_count_does_not_grow_with_chamas(self):
+        # session, user, memberships (with chama and virtual account joined in)
+        for total in (1, 5, 20):
+            with self.subTest(chamas=total):
+                self.join_chamas(total - Member.objects.filter(user=self.user).count())
+                with self.assertNumQueries(3):
+                    response = self.client.get(reverse('accounts'))
+                self.assertEqual(len(response.context['accounts']), total)
+
+    def test_rows(self):
+        self.join_chamas(1, role='leader')
+        self.join_chamas(1)
+        chama_without_account = Chama.objects.order_by('id').last()
+        VirtualAccount.objects.filter(chama=chama_without_account).delete()
+        VirtualAccount.objects.filter(chama__name="Chama 1").update(balance=250)
+
+        accounts = {a["chama"].name: a for a in self.client.get(reverse('accounts')).context['accounts']}
+
+        self.assertTrue(accounts["Chama 1"]["is_leader"])
+        self.assertEqual(accounts["Chama 1"]["balance"], 250)
+        self.assertFalse(accounts["Chama 2"]["is_leader"])
+        self.assertEqual(accounts["Chama 2"]["balance"], 0)
+        self.assertEqual(accounts["Chama 2"]["account_number"], chama_without_account.account_number)
+
+
+class QueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN on every query the hot pages issue, against a seeded
+    database, and fails if one reads a large table by sequential scan.
+    The queries are captured from the views themselves, so the test
+    follows the code as it changes.
+    """
+
+    LARGE_TABLES = {
+        "payments_transaction",
+        "payments_auditlog",
+        "app_contribution",
+        "app_member",
+        "app_customuser",
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(
+            username="amina", email="amina@example.com", password="pw", phone_number="254700000001"
+        )
+        others = CustomUser.objects.bulk_create([
+            CustomUser(username=f"user{i}", email=f"user{i}@example.com", phone_number=f"2547{i:08d}")
+            for i in range(2000)
+        ])
+        chamas = [Chama.objects.create(name=f"Chama {i}", created_by=cls.user) for i in range(3)]
+        chamas += Chama.objects.bulk_create([
+            Chama(name=f"Other {i}", created_by=others[i], account_number=f"9{i:07d}") for i in range(60)
+        ])
+        cls.chama = chamas[0]
+
+        Member.objects.bulk_create(
+            [Member(user=cls.user, chama=chama, role='leader') for chama in chamas[:3]]
+            + [Member(user=user, chama=chamas[i % len(chamas)]) for i, user in enumerate(others)]
+        )
+        members = list(Member.objects.all())
+        Contribution.objects.bulk_create([
+            Contribution(member=members[i % len(members)], amount=10 + i % 90, payment_method='mpesa')
+            for i in range(20000)
+        ])
+
+        transactions = Transaction.objects.bulk_create([
+            Transaction(
+                chama=chamas[i % len(chamas)],
+                amount=10 + i % 90,
+                checkout_id=f"ws_CO_{i}",
+                mpesa_code=f"PLAN{i:06d}",
+                phone_number=others[i % len(others)].phone_number,
+                status="Success",
+                transaction_type="withdrawal" if i % 10 == 0 else "deposit",
+            )
+            for i in range(30000)
+        ])
+        AuditLog.objects.bulk_create([
+            AuditLog(
+                transaction=txn, chama_id=txn.chama_id, action_type=txn.transaction_type,
+                amount=txn.amount, reference_no=f"TXN-{txn.mpesa_code}",
+            )
+            for txn in transactions
+        ])
+
+        # fresh statistics, as autovacuum would have on a live database
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def explain(self, sql):
+        """(table, plan line) for every full scan of a large table in the plan of `sql`."""
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+                plan = cursor.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                nodes, scans = [plan[0]["Plan"]], []
+                while nodes:
+                    node = nodes.pop()
+                    nodes.extend(node.get("Plans", []))
+                    if node["Node Type"] == "Seq Scan" and node["Relation Name"] in self.LARGE_TABLES:
+                        scans.append((node["Relation Name"], f"Seq Scan on {node['Relation Name']}"))
+                return scans
+            if connection.vendor == "sqlite":
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                scans = []
+                for *_, detail in cursor.fetchall():
+                    # "SCAN t" reads every row; "SEARCH t USING INDEX ..." and
+                    # "SCAN t USING INDEX ..." (an ordered walk under a LIMIT) don't
+                    match = re.match(r"SCAN (\w+)(?: AS \w+)?$", detail)
+                    if match and match.group(1) in self.LARGE_TABLES:
+                        scans.append((match.group(1), detail))
+                return scans
+        self.skipTest(f"no plan inspection for {connection.vendor}")
+
+    def assertNoSeqScans(self, make_queries):
+        with CaptureQueriesContext(connection) as captured:
+            make_queries()
+        selects = [q["sql"] for q in captured.captured_queries if q["sql"].lstrip().upper().startswith("SELECT")]
+        self.assertTrue(selects, "no queries captured")
+        for sql in selects:
+            scans = self.explain(sql)
+            self.assertFalse(scans, f"sequential scan in plan of:\n{sql}\n{scans}")
+
+    def get(self, name, *args, **query):
+        response = self.client.get(reverse(name, args=args), query)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_transactions_pages(self):
+        for filter_type in ('all', 'deposit', 'withdrawal'):
+            with self.subTest(type=filter_type):
+                first = self.get('transactions', type=filter_type)
+                self.assertNoSeqScans(lambda: self.get('transactions', type=filter_type))
+                self.assertNoSeqScans(lambda: self.get(
+                    'transactions', type=filter_type,
+                    after=first.context['next_cursor'], logs_after=first.context['next_logs_cursor'],
+                ))
+
+    def test_dashboard_rebuild(self):
+        cache.delete(summary_key(self.user.id))
+        self.assertNoSeqScans(lambda: build_summary(self.user.id))
+
+    def test_accounts_and_contributions(self):
+        self.assertNoSeqScans(lambda: self.get('accounts'))
+        self.assertNoSeqScans(lambda: self.get('contributions_list', self.chama.id))
+
+    def test_callback_member_lookup(self):
+        # payment_callback matches the payer to a member by phone number
+        chama = Chama.objects.get(name="Other 7")
+        phone = Member.objects.filter(chama=chama).values_list('user__phone_number', flat=True).first()
+        self.assertNoSeqScans(lambda: Member.objects.select_related("user").filter(chama=chama, user__phone_number=phone).first())
+        # and the spool drain does the same for a whole batch
+        self.assertNoSeqScans(lambda: list(
+            Member.objects.select_related("user").filter(chama__in=[chama], user__phone_number__in={phone})
+        ))
+
+    def test_harness_flags_seq_scans(self):
+        # an unindexed filter on a large table has to fail
+        with self.assertRaises(AssertionError):
+            self.assertNoSeqScans(lambda: list(Transaction.objects.filter(phone_number="254700000042")))
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every URL name declares a query budget in its urls.py. The pages are
+    requested with a small and a larger chama, so a loop that queries per
+    row (members, contributions, transactions) goes over at the second size.
+    """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username="otieno", email="otieno@example.com", password="pw", phone_number="254711000000"
+        )
+        self.chama = Chama.objects.create(name="Budget Chama", created_by=self.user)
+        self.leader = Member.objects.create(user=self.user, chama=self.chama, role='leader')
+        self.client.force_login(self.user)
+
+    def grow(self, members):
+        """Adds members to the chama, each with a contribution and a deposit."""
+        start = Member.objects.filter(chama=self.chama).count()
+        for i in range(start, start + members):
+            user = CustomUser.objects.create_user(username=f"member{i}", email=f"member{i}@example.com", password="pw")
+            member = Member.objects.create(user=user, chama=self.chama)
+            Contribution.objects.create(member=member, amount=100, payment_method='cash')
+            Transaction.objects.create(
+                chama=self.chama, member=member, amount=50, checkout_id=f"ws_CO_{i}",
+                mpesa_code=f"BUDGET{i}", phone_number="254700000000", status="Success",
+            )
+        # summaries are dropped on commit, which a TestCase never reaches
+        cache.delete(summary_key(self.user.id))
+
+    def pages(self):
+        chama_id = self.chama.id
+        member = Member.objects.filter(chama=self.chama, role='member').first()
+        transaction = Transaction.objects.filter(chama=self.chama).first()
+        return [
+            ('home', ()), ('dashboard', ()), ('accounts', ()), ('transactions', ()),
+            ('contributions_overview', ()), ('members_home', ()), ('chama_members', (chama_id,)),
+            ('contributions_list', (chama_id,)), ('add_member', (chama_id,)), ('add_contribution', (chama_id,)),
+            ('withdraw', (chama_id,)), ('create_chama', ()), ('update_user', ()), ('about', ()),
+            ('contact_support', ()), ('support_success', ()), ('leave_chama_confirm', (chama_id,)),
+            ('remove_member_confirm', (chama_id, member.id)), ('payment', (chama_id,)),
+            ('download_receipt', (transaction.id,)), ('password_reset', ()),
+        ]
+
+    def test_every_url_declares_a_budget(self):
+        budgets = query_budgets()
+        for module in (app_urls, payments_urls):
+            for pattern in module.urlpatterns:
+                with self.subTest(url=pattern.name):
+                    self.assertIn(pattern.name, budgets)
+
+    def test_pages_stay_within_budget(self):
+        for members in (2, 8):
+            self.grow(members - Member.objects.filter(chama=self.chama, role='member').count())
+            for name, args in self.pages():
+                with self.subTest(url=name, members=members), query_budget(name):
+                    response = self.client.get(reverse(name, args=args))
+                    self.assertLess(response.status_code, 400)
+
+    def callback(self, checkout_id, receipt):
+        body = {"Body": {"stkCallback": {
+            "MerchantRequestID": "29115-34620561-1",
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": 250},
+                {"Name": "MpesaReceiptNumber", "Value": receipt},
+                {"Name": "PhoneNumber", "Value": 254711000000},
+                {"Name": "AccountReference", "Value": self.chama.account_number},
+            ]},
+        }}}
+        return self.client.post(reverse('payment_callback'), body, content_type="application/json")
+
+    def test_callback_within_budget(self):
+        self.grow(3)
+        # the chama's first deposit also creates its ledger accounts; the
+        # budget is for every deposit after that
+        self.callback("ws_CO_FIRST", "RKTQDM7W6R")
+        with query_budget('payment_callback'):
+            response = self.callback("ws_CO_BUDGET", "RKTQDM7W6S")
+        self.assertEqual(response.json()["ResultCode"], 0)
+
+        with query_budget('stk_status'):
+            response = self.client.post(
+                reverse('stk_status'), {"checkout_request_id": "ws_CO_BUDGET"}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def test_budget_helper_reports_repeated_sql(self):
+        self.grow(3)
+        with self.assertRaisesMessage(AssertionError, "3x SELECT"):
+            with query_budget(2):
+                for member in Member.objects.filter(chama=self.chama, role='member'):
+                    member.user.username
+
+    @override_settings(SQL_BUDGET_ENABLED=True, SQL_BUDGET_REPORT="header")
+    def test_middleware_reports_in_headers(self):
+        response = self.client.get(reverse('accounts'))
+        self.assertEqual(response["X-SQL-Queries"], f"{response.sql_stats.count}/3")
+        self.assertIn('desc="3 queries"', response["Server-Timing"])
+
+    @override_settings(SQL_BUDGET_ENABLED=True, SQL_BUDGET_REPORT="log")
+    def test_middleware_logs_over_budget_requests_as_warnings(self):
+        with self.assertLogs("payments.utils.sql_budget", "INFO") as logs:
+            self.client.get(reverse('accounts'))
+        self.assertEqual(logs.records[0].levelname, "INFO")
+        self.assertIn("budget 3", logs.output[0])
+
+        with mock.patch.dict(query_budgets(), {'accounts': 1}), self.assertLogs("payments.utils.sql_budget") as logs:
+            self.client.get(reverse('accounts'))
+        self.assertEqual(logs.records[0].levelname, "WARNING")
+        self.assertIn("OVER BUDGET", logs.output[0])
+
+    def test_middleware_is_dropped_when_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            SQLBudgetMiddleware(lambda request: None)
+        self.assertNotIn("X-SQL-Queries", self.client.get(reverse('accounts')))
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="jeptoo", email="jeptoo@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Paged Chama", created_by=self.user)
+        Member.objects.create(user=self.user, chama=self.chama, role='leader')
+        for i in range(7):
+            Transaction.objects.create(
+                chama=self.chama, amount=10 + i, checkout_id=f"ws_CO_PAGE{i}", mpesa_code=f"PAGE{i}",
+                phone_number="254799000000", status="Success",
+            )
+        # five rows share one timestamp, so only the id tells them apart
+        tied = timezone.now() - timedelta(minutes=5)
+        Transaction.objects.filter(mpesa_code__in=[f"PAGE{i}" for i in range(1, 6)]).update(timestamp=tied)
+        self.client.force_login(self.user)
+
+    def walk(self, size):
+        pages, cursor = [], None
+        while True:
+            rows, cursor = keyset_page(Transaction.objects.all(), cursor, size)
+            pages.append([row.id for row in rows])
+            if cursor is None:
+                return pages
+
+    def test_walks_every_row_once_through_ties(self):
+        expected = list(Transaction.objects.order_by("-timestamp", "-id").values_list("id", flat=True))
+        for size in (1, 2, 3, 7, 10):
+            with self.subTest(size=size):
+                pages = self.walk(size)
+                self.assertEqual([pk for page in pages for pk in page], expected)
+                self.assertTrue(all(len(page) == size for page in pages[:-1]))
+                self.assertTrue(pages[-1])
+
+    @override_settings(PAGE_SIZE=3)
+    def test_view_pages_to_the_end(self):
+        seen, cursor = [], None
+        while True:
+            params = {"after": cursor} if cursor else {}
+            response = self.client.get(reverse('transactions'), params)
+            self.assertEqual(response.status_code, 200)
+            seen += [txn.id for txn in response.context['transactions']]
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), sorted(Transaction.objects.values_list("id", flat=True)))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_garbage_cursor_is_a_bad_request(self):
+        first = Transaction.objects.order_by("-timestamp", "-id").first()
+        cursor = encode_cursor(first)
+
+        def b64(raw):
+            return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+        garbage = [
+            "garbage", "%%%", cursor[:-3], b64("no-separator"), b64("a|b|c"),
+            b64(f"{first.timestamp.isoformat()}|abc"), b64(f"{first.timestamp.isoformat()}|{2 ** 64}"),
+            b64(f"{first.timestamp.isoformat()}|-1"), b64(f"{first.timestamp.replace(tzinfo=None).isoformat()}|1"),
+            base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+        ]
+        for bad in garbage:
+            for param in ("after", "logs_after"):
+                with self.subTest(cursor=bad, param=param):
+                    response = self.client.get(reverse('transactions'), {param: bad})
+                    self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.client.get(reverse('transactions'), {"after": cursor}).status_code, 200)
+
+
+class DashboardInvalidationTests(TestCase):
+    def setUp(self):
+        self.leader = CustomUser.objects.create_user(username="kiprono", email="kiprono@example.com", password="pw")
+        self.member = CustomUser.objects.create_user(username="awino", email="awino@example.com", password="pw")
+        chama = Chama.objects.create(name="Renamed Chama", created_by=self.leader)
+        Member.objects.create(user=self.leader, chama=chama, role='leader')
+        Member.objects.create(user=self.member, chama=chama)
+
+    def leader_shown_to(self, user):
+        summary = get_summary(user.id)
+        return (summary['leader_chamas'] + summary['member_chamas'])[0]['leader']
+
+    def test_renaming_a_leader_refreshes_members_dashboards(self):
+        self.assertEqual(self.leader_shown_to(self.member), "kiprono")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.leader.username = "kiprono.k"
+            self.leader.save()
+        self.assertEqual(self.leader_shown_to(self.member), "kiprono.k")
+
+    def test_login_keeps_the_cache(self):
+        get_summary(self.member.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.login(username="kiprono", password="pw")
+        self.assertIsNotNone(cache.get(summary_key(self.member.id)))
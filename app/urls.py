@@ -53,4 +53,37 @@ urlpatterns = [
         auth_views.PasswordResetCompleteView.as_view(template_name='app/password_reset_complete.html'),
         name='password_reset_complete'
     ),
-]
\ No newline at end of file
+]
+# Most queries a request to each URL may make (session and user lookups
+# included); app.tests.QueryBudgetTests enforces them and, with
+# SQL_BUDGET_ENABLED, the SQL budget middleware reports against them.
+# None means measured but unbudgeted.
+QUERY_BUDGETS = {
+    'home': 2,
+    'signup': 10,
+    'login': 6,
+    'logout': 4,
+    'update_user': 5,
+    'dashboard': 10,  # a cache miss; a hit is 3
+    'create_chama': 13,
+    'add_member': 12,
+    'add_contribution': 9,
+    'contributions_list': 6,
+    'contributions_overview': 3,
+    'members_home': 3,
+    'chama_members': 5,
+    'accounts': 3,
+    'withdraw': 25,
+    'transactions': 4,
+    'about': 2,
+    'contact_support': 2,
+    'support_success': 2,
+    # deleting a chama cascades row by row through the model signals
+    'delete_chama_confirm': None,
+    'leave_chama_confirm': 8,
+    'remove_member_confirm': 18,
+    'password_reset': 4,
+    'password_reset_done': 2,
+    'password_reset_confirm': 4,
+    'password_reset_complete': 2,
+}
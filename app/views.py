@@ -4,14 +4,20 @@ from .forms import CustomUserCreationForm, ChamaForm, AddMemberForm, Contributio
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django.contrib import messages
-from django.db.models import Sum
 from decimal import Decimal
 from django.db import transaction
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseBadRequest, HttpResponseForbidden
+from django.conf import settings
 import uuid
 
-from .models import Chama, Member, CustomUser, Contribution, VirtualAccount
-from payments.models import Transaction, AuditLog
+from .models import Chama, Member, CustomUser, Contribution
+from payments.models import Transaction, AuditLog, ChamaStats
+from payments.utils.ledger import InsufficientFunds, post_transactions
+from payments.utils.chama_stats import record_transactions
+from payments.utils.jobs import enqueue
+from payments.utils.pagination import InvalidCursor, keyset_page
+from payments.utils.dashboard import get_summary
+from payments.utils.receipts import render_receipt
 
 User = get_user_model()
 
@@ -83,13 +89,15 @@ def contact_support(request):
 
 # ====================================================================================================
 def transactions_view(request):
-    # get the user's chamas
-    memberships = Member.objects.filter(user=request.user)
-    chamas = [m.chama for m in memberships]
+    # the user's chamas, as a subquery
+    chamas = Member.objects.filter(user=request.user).values('chama')
 
-    # get all transactions and audit logs for those chamas
-    transactions = Transaction.objects.filter(chama__in=chamas).order_by('-timestamp')
-    audit_logs = AuditLog.objects.filter(chama__in=chamas).order_by('-timestamp')
+    # transactions and audit logs for those chamas, with everything the
+    # rows print fetched in the same query
+    transactions = Transaction.objects.filter(chama__in=chamas).select_related(
+        'chama', 'member__user', 'audit_log'
+    )
+    audit_logs = AuditLog.objects.filter(chama__in=chamas).select_related('chama', 'user', 'transaction')
 
     # handle filter toggle: deposit / withdrawal / all
     filter_type = request.GET.get('type', 'all')
@@ -100,11 +108,20 @@ def transactions_view(request):
     elif filter_type == 'withdrawal':
         transactions = transactions.filter(transaction_type='withdrawal')
         audit_logs = audit_logs.filter(action_type='withdrawal')
-    
+
+    # each list pages independently, by cursor rather than offset
+    try:
+        transactions, next_cursor = keyset_page(transactions, request.GET.get('after'), settings.PAGE_SIZE)
+        audit_logs, next_logs_cursor = keyset_page(audit_logs, request.GET.get('logs_after'), settings.PAGE_SIZE)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid page cursor.")
+
     context = {
         'transactions': transactions,
         'audit_logs': audit_logs,
-        'filter_type': filter_type
+        'filter_type': filter_type,
+        'next_cursor': next_cursor,
+        'next_logs_cursor': next_logs_cursor,
     }
     return render(request, 'app/transactions.html', context)
 
@@ -134,32 +151,33 @@ def withdraw_view(request, chama_id):
                 })
 
             # Use atomic block to ensure balance + transaction integrity
-            with transaction.atomic():
-                account = VirtualAccount.objects.filter(chama=chama).select_for_update().first()
-
-                if not account or account.balance < amount:
-                    return render(request, "payments/withdraw_form.html", {
-                        "chama": chama,
-                        "error_message": "Insufficient balance."
-                    })
-
-                # Deduct from chama account
-                account.balance -= amount
-                account.save()
-
-                # Record withdrawal transaction
-                txn = Transaction.objects.create(
-                    chama=chama,
-                    member=member,
-                    initiated_by=request.user.username,
-                    amount=amount,
-                    checkout_id=f"WITHDRAW-{chama.id}-{request.user.id}-{uuid.uuid4().hex[:8].upper()}",
-                    mpesa_code=f"WDR-{uuid.uuid4().hex[:8].upper()}",
-                    phone_number=phone,
-                    status="Simulated",
-                    transaction_type="withdrawal",
-                )
-                # AuditLog auto-created by signal
+            try:
+                with transaction.atomic():
+                    # Record withdrawal transaction
+                    txn = Transaction.objects.create(
+                        chama=chama,
+                        member=member,
+                        initiated_by=request.user.username,
+                        amount=amount,
+                        checkout_id=f"WITHDRAW-{chama.id}-{request.user.id}-{uuid.uuid4().hex[:8].upper()}",
+                        mpesa_code=f"WDR-{uuid.uuid4().hex[:8].upper()}",
+                        phone_number=phone,
+                        status="Simulated",
+                        transaction_type="withdrawal",
+                    )
+                    # AuditLog auto-created by signal; the receipt is rendered by a worker
+                    enqueue(render_receipt, transaction_id=txn.id)
+
+                    # Deduct from chama account through the ledger; the balance update is a
+                    # single conditional UPDATE, so it can't go negative
+                    post_transactions([txn])
+                    # the chama's running totals, last for the same reason
+                    record_transactions([txn])
+            except InsufficientFunds:
+                return render(request, "payments/withdraw_form.html", {
+                    "chama": chama,
+                    "error_message": "Insufficient balance."
+                })
 
             # Redirect to transaction list after success
             return redirect('transactions')
@@ -184,26 +202,20 @@ def transaction_list(request):
 
 # ====================================================================================================
 def accounts_view(request):
-    memberships = Member.objects.filter(user=request.user)
-    chamas = [m.chama for m in memberships]
+    # one query: each membership with its chama and the chama's main account;
+    # the membership row itself says whether the user leads the chama
+    memberships = Member.objects.filter(user=request.user).select_related('chama__virtual_accounts')
     accounts = []
 
-    for chama in chamas:
-        # get the chama's main account
-        main_account = VirtualAccount.objects.filter(chama=chama).first()
-
-        # check if the currrent user is the leader of this chama
-        is_leader = Member.objects.filter(
-            user = request.user,
-            chama = chama,
-            role = 'leader'
-        ).exists()
+    for membership in memberships:
+        chama = membership.chama
+        main_account = getattr(chama, 'virtual_accounts', None)
 
         accounts.append({
             "chama": chama,
             "account_number": main_account.account_number if main_account else chama.account_number,
             "balance": main_account.balance if main_account else 0,
-            "is_leader": is_leader,
+            "is_leader": membership.role == 'leader',
         })
     return render(request, "app/accounts.html", {"accounts": accounts})
 
@@ -258,10 +270,10 @@ def contributions_list(request, chama_id):
     # get all contributions for this chama
     contributions = Contribution.objects.filter(
         member__chama=chama
-    ).order_by('-date')
+    ).select_related('member__user').order_by('-date')
 
-    # calculate total contributions
-    total = contributions.aggregate(Sum('amount'))['amount__sum'] or 0
+    # the running total kept in ChamaStats, rather than summing the history
+    total = ChamaStats.objects.filter(chama=chama).values_list('contribution_total', flat=True).first() or 0
 
     return render(
         request,
@@ -376,50 +388,9 @@ def home_view(request):
 # ====================================================================================================
 @login_required
 def dashboard_view(request):
-    memberships = Member.objects.filter(user=request.user).select_related('chama')
-
-    # Separate leader and member chamas
-    leader_chamas = []
-    member_chamas = []
-
-    for m in memberships:
-        chama = m.chama
-
-        # Safely get chama balance
-        first_account = getattr(chama, 'virtual_accounts', None)
-        chama.balance_display = first_account.balance if first_account else 0
-
-        # Sort into leader/member lists
-        if m.role == 'leader':
-            leader_chamas.append(chama)
-        else:
-            member_chamas.append(chama)
-
-    # Summary statistics
-    total_chamas = memberships.count()
-    total_members = Member.objects.filter(chama__in=[m.chama for m in memberships]).count()
-
-    # Calculate total balance across user’s chamas
-    total_balance = sum(
-        chama.balance_display for chama in leader_chamas + member_chamas
-    )
-
-    # Recent transactions (latest 5)
-    recent_transactions = (
-        Contribution.objects.filter(member__user=request.user)
-        .select_related('member', 'member__user')
-        .order_by('-date')[:5]
-    )
-
-    context = {
-        'leader_chamas': leader_chamas,
-        'member_chamas': member_chamas,
-        'total_chamas': total_chamas,
-        'total_members': total_members,
-        'total_balance': total_balance,
-        'recent_transactions': recent_transactions,
-    }
-
+    # chamas, balances, totals and recent contributions are precomputed per
+    # user and cached; saves to any of them drop the summaries they appear in
+    context = get_summary(request.user.id)
 
     return render(request, 'app/dashboard.html', context)
 # ====================================================================================================
@@ -3,6 +3,11 @@ ASGI config for chama_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The async payment views (STK push, status, callback) only free up the worker
+while waiting on Daraja when served through here, e.g.:
+
+    gunicorn chama_project.asgi:application -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -14,3 +19,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chama_project.settings')
 
 application = get_asgi_application()
+
+# the server's event loops outlive every request, so each can keep one
+# pooled httpx client for Daraja
+from payments.utils.daraja import use_long_lived_loops  # noqa: E402
+
+use_long_lived_loops()
@@ -26,6 +26,86 @@ MPESA_SHORTCODE = os.getenv("MPESA_SHORTCODE")
 CALLBACK_URL = os.getenv("CALLBACK_URL")
 MPESA_BASE_URL = os.getenv("MPESA_BASE_URL")
 
+# Access tokens are reused until this many seconds before `expires_in`
+MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv("MPESA_TOKEN_REFRESH_MARGIN", "120"))
+# How long other workers wait for the worker that is refreshing the token
+MPESA_TOKEN_LOCK_TIMEOUT = int(os.getenv("MPESA_TOKEN_LOCK_TIMEOUT", "10"))
+
+# Operational counters (token cache hits, duplicate callbacks) are kept in
+# memory and written to the database at most this often (seconds) per process
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "10"))
+
+# Daraja HTTP client: keep-alive pool size and (connect, read) timeouts in seconds
+MPESA_POOL_SIZE = int(os.getenv("MPESA_POOL_SIZE", "10"))
+MPESA_CONNECT_TIMEOUT = float(os.getenv("MPESA_CONNECT_TIMEOUT", "3.05"))
+MPESA_READ_TIMEOUT = float(os.getenv("MPESA_READ_TIMEOUT", "15"))
+# Dotted path to a requests adapter class that answers Daraja calls instead of Safaricom
+MPESA_TRANSPORT = os.getenv("MPESA_TRANSPORT", "")
+# Same for the async (httpx) client used by the payment views under ASGI
+MPESA_ASYNC_TRANSPORT = os.getenv("MPESA_ASYNC_TRANSPORT", "")
+
+# STK status polls are answered locally for this many seconds after the push,
+# then Daraja is queried at most once per interval per CheckoutRequestID
+MPESA_STATUS_GRACE_PERIOD = int(os.getenv("MPESA_STATUS_GRACE_PERIOD", "20"))
+MPESA_STATUS_QUERY_INTERVAL = int(os.getenv("MPESA_STATUS_QUERY_INTERVAL", "10"))
+# Long-poll status requests are held open this long, re-checking the DB/cache
+# every recheck interval in case the callback landed on another worker
+MPESA_STATUS_WAIT_TIMEOUT = int(os.getenv("MPESA_STATUS_WAIT_TIMEOUT", "25"))
+MPESA_STATUS_RECHECK_INTERVAL = float(os.getenv("MPESA_STATUS_RECHECK_INTERVAL", "2"))
+# "inline" applies each callback before acknowledging it; "spool" stores it and
+# acknowledges at once, leaving drain_callback_spool to apply callbacks in batches
+MPESA_CALLBACK_MODE = os.getenv("MPESA_CALLBACK_MODE", "inline")
+# Pending STK pushes with no result after this many seconds are expired by reconcile_payments,
+# once Daraja has been asked and still has no result for them
+MPESA_PENDING_EXPIRY = int(os.getenv("MPESA_PENDING_EXPIRY", str(60 * 60 * 24)))
+
+# Background jobs: "queue" stores them for run_jobs workers; "immediate" runs
+# them in-process once the enqueuing transaction commits (tests, local dev)
+JOBS_MODE = os.getenv("JOBS_MODE", "queue")
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "1"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "5"))
+# retry delay doubles from the base up to the max (seconds)
+JOBS_BACKOFF_BASE = int(os.getenv("JOBS_BACKOFF_BASE", "10"))
+JOBS_BACKOFF_MAX = int(os.getenv("JOBS_BACKOFF_MAX", "3600"))
+# workers refresh their running jobs' heartbeat this often (seconds); a job
+# whose heartbeat is older than JOBS_STALE_AFTER belongs to a dead worker
+JOBS_HEARTBEAT_INTERVAL = int(os.getenv("JOBS_HEARTBEAT_INTERVAL", "30"))
+JOBS_STALE_AFTER = int(os.getenv("JOBS_STALE_AFTER", "600"))
+JOBS_RETENTION_DAYS = int(os.getenv("JOBS_RETENTION_DAYS", "7"))
+
+# Rendered receipt PDFs kept in memory per process (bytes)
+RECEIPT_CACHE_BYTES = int(os.getenv("RECEIPT_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Dotted path of the Django Storage class receipts are kept in
+RECEIPT_STORAGE = os.getenv("RECEIPT_STORAGE", "payments.utils.receipt_storage.ShardedReceiptStorage")
+# How download_receipt hands the file over: "django" (render from memory),
+# "x-accel-redirect" (nginx), "x-sendfile" (Apache/lighttpd) or "redirect" (to the storage URL)
+RECEIPT_SERVE_MODE = os.getenv("RECEIPT_SERVE_MODE", "django")
+# internal nginx location that maps onto the receipt storage, e.g.
+#   location /protected/receipts/ { internal; alias /srv/chama/media/receipts/; }
+RECEIPT_ACCEL_PREFIX = os.getenv("RECEIPT_ACCEL_PREFIX", "/protected/receipts/")
+
+# Rows per page on the transactions and audit log lists
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+# Seconds a cached dashboard summary may live; saves drop it sooner
+DASHBOARD_CACHE_TIMEOUT = int(os.getenv("DASHBOARD_CACHE_TIMEOUT", "3600"))
+
+# Per-request query counting against the QUERY_BUDGETS in each urls.py; off
+# in production unless being investigated. SQL_BUDGET_REPORT is "header",
+# "log" or "both" (over-budget requests are always logged)
+SQL_BUDGET_ENABLED = os.getenv("SQL_BUDGET_ENABLED", "False") == "True"
+SQL_BUDGET_REPORT = os.getenv("SQL_BUDGET_REPORT", "both")
+
+# Report lines go to the "payments.utils.sql_budget" logger: INFO per
+# request, WARNING when over budget
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "payments.utils.sql_budget": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -64,6 +144,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payments.utils.sql_budget.SQLBudgetMiddleware',             # first, so it sees every query (off by default)
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',               # ✅ After SecurityMiddleware
     'django.contrib.sessions.middleware.SessionMiddleware',      # ✅ Required for admin
@@ -109,6 +190,18 @@ DATABASES = {
 
 
 
+# Cache
+# Database backed so every gunicorn worker sees the same entries (M-Pesa token, etc.)
+# The table is created by the payments migrations.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'chama_cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -158,4 +251,8 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 DEFAULT_FROM_EMAIL = 'noreply@chamaapp.com'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# LocalObjectStorage, the local object-store stand-in for receipts
+RECEIPT_OBJECT_STORE_ROOT = os.getenv("RECEIPT_OBJECT_STORE_ROOT", os.path.join(MEDIA_ROOT, "object-store"))
+RECEIPT_OBJECT_STORE_URL = os.getenv("RECEIPT_OBJECT_STORE_URL", "/object-store/")
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Transaction, AuditLog
+from .models import Transaction, AuditLog, PendingPayment, CallbackSpool, MonthlyBalance, BalanceCheck, Job, ChamaStats
 
 # Register your models here.
 admin.site.register(Transaction)
@@ -9,3 +9,36 @@ class AuditLogAdmin(admin.ModelAdmin):
     readonly_fields = [f.name for f in AuditLog._meta.get_fields()]
     search_fields = ("reference_no", "chama__name", "action_type")
     list_filter = ("action_type", "chama")
+
+@admin.register(PendingPayment)
+class PendingPaymentAdmin(admin.ModelAdmin):
+    list_display = ("checkout_request_id", "chama", "amount", "status", "attempts", "created_at")
+    search_fields = ("checkout_request_id", "phone_number", "chama__name")
+    list_filter = ("status",)
+
+@admin.register(CallbackSpool)
+class CallbackSpoolAdmin(admin.ModelAdmin):
+    list_display = ("id", "checkout_request_id", "status", "attempts", "received_at", "processed_at")
+    search_fields = ("checkout_request_id",)
+    list_filter = ("status",)
+
+@admin.register(MonthlyBalance)
+class MonthlyBalanceAdmin(admin.ModelAdmin):
+    list_display = ("chama", "month", "opening_balance", "deposits", "withdrawals", "closing_balance")
+    readonly_fields = [f.name for f in MonthlyBalance._meta.get_fields()]
+    list_filter = ("month",)
+
+@admin.register(BalanceCheck)
+class BalanceCheckAdmin(admin.ModelAdmin):
+    list_display = ("chama", "expected_balance", "accepted_drift", "drift", "checked_at")
+    list_filter = ("checked_at",)
+
+@admin.register(ChamaStats)
+class ChamaStatsAdmin(admin.ModelAdmin):
+    list_display = ("chama", "member_count", "contribution_total", "deposit_total", "withdrawal_total", "last_activity")
+    readonly_fields = [f.name for f in ChamaStats._meta.get_fields()]
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "task", "status", "priority", "attempts", "run_at", "finished_at")
+    list_filter = ("status", "task")
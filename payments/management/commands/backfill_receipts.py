@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from payments.models import StoredReceipt, Transaction
+from payments.utils.receipts import is_current, receipt_etag, record_stored
+from payments.utils.render_pool import init_worker, render_batch
+
+CHECKPOINT_KEY = "receipts:backfill:checkpoint"
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-render receipts whose inputs (transaction fields, layout version or storage) changed, "
+        "across a process pool. An interrupted run resumes from its checkpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+        parser.add_argument('--chunk-size', type=int, default=500, help="Transactions fetched per database round trip")
+        parser.add_argument('--batch-size', type=int, default=25, help="Receipts sent to a worker at a time")
+        parser.add_argument('--force', action='store_true', help="Render every receipt, changed or not")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the first transaction")
+        parser.add_argument('--start-after', type=int, help="Start after this transaction id")
+
+    def handle(self, *args, **options):
+        if options['start_after'] is not None:
+            start_after = options['start_after']
+        elif options['restart']:
+            start_after = 0
+        else:
+            start_after = cache.get(CHECKPOINT_KEY, 0)
+        if start_after:
+            self.stdout.write(f"Resuming after transaction #{start_after}")
+
+        transactions = (
+            Transaction.objects.select_related("member__user")
+            .filter(id__gt=start_after).order_by("id")
+            .iterator(chunk_size=options['chunk_size'])
+        )
+
+        self.seen = self.rendered = 0
+        self.started = time.perf_counter()
+
+        pool = ProcessPoolExecutor(
+            max_workers=options['workers'],
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        )
+        with pool:
+            # keep a couple of chunks in flight so workers don't idle while the next one is fetched
+            in_flight = deque()
+            while True:
+                chunk = list(islice(transactions, options['chunk_size']))
+                if not chunk:
+                    break
+                in_flight.append((chunk[-1].id, len(chunk), self._submit(pool, chunk, options)))
+                if len(in_flight) > 2:
+                    self._finish(*in_flight.popleft())
+            while in_flight:
+                self._finish(*in_flight.popleft())
+
+        # finished: the next run starts from the beginning again (and skips
+        # everything that hasn't changed)
+        cache.delete(CHECKPOINT_KEY)
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f"Done: {self.seen} transactions checked, {self.rendered} receipts rendered in {elapsed:.1f}s "
+            f"({self.rendered / elapsed if elapsed else 0:.0f} receipts/s)."
+        )
+
+    def _submit(self, pool, chunk, options):
+        stored = StoredReceipt.objects.in_bulk([t.id for t in chunk])
+        stale = []
+        for txn in chunk:
+            etag = receipt_etag(txn)
+            if options['force'] or not is_current(stored.get(txn.id), etag):
+                stale.append((txn, etag))
+
+        size = options['batch_size']
+        return [pool.submit(render_batch, stale[i:i + size]) for i in range(0, len(stale), size)]
+
+    def _finish(self, last_id, count, futures):
+        receipts = [receipt for future in futures for receipt in future.result()]
+        if receipts:
+            record_stored(receipts)
+        # everything up to last_id is rendered and recorded, so a rerun can start after it
+        cache.set(CHECKPOINT_KEY, last_id, None)
+
+        self.seen += count
+        self.rendered += len(receipts)
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f"Through #{last_id}: {self.seen} checked, {self.rendered} rendered, "
+            f"{self.rendered / elapsed:.0f} receipts/s"
+        )
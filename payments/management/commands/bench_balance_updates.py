@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction
+
+from app.models import Chama, VirtualAccount
+from payments.utils.balances import credit
+
+
+class Command(BaseCommand):
+    help = "Hammer one chama's balance from many threads and report lost updates and deposits per second"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--deposits', type=int, default=200, help="Deposits per thread")
+        parser.add_argument('--modes', default="save,locked,atomic",
+                            help="save: read, add, save() (old callback); locked: select_for_update then save(); atomic: F() increment")
+
+    def handle(self, *args, **options):
+        user, _ = get_user_model().objects.get_or_create(
+            username="bench-balance", defaults={"email": "bench-balance@example.invalid"}
+        )
+        chama = Chama.objects.create(name="Balance benchmark", created_by=user)
+
+        try:
+            for mode in options['modes'].split(","):
+                self._run(chama, mode.strip(), options['threads'], options['deposits'])
+        finally:
+            chama.delete()
+
+    def _run(self, chama, mode, threads, deposits):
+        VirtualAccount.objects.filter(chama=chama).update(balance=0)
+        deposit = getattr(self, f"_deposit_{mode}")
+        amount = Decimal("1.00")
+
+        def worker(_):
+            done = 0
+            try:
+                for _ in range(deposits):
+                    try:
+                        with transaction.atomic():
+                            deposit(chama, amount)
+                        done += 1
+                    except OperationalError:
+                        # lock timeout / deadlock (SQLite can't upgrade a read lock under contention)
+                        pass
+            finally:
+                connection.close()
+            return done
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            committed = sum(pool.map(worker, range(threads)))
+        elapsed = time.perf_counter() - start
+
+        expected = amount * committed
+        actual = VirtualAccount.objects.get(chama=chama).balance
+        self.stdout.write(
+            f"{mode:>7}: {committed / elapsed:8.1f} deposits/s, {threads * deposits - committed} failed, "
+            f"balance {actual} of {expected} ({int(expected - actual)} lost updates)"
+        )
+
+    def _deposit_save(self, chama, amount):
+        account = VirtualAccount.objects.get(chama=chama)
+        account.balance += amount
+        account.save()
+
+    def _deposit_locked(self, chama, amount):
+        account = VirtualAccount.objects.select_for_update().get(chama=chama)
+        account.balance += amount
+        account.save()
+
+    def _deposit_atomic(self, chama, amount):
+        credit(chama.id, amount)
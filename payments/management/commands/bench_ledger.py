@@ -0,0 +1,78 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Chama
+from payments.models import JournalEntry, Posting
+from payments.utils.ledger import CLEARING, chama_accounts, post_entries, system_account
+
+
+class Command(BaseCommand):
+    help = (
+        "Show that posting a batch of journal entries costs the same however much "
+        "history a chama has. Runs in one transaction that is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--history', type=int, default=200_000, help="Journal entries of history to build up to")
+        parser.add_argument('--checkpoints', type=int, default=5, help="Points along the way to measure at")
+        parser.add_argument('--batch', type=int, default=100, help="Entries per timed post_entries() call")
+        parser.add_argument('--samples', type=int, default=5, help="Timed batches per checkpoint")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user, _ = get_user_model().objects.get_or_create(
+                username="bench-ledger", defaults={"email": "bench-ledger@example.invalid"}
+            )
+            chama = Chama.objects.create(name="Ledger benchmark", created_by=user)
+            wallet = chama_accounts([chama.id])[chama.id]
+            clearing = system_account(CLEARING)
+
+            step = options['history'] // options['checkpoints']
+            seeded = 0
+            self.stdout.write(f"{'history (entries)':>18} {'postings':>10} {'ms / batch':>11} {'entries/s':>10}")
+
+            for checkpoint in range(options['checkpoints'] + 1):
+                timings = []
+                for _ in range(options['samples']):
+                    batch = [self._entry(chama, wallet, clearing) for _ in range(options['batch'])]
+                    start = time.perf_counter()
+                    with transaction.atomic():
+                        post_entries(batch)
+                    timings.append(time.perf_counter() - start)
+                seeded += options['batch'] * options['samples']
+
+                best = sorted(timings)[len(timings) // 2]
+                self.stdout.write(
+                    f"{seeded:>18,} {seeded * 2:>10,} {best * 1000:>11.1f} {options['batch'] / best:>10.0f}"
+                )
+
+                if checkpoint < options['checkpoints']:
+                    seeded += self._seed(chama, wallet, clearing, step)
+
+            transaction.set_rollback(True)
+
+    def _entry(self, chama, wallet, clearing):
+        amount = Decimal("1.00")
+        return (
+            JournalEntry(chama=chama, description="Benchmark deposit"),
+            [(clearing, amount), (wallet, -amount)],
+        )
+
+    def _seed(self, chama, wallet, clearing, count, chunk=10_000):
+        # history is written straight to the tables; only the timed batches go through post_entries
+        done = 0
+        while done < count:
+            size = min(chunk, count - done)
+            entries = JournalEntry.objects.bulk_create(
+                [JournalEntry(chama=chama, description="Benchmark history") for _ in range(size)]
+            )
+            Posting.objects.bulk_create(
+                [Posting(entry=e, account=clearing, amount=Decimal("1.00"), created_at=e.created_at) for e in entries]
+                + [Posting(entry=e, account=wallet, amount=Decimal("-1.00"), created_at=e.created_at) for e in entries]
+            )
+            done += size
+        return done
@@ -0,0 +1,43 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from payments.models import Transaction
+from payments.utils.receipts import render_receipt_canvas, render_receipt_pdf
+
+
+class Command(BaseCommand):
+    help = "Receipts per second: drawing each receipt on a canvas vs stamping the precompiled template"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        # an unsaved transaction: the benchmark needs no database rows
+        txn = Transaction(
+            id=1,
+            amount=Decimal("1500.00"),
+            checkout_id="ws_CO_BENCH",
+            mpesa_code="BENCH12345",
+            phone_number="254700000000",
+            status="Success",
+            initiated_by="phone",
+            transaction_type="deposit",
+            timestamp=timezone.now(),
+        )
+
+        if render_receipt_pdf(txn) != render_receipt_canvas(txn):
+            raise CommandError("The template and the canvas renderer disagree; not benchmarking.")
+
+        results = {}
+        for name, render in (("canvas", render_receipt_canvas), ("template", render_receipt_pdf)):
+            start = time.perf_counter()
+            for _ in range(options['count']):
+                render(txn)
+            elapsed = time.perf_counter() - start
+            results[name] = options['count'] / elapsed
+            self.stdout.write(f"{name:>9}: {results[name]:>8.0f} receipts/s ({elapsed / options['count'] * 1e6:.0f} us each)")
+
+        self.stdout.write(f"Speedup: {results['template'] / results['canvas']:.1f}x, identical output.")
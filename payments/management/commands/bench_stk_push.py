@@ -0,0 +1,82 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from payments.utils.daraja import AsyncDarajaClient, DarajaClient
+from payments.utils.simulator import DarajaSimulator, serve
+
+
+class Command(BaseCommand):
+    help = "Compare concurrent STK push throughput of the sync and async Daraja clients against a local stand-in"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="STK pushes per run")
+        parser.add_argument('--latency', type=float, default=0.2, help="Seconds the stand-in takes per STK push")
+        parser.add_argument('--sync-workers', type=int, default=4, help="Concurrent requests on the sync path (gunicorn sync workers)")
+        parser.add_argument('--concurrency', type=int, default=200, help="In-flight requests on the async path")
+
+    def handle(self, *args, **options):
+        simulator = DarajaSimulator(latency=str(options['latency']), deliver_callbacks=False)
+        server = serve(simulator)
+
+        client_options = {
+            "base_url": f"http://127.0.0.1:{server.server_port}",
+            "consumer_key": "bench",
+            "consumer_secret": "bench",
+            "shortcode": "174379",
+            "passkey": "bench",
+            "callback_url": "http://127.0.0.1/payments/callback/",
+        }
+        total = options['requests']
+
+        try:
+            sync_elapsed = self._run_sync(client_options, total, options['sync_workers'])
+            async_elapsed = asyncio.run(self._run_async(client_options, total, options['concurrency']))
+        finally:
+            server.shutdown()
+            server.server_close()
+            simulator.close()
+
+        self.stdout.write(f"{total} STK pushes, {options['latency'] * 1000:.0f} ms upstream latency")
+        self.stdout.write(f"sync  ({options['sync_workers']} workers): {sync_elapsed:.2f}s, {total / sync_elapsed:.1f} req/s")
+        self.stdout.write(f"async ({options['concurrency']} in flight): {async_elapsed:.2f}s, {total / async_elapsed:.1f} req/s")
+
+    def _run_sync(self, client_options, total, workers):
+        client = DarajaClient(pool_size=workers, **client_options)
+        client.access_token()  # warm the token cache, like a long running worker
+
+        def push(i):
+            return client.stk_push("254700000000", 1, "BENCH", f"Bench {i}")
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(push, range(total)))
+        elapsed = time.perf_counter() - start
+
+        client.close()
+        self._check(results)
+        return elapsed
+
+    async def _run_async(self, client_options, total, concurrency):
+        client = AsyncDarajaClient(pool_size=concurrency, **client_options)
+        await client.access_token()
+        limit = asyncio.Semaphore(concurrency)
+
+        async def push(i):
+            async with limit:
+                return await client.stk_push("254700000000", 1, "BENCH", f"Bench {i}")
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(push(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+        await client.aclose()
+        self._check(results)
+        return elapsed
+
+    def _check(self, results):
+        failed = sum(1 for r in results if r.get("ResponseCode") != "0")
+        if failed:
+            self.stderr.write(f"{failed} STK pushes failed")
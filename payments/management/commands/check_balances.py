@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils.consistency import accept_drift, check_balances
+
+
+class Command(BaseCommand):
+    help = (
+        "Check every chama's balance against its transactions, starting where the last run "
+        "stopped. Meant to run nightly; exits non-zero when a balance has drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=int, default=300, help="Leave transactions younger than this many seconds for the next run")
+        parser.add_argument('--full', action='store_true', help="Ignore the high-water mark and re-verify all history")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--accept', type=int, nargs='+', metavar='CHAMA_ID', help="Accept these chamas' last reported drift as explained")
+
+    def handle(self, *args, **options):
+        if options['accept']:
+            accept_drift(options['accept'])
+            self.stdout.write(f"Accepted drift for {len(options['accept'])} chama(s).")
+            return
+
+        start = time.perf_counter()
+        try:
+            run, drift = check_balances(options['lag'], options['full'], options['chunk_size'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"Checked {run.chamas_checked} chamas ({run.transactions_checked} new transactions, "
+            f"through #{run.transaction_high_water}) in {elapsed:.1f}s: {run.drifted} drifted."
+        )
+        for row in drift:
+            self.stdout.write(
+                f"  chama {row['chama_id']} {row['chama__name']}: balance {row['balance']}, "
+                f"expected {row['expected']}, drift {row['drift']:+}"
+            )
+        if drift:
+            raise CommandError(f"{len(drift)} chama balance(s) drifted.")
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils.periods import close_periods
+
+
+class Command(BaseCommand):
+    help = "Close ended months into per-chama MonthlyBalance rows (run early each month, e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until', help="Close months before this one (YYYY-MM); defaults to the current month")
+
+    def handle(self, *args, **options):
+        until = None
+        if options['until']:
+            try:
+                until = datetime.strptime(options['until'], "%Y-%m").date()
+            except ValueError:
+                raise CommandError("--until must look like 2025-03")
+
+        closed = 0
+        for month, rows in close_periods(until):
+            closed += 1
+            self.stdout.write(f"{month:%Y-%m}: {rows} chamas closed")
+
+        if not closed:
+            self.stdout.write("Nothing to close.")
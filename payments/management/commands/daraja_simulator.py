@@ -0,0 +1,75 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.utils.simulator import DarajaSimulator, serve
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for Daraja (OAuth, STK push/query, callbacks), or fire a "
+        "burst of callbacks at the app and report throughput and tail latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default="127.0.0.1")
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument('--callback-url', default=None, help="Where callbacks are POSTed (defaults to CALLBACK_URL)")
+        parser.add_argument('--latency', default="lognormal:0.3,0.5",
+                            help='Response latency: "0.2", "uniform:a,b", "normal:mean,sd" or "lognormal:median,sigma"')
+        parser.add_argument('--callback-delay', default="uniform:2,15", help="Delay between push and callback, same format")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Share of calls answered with a 503")
+        parser.add_argument('--cancel-rate', type=float, default=0.1, help="Share of pushes the customer cancels")
+        parser.add_argument('--duplicate-rate', type=float, default=0.0, help="Share of callbacks delivered twice")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--burst', type=int, default=0, help="Send this many callbacks at once, report, and exit")
+        parser.add_argument('--account-reference', default=None, help="Chama account number for --burst callbacks")
+        parser.add_argument('--phone', default="254700000000")
+        parser.add_argument('--concurrency', type=int, default=50, help="Parallel connections for --burst")
+
+    def handle(self, *args, **options):
+        simulator = DarajaSimulator(
+            callback_url=options['callback_url'],
+            latency=options['latency'],
+            callback_delay=options['callback_delay'],
+            error_rate=options['error_rate'],
+            cancel_rate=options['cancel_rate'],
+            duplicate_rate=options['duplicate_rate'],
+            deliver_callbacks=not options['burst'],
+            seed=options['seed'],
+        )
+
+        if options['burst']:
+            if not options['account_reference']:
+                raise CommandError("--burst needs --account-reference (a chama account number).")
+            self._burst(simulator, options)
+            return
+
+        server = serve(simulator, options['host'], options['port'])
+        self.stdout.write(f"Daraja simulator on http://{options['host']}:{server.server_port}, callbacks to {simulator.callback_url}")
+        self.stdout.write("Point MPESA_BASE_URL at it. Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(10)
+                self.stdout.write(str(simulator.stats))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            simulator.close()
+
+    def _burst(self, simulator, options):
+        stats = simulator.burst(
+            options['burst'],
+            options['account_reference'],
+            phone=options['phone'],
+            concurrency=options['concurrency'],
+        )
+        self.stdout.write(
+            f"Sent {stats['sent']} callbacks in {stats['elapsed']:.2f}s "
+            f"({stats['sent'] / stats['elapsed']:.1f}/s), {stats['failed']} not acknowledged"
+        )
+        self.stdout.write(
+            f"ACK latency p50 {stats['p50'] * 1000:.0f} ms, p95 {stats['p95'] * 1000:.0f} ms, "
+            f"p99 {stats['p99'] * 1000:.0f} ms, max {stats['max'] * 1000:.0f} ms"
+        )
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments.utils.callbacks import drain_spool
+
+
+class Command(BaseCommand):
+    help = "Apply spooled M-Pesa callbacks in micro-batches (MPESA_CALLBACK_MODE=spool)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--loop', action='store_true', help="Keep draining instead of exiting when the spool is empty")
+        parser.add_argument('--idle-sleep', type=float, default=0.5, help="Seconds to wait when the spool is empty (with --loop)")
+
+    def handle(self, *args, **options):
+        totals = [0, 0, 0]
+        start = time.perf_counter()
+
+        try:
+            while True:
+                try:
+                    rows, applied, skipped, failed = drain_spool(options['batch_size'])
+                except Exception as e:
+                    # bad rows are failed one by one inside drain_spool; this is
+                    # the database itself, so a worker waits and tries again
+                    if not options['loop']:
+                        raise
+                    self.stderr.write(f"Drain failed: {type(e).__name__}: {e}")
+                    time.sleep(options['idle_sleep'])
+                    continue
+                totals = [totals[0] + applied, totals[1] + skipped, totals[2] + failed]
+
+                if rows:
+                    self.stdout.write(f"Batch: {applied} applied, {skipped} duplicates, {failed} failed")
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['idle_sleep'])
+        except KeyboardInterrupt:
+            pass
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"Drained in {elapsed:.1f}s: {totals[0]} applied, {totals[1]} duplicates, {totals[2]} failed."
+        )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from payments.utils import counters
+from payments.utils.callbacks import CALLBACK_STATS_KEYS
+from payments.utils.daraja import get_client
+
+
+class Command(BaseCommand):
+    help = "Show M-Pesa counters: access token reuse and duplicate callbacks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Reset the counters after printing them")
+
+    def handle(self, *args, **options):
+        token_provider = get_client().tokens
+        stats = token_provider.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = (stats["hits"] / lookups * 100) if lookups else 0
+
+        self.stdout.write(f"Token lookups: {lookups}")
+        self.stdout.write(f"Cache hits: {stats['hits']} ({hit_rate:.1f}%)")
+        self.stdout.write(f"Cache misses: {stats['misses']}")
+        self.stdout.write(f"Token endpoint calls: {stats['refreshes']}")
+
+        callbacks = counters.read(CALLBACK_STATS_KEYS)
+        self.stdout.write(f"Duplicate callbacks: {callbacks['duplicates']}")
+        self.stdout.write(f"Duplicates caught at insert: {callbacks['duplicate_races']}")
+
+        if options['reset']:
+            token_provider.reset_stats()
+            counters.reset(CALLBACK_STATS_KEYS)
+            self.stdout.write(self.style.SUCCESS("Counters reset."))
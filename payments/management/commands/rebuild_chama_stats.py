@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from payments.utils.chama_stats import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute ChamaStats from contributions, transactions and members. For repair after "
+        "writes that skipped the model signals (raw SQL, queryset.update(), bulk loads) and "
+        "transactions written outside the payment paths (admin, shell)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('chama_ids', type=int, nargs='*', metavar='CHAMA_ID', help="Only these chamas (default: all)")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        # in one transaction, so pages never see half the chamas rebuilt
+        with transaction.atomic():
+            count = rebuild(options['chama_ids'] or None)
+        self.stdout.write(f"Rebuilt stats for {count} chamas in {time.perf_counter() - start:.2f}s.")
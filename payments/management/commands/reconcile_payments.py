@@ -0,0 +1,157 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+
+from app.models import Member
+from payments.models import CallbackSpool, PendingPayment, Transaction
+from payments.utils.daraja import get_client
+from payments.utils.stk_status import remember_result
+from payments.views import query_stk_push, record_deposit
+
+
+class RateLimiter:
+    """Spaces out calls so that at most `rate` start per second, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_at)
+            self.next_at = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Command(BaseCommand):
+    help = "Finalize or expire STK pushes whose callback never arrived, querying Daraja in rate-limited batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=120, help="Only check pushes at least this many seconds old")
+        parser.add_argument('--recheck-after', type=int, default=60, help="Seconds before a row is queried again")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--concurrency', type=int, default=4, help="Daraja queries in flight")
+        parser.add_argument('--rate', type=float, default=5, help="Maximum Daraja queries per second")
+        parser.add_argument('--limit', type=int, default=None, help="Stop after checking this many rows")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        # past this a push will never get a result, but it is still queried
+        # first: the reconciler may have been down while a paid push's
+        # callback went missing
+        expires_before = now - timedelta(seconds=settings.MPESA_PENDING_EXPIRY)
+
+        stale = PendingPayment.objects.filter(
+            status="pending",
+            created_at__lte=now - timedelta(seconds=options['min_age']),
+        ).filter(
+            Q(last_checked_at__isnull=True) | Q(last_checked_at__lte=now - timedelta(seconds=options['recheck_after']))
+        ).order_by("id")
+
+        limiter = RateLimiter(options['rate'])
+        counts = {"checked": 0, "success": 0, "failed": 0, "pending": 0, "spooled": 0, "errors": 0, "expired": 0}
+        last_id = 0
+        start = time.perf_counter()
+
+        get_client()  # build the shared client before the threads race for it
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            while options['limit'] is None or counts["checked"] < options['limit']:
+                batch_size = options['batch_size']
+                if options['limit'] is not None:
+                    batch_size = min(batch_size, options['limit'] - counts["checked"])
+
+                batch = list(stale.filter(id__gt=last_id).select_related("chama")[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                def query(pending):
+                    limiter.wait()
+                    try:
+                        return query_stk_push(pending.checkout_request_id)
+                    except Exception as e:
+                        # one bad row (or Daraja reply) mustn't end the run
+                        return {"error": f"{type(e).__name__}: {e}"}
+
+                unresolved = []
+                for pending, status in zip(batch, pool.map(query, batch)):
+                    try:
+                        outcome = self._apply(pending, status)
+                    except Exception as e:
+                        status = {"error": f"{type(e).__name__}: {e}"}
+                        outcome = "errors"
+                    if "error" in status:
+                        self.stderr.write(f"{pending.checkout_request_id}: {status['error']}")
+                    elif outcome == "pending" and pending.created_at < expires_before:
+                        # Daraja answered and still has no result (or no record) of it
+                        unresolved.append(pending.pk)
+                        outcome = "expired"
+                    counts[outcome] += 1
+                PendingPayment.objects.filter(pk__in=unresolved, status="pending").update(
+                    status="expired", result_desc="No result before expiry", updated_at=timezone.now(),
+                )
+                counts["checked"] += len(batch)
+
+                checked_at = timezone.now()
+                for pending in batch:
+                    pending.attempts += 1
+                    pending.last_checked_at = checked_at
+                PendingPayment.objects.bulk_update(batch, ["attempts", "last_checked_at"])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"Checked {counts['checked']} in {elapsed:.1f}s: {counts['success']} succeeded, "
+            f"{counts['failed']} failed, {counts['pending']} still pending, {counts['spooled']} awaiting the spool, "
+            f"{counts['errors']} errors, {counts['expired']} expired."
+        )
+
+    def _apply(self, pending, status):
+        if "ResultCode" not in status:
+            # still processing, or Daraja errored; try again next run
+            return "pending"
+
+        result_code = str(status["ResultCode"])
+        result_desc = status.get("ResultDesc", "")[:255]
+
+        if result_code == "0":
+            # the real callback is queued; drain_callback_spool records it
+            # with its M-Pesa receipt number, so don't credit it here too
+            if CallbackSpool.objects.filter(checkout_request_id=pending.checkout_request_id, status="queued").exists():
+                return "spooled"
+            self._record_success(pending)
+            outcome = "success"
+        else:
+            outcome = "failed"
+
+        PendingPayment.objects.filter(pk=pending.pk, status="pending").update(
+            status=outcome, result_code=result_code, result_desc=result_desc, updated_at=timezone.now(),
+        )
+        remember_result(pending.checkout_request_id, result_code, result_desc)
+        return outcome
+
+    def _record_success(self, pending):
+        if Transaction.objects.filter(checkout_id=pending.checkout_request_id).exists():
+            return
+
+        member = Member.objects.select_related("user").filter(
+            chama=pending.chama, user__phone_number=pending.phone_number
+        ).first()
+        try:
+            # the STK query doesn't return the M-Pesa receipt number
+            record_deposit(
+                pending.chama, member, pending.amount, pending.checkout_request_id,
+                f"RECON-{pending.checkout_request_id}", pending.phone_number,
+            )
+        except IntegrityError:
+            # the callback arrived while we were querying
+            pass
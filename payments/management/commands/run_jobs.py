@@ -0,0 +1,43 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from payments.utils.jobs import work
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the jobs table (start as many of these as you like)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help="Worker threads in this process")
+        parser.add_argument('--batch-size', type=int, default=10, help="Jobs claimed per round trip")
+        parser.add_argument('--once', action='store_true', help="Exit once no job is due instead of polling")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        totals = []
+
+        def worker():
+            try:
+                totals.append(work(batch_size=options['batch_size'], stop=stop, once=options['once']))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['workers'])]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        done = sum(d for d, _ in totals)
+        failed = sum(f for _, f in totals)
+        self.stdout.write(f"Workers stopped: {done} jobs done, {failed} failed.")
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.6 on 2026-10-17 15:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_remove_virtualaccount_member_and_more'),
+        ('payments', '0005_create_cache_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingPayment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkout_request_id', models.CharField(max_length=100, unique=True)),
+                ('merchant_request_id', models.CharField(blank=True, max_length=100)),
+                ('phone_number', models.CharField(max_length=15)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('success', 'Success'), ('failed', 'Failed'), ('expired', 'Expired')], default='pending', max_length=20)),
+                ('result_code', models.CharField(blank=True, max_length=20)),
+                ('result_desc', models.CharField(blank=True, max_length=255)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_checked_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chama', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_payments', to='app.chama')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='payments_pe_status_e9dde6_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from django.db import migrations
+
+
+def open_ledger(apps, schema_editor):
+    # every existing transaction gets its journal entry, dated when it
+    # happened, so balances on past dates come from the ledger too. Whatever
+    # of a wallet's balance the transactions don't explain is posted as one
+    # opening entry dated before the chama's first transaction.
+    VirtualAccount = apps.get_model('app', 'VirtualAccount')
+    Transaction = apps.get_model('payments', 'Transaction')
+    LedgerAccount = apps.get_model('payments', 'LedgerAccount')
+    JournalEntry = apps.get_model('payments', 'JournalEntry')
+    Posting = apps.get_model('payments', 'Posting')
+
+    clearing, _ = LedgerAccount.objects.get_or_create(code="mpesa:clearing", defaults={"name": "M-Pesa paybill clearing"})
+    opening, _ = LedgerAccount.objects.get_or_create(code="equity:opening", defaults={"name": "Opening balances"})
+
+    for va in VirtualAccount.objects.select_related('chama'):
+        wallet, _ = LedgerAccount.objects.get_or_create(
+            code=f"chama:{va.chama_id}",
+            defaults={"name": f"{va.chama.name} wallet", "virtual_account": va},
+        )
+
+        entries = []
+        txns = list(Transaction.objects.filter(chama_id=va.chama_id).order_by('timestamp', 'id'))
+        for txn in txns:
+            if txn.transaction_type == "withdrawal":
+                description, legs = f"Withdrawal {txn.mpesa_code}", [(wallet, txn.amount), (clearing, -txn.amount)]
+            else:
+                description, legs = f"Deposit {txn.mpesa_code}", [(clearing, txn.amount), (wallet, -txn.amount)]
+            entry = JournalEntry(chama_id=va.chama_id, transaction_id=txn.id, description=description)
+            entries.append((entry, txn.timestamp, legs))
+
+        # wallets are credit-normal: the transactions explain minus the wallet's postings
+        explained = -sum(amount for _, _, legs in entries for account, amount in legs if account == wallet)
+        unexplained = va.balance - explained
+        if unexplained:
+            opened_at = va.chama.created_at
+            if txns:
+                opened_at = min(opened_at, txns[0].timestamp - timedelta(seconds=1))
+            entry = JournalEntry(chama_id=va.chama_id, description="Opening balance")
+            entries.insert(0, (entry, opened_at, [(opening, unexplained), (wallet, -unexplained)]))
+
+        if not entries:
+            continue
+        JournalEntry.objects.bulk_create([entry for entry, _, _ in entries], batch_size=500)
+        # created_at is auto_now_add, so the real dates go in after the insert
+        for entry, created_at, _ in entries:
+            entry.created_at = created_at
+        JournalEntry.objects.bulk_update([entry for entry, _, _ in entries], ["created_at"], batch_size=500)
+        Posting.objects.bulk_create([
+            Posting(entry=entry, account=account, amount=amount)
+            for entry, _, legs in entries
+            for account, amount in legs
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_remove_virtualaccount_member_and_more'),
+        ('payments', '0009_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.6 on 2026-10-17 15:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_remove_virtualaccount_member_and_more'),
+        ('payments', '0010_ledger_opening_balances'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('opening_balance', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('deposits', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('deposit_count', models.PositiveIntegerField(default=0)),
+                ('withdrawals', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('withdrawal_count', models.PositiveIntegerField(default=0)),
+                ('adjustments', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('closing_balance', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('closed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['chama', 'month'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='journalentry',
+            index=models.Index(fields=['chama', 'created_at'], name='payments_jo_chama_i_967701_idx'),
+        ),
+        migrations.AddField(
+            model_name='monthlybalance',
+            name='chama',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_balances', to='app.chama'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlybalance',
+            unique_together={('chama', 'month')},
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.6 on 2026-10-17 15:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_remove_virtualaccount_member_and_more'),
+        ('payments', '0011_monthly_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_high_water', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('transactions_checked', models.PositiveIntegerField(default=0)),
+                ('chamas_checked', models.PositiveIntegerField(default=0)),
+                ('drifted', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceCheck',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expected_balance', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('accepted_drift', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('drift', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('checked_at', models.DateTimeField(auto_now=True)),
+                ('chama', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance_check', to='app.chama')),
+            ],
+        ),
+    ]
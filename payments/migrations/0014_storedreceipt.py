@@ -0,0 +1,24 @@
+# Generated by Django 5.2.6 on 2026-10-17 15:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0013_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredReceipt',
+            fields=[
+                ('transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stored_receipt', serialize=False, to='payments.transaction')),
+                ('etag', models.CharField(max_length=64)),
+                ('storage', models.CharField(max_length=200)),
+                ('name', models.CharField(max_length=255)),
+                ('rendered_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
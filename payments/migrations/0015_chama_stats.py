@@ -0,0 +1,59 @@
+# Generated by Django 5.2.6 on 2026-10-17 16:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def fill_stats(apps, schema_editor):
+    # one row per existing chama, counted from its history; from here on
+    # the model signals keep them current
+    Chama = apps.get_model('app', 'Chama')
+    Contribution = apps.get_model('app', 'Contribution')
+    Member = apps.get_model('app', 'Member')
+    Transaction = apps.get_model('payments', 'Transaction')
+    ChamaStats = apps.get_model('payments', 'ChamaStats')
+
+    rows = []
+    for chama in Chama.objects.all():
+        contributions = Contribution.objects.filter(member__chama=chama).aggregate(total=Sum('amount'), latest=Max('date'))
+        members = Member.objects.filter(chama=chama).aggregate(count=Count('id'), latest=Max('joined_at'))
+        transactions = Transaction.objects.filter(chama=chama)
+        deposits = transactions.filter(transaction_type='deposit').aggregate(total=Sum('amount'))
+        withdrawals = transactions.filter(transaction_type='withdrawal').aggregate(total=Sum('amount'))
+        latest = transactions.aggregate(latest=Max('timestamp'))['latest']
+        rows.append(ChamaStats(
+            chama=chama,
+            contribution_total=contributions['total'] or 0,
+            deposit_total=deposits['total'] or 0,
+            withdrawal_total=withdrawals['total'] or 0,
+            member_count=members['count'],
+            last_activity=max(filter(None, [contributions['latest'], members['latest'], latest]), default=None),
+        ))
+    ChamaStats.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_remove_virtualaccount_member_and_more'),
+        ('payments', '0014_storedreceipt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChamaStats',
+            fields=[
+                ('chama', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='app.chama')),
+                ('contribution_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('deposit_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('withdrawal_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('last_activity', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Chama stats',
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
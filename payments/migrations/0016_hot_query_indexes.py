@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-17 16:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_hot_query_indexes'),
+        ('payments', '0015_chama_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['chama', '-timestamp', '-id'], name='payments_au_chama_i_5bc9bc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['chama', 'action_type', '-timestamp', '-id'], name='payments_au_chama_i_4016e3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['chama', '-timestamp', '-id'], name='payments_tr_chama_i_25c81a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['chama', 'transaction_type', '-timestamp', '-id'], name='payments_tr_chama_i_04bb2f_idx'),
+        ),
+    ]
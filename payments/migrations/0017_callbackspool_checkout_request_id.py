@@ -0,0 +1,22 @@
+# Generated by Django 5.2.6 on 2026-10-17 17:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0016_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackspool',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='callbackspool',
+            index=models.Index(fields=['checkout_request_id', 'status'], name='payments_ca_checkou_7c2c34_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0017_callbackspool_checkout_request_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackspool',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_entry_times(apps, schema_editor):
+    JournalEntry = apps.get_model('payments', 'JournalEntry')
+    Posting = apps.get_model('payments', 'Posting')
+    Posting.objects.update(
+        created_at=Subquery(JournalEntry.objects.filter(pk=OuterRef('entry_id')).values('created_at')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0018_callbackspool_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='posting',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(copy_entry_times, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='posting',
+            name='created_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='posting',
+            index=models.Index(fields=['account', 'created_at'], name='payments_po_account_d53258_idx'),
+        ),
+    ]
@@ -1,7 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from decimal import Decimal
 import uuid
 
@@ -39,10 +40,296 @@ class Transaction(models.Model):
         default="deposit"
     )
 
+    class Meta:
+        indexes = [
+            # transactions_view and statements: a chama's transactions in
+            # (timestamp, id) order, seeking straight to a keyset cursor
+            models.Index(fields=["chama", "-timestamp", "-id"]),
+            # the same with the deposit/withdrawal filter, so a rare type
+            # doesn't walk past every row of the common one
+            models.Index(fields=["chama", "transaction_type", "-timestamp", "-id"]),
+        ]
+
     def __str__(self):
         who = self.member.user.username if self.member else (self.initiated_by or "Unknown")
         return f"{who} - {self.amount} KES ({self.transaction_type})"
 
+class PendingPayment(models.Model):
+    """
+    An STK push Safaricom accepted but we haven't seen the result of yet.
+    Finalized by the callback, or by the reconcile_payments command when
+    the callback never arrives.
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("success", "Success"),
+        ("failed", "Failed"),
+        ("expired", "Expired"),
+    ]
+
+    chama = models.ForeignKey("app.Chama", on_delete=models.CASCADE, related_name='pending_payments')
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    merchant_request_id = models.CharField(max_length=100, blank=True)
+    phone_number = models.CharField(max_length=15)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    result_code = models.CharField(max_length=20, blank=True)
+    result_desc = models.CharField(max_length=255, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_checked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # the reconciler scans pending rows oldest first
+            models.Index(fields=["status", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.checkout_request_id} - {self.amount} KES ({self.status})"
+
+class CallbackSpool(models.Model):
+    """
+    Raw Daraja callback, stored as received so it can be acknowledged
+    straight away and applied later in batches by drain_callback_spool.
+    """
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    body = models.TextField()
+    # copied out of the body so the reconciler can see a result is already queued
+    checkout_request_id = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="queued")
+    error = models.TextField(blank=True)
+    # times the drain has failed to apply it
+    attempts = models.PositiveSmallIntegerField(default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"]),
+            models.Index(fields=["checkout_request_id", "status"]),
+        ]
+
+    def __str__(self):
+        return f"Callback #{self.pk} ({self.status})"
+
+class Counter(models.Model):
+    """Operational counter shared by every worker (token cache hits, duplicate callbacks, ...)."""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+class LedgerAccount(models.Model):
+    """
+    An account in the double-entry ledger. Each chama wallet has one, linked
+    to its VirtualAccount, alongside a few system accounts (M-Pesa clearing,
+    opening balances).
+    """
+    code = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=255)
+    virtual_account = models.OneToOneField(
+        "app.VirtualAccount",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="ledger_account",
+    )
+
+    def __str__(self):
+        return f"{self.code} ({self.name})"
+
+class JournalEntry(models.Model):
+    """An append-only ledger entry; its postings always sum to zero."""
+    chama = models.ForeignKey("app.Chama", on_delete=models.CASCADE, null=True, blank=True, related_name="journal_entries")
+    transaction = models.OneToOneField(
+        "Transaction",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="journal_entry",
+    )
+    description = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # a chama's entries for a period (period close, balance tail scans)
+            models.Index(fields=["chama", "created_at"]),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError("Journal entries cannot be edited once posted.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Journal entries cannot be deleted.")
+
+    def __str__(self):
+        return f"#{self.pk} {self.description}"
+
+class Posting(models.Model):
+    """
+    One leg of a journal entry. Debits are positive and credits negative, so
+    a chama wallet (money owed to the chama) grows with credits.
+    """
+    # a chama's history goes when the chama is deleted, as its transactions do
+    entry = models.ForeignKey(JournalEntry, on_delete=models.CASCADE, related_name="postings")
+    account = models.ForeignKey(LedgerAccount, on_delete=models.CASCADE, related_name="postings")
+    amount = models.DecimalField(max_digits=14, decimal_places=2)
+    # the entry's created_at, copied so an account's postings for a period
+    # are one index range instead of its whole history joined to the entries
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # an account's history, newest last
+            models.Index(fields=["account", "entry"]),
+            # an account's postings for a period (period close, balance tails)
+            models.Index(fields=["account", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.account.code} {self.amount}"
+
+class MonthlyBalance(models.Model):
+    """
+    A closed month of a chama's wallet: its opening and closing balance and
+    the deposits and withdrawals in between. Written once by close_periods;
+    the closing balance is the snapshot historical balances start from.
+    """
+    chama = models.ForeignKey("app.Chama", on_delete=models.CASCADE, related_name="monthly_balances")
+    month = models.DateField()  # first day of the month
+    opening_balance = models.DecimalField(max_digits=14, decimal_places=2)
+    deposits = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    deposit_count = models.PositiveIntegerField(default=0)
+    withdrawals = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    withdrawal_count = models.PositiveIntegerField(default=0)
+    # entries without a transaction, e.g. opening balances
+    adjustments = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    closing_balance = models.DecimalField(max_digits=14, decimal_places=2)
+    closed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("chama", "month")
+        ordering = ["chama", "month"]
+
+    def __str__(self):
+        return f"{self.chama} {self.month:%Y-%m}: {self.closing_balance}"
+
+class BalanceCheck(models.Model):
+    """
+    What check_balances expects a chama's balance to be: the net of its
+    transactions up to the last run's high-water mark, plus any drift an
+    admin has looked into and accepted (e.g. balances set by hand).
+    """
+    chama = models.OneToOneField("app.Chama", on_delete=models.CASCADE, related_name="balance_check")
+    expected_balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    accepted_drift = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    drift = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    checked_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.chama}: expected {self.expected_balance}, drift {self.drift}"
+
+class BalanceCheckRun(models.Model):
+    """One check_balances run; the latest one holds the high-water marks the next run starts from."""
+    transaction_high_water = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    transactions_checked = models.PositiveIntegerField(default=0)
+    chamas_checked = models.PositiveIntegerField(default=0)
+    drifted = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Run {self.pk}: {self.drifted} drifted of {self.chamas_checked}"
+
+class Job(models.Model):
+    """
+    A unit of background work: `task` is the dotted path of a function that
+    is called with `kwargs`. Enqueued with payments.utils.jobs.enqueue and
+    run by run_jobs workers.
+    """
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    task = models.CharField(max_length=200)
+    kwargs = models.JSONField(default=dict, blank=True)
+    # higher runs first
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="queued")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # refreshed by the worker while the job runs; a stale one means the worker died
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # what workers claim from; done/failed rows stay out of it
+            models.Index(
+                fields=["-priority", "run_at", "id"],
+                condition=models.Q(status="queued"),
+                name="payments_job_queue_idx",
+            ),
+            models.Index(fields=["status", "finished_at"]),
+        ]
+
+    def __str__(self):
+        return f"#{self.pk} {self.task} ({self.status})"
+
+class StoredReceipt(models.Model):
+    """
+    The receipt last rendered for a transaction: what it was rendered from
+    (its ETag) and where it was written. A receipt whose ETag or storage
+    no longer matches needs rendering again.
+    """
+    transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, primary_key=True, related_name="stored_receipt")
+    etag = models.CharField(max_length=64)
+    storage = models.CharField(max_length=200)
+    name = models.CharField(max_length=255)
+    rendered_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+class ChamaStats(models.Model):
+    """
+    Running totals for a chama, kept up to date in the same database
+    transaction as the rows they count, so pages read them instead of
+    aggregating history. rebuild_chama_stats recomputes them from scratch.
+    """
+    chama = models.OneToOneField("app.Chama", on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    contribution_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    deposit_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    withdrawal_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    member_count = models.PositiveIntegerField(default=0)
+    # latest contribution, transaction or new member
+    last_activity = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "Chama stats"
+
+    def __str__(self):
+        return f"{self.chama}: {self.member_count} members, {self.contribution_total} contributed"
+
 class AuditLog(models.Model):
     ACTION_TYPES = [
         ("deposit", "Deposit"),
@@ -78,6 +365,11 @@ class AuditLog(models.Model):
         ordering = ['-timestamp']
         verbose_name = "Audit Log"
         verbose_name_plural = "Audit Logs"
+        indexes = [
+            # the audit log list on transactions_view, with and without the type filter
+            models.Index(fields=["chama", "-timestamp", "-id"]),
+            models.Index(fields=["chama", "action_type", "-timestamp", "-id"]),
+        ]
 
     @receiver(post_save, sender=Transaction)
     def create_audit_log(sender, instance, created, **kwargs):
@@ -93,4 +385,50 @@ class AuditLog(models.Model):
                 )
             
             except Exception as e:
-                print(f"Audit log creation failed: {e}")
\ No newline at end of file
+                print(f"Audit log creation failed: {e}")
+
+
+# a recorded transaction moves its chama's balance, which every member's dashboard shows
+@receiver([post_save, post_delete], sender=Transaction)
+def invalidate_transaction_dashboards(sender, instance, **kwargs):
+    from payments.utils.dashboard import invalidate_chamas
+    invalidate_chamas([instance.chama_id])
+
+
+# ChamaStats: every change is counted by an UPDATE inside the transaction
+# that makes it. Edits are rare, so the old row is read before saving and
+# counted out again, which also covers a row moving to another chama.
+# Transactions are the exception: the deposit and withdrawal paths count them
+# with chama_stats.record_transactions as their last statement, so the hot
+# stats row is locked only briefly, as the wallet row is. Transactions
+# edited, deleted or created anywhere else (admin, shell, fixtures) are left
+# to rebuild_chama_stats, so nothing is uncounted that was never counted.
+@receiver(post_save, sender="app.Chama")
+def create_chama_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ChamaStats.objects.get_or_create(chama=instance)
+
+@receiver(pre_save, sender="app.Contribution")
+@receiver(pre_save, sender="app.Member")
+def remember_counted_stats(sender, instance, raw=False, **kwargs):
+    from payments.utils.chama_stats import counted
+    if instance.pk and not raw:
+        old = sender.objects.filter(pk=instance.pk).first()
+        instance._counted_stats = counted(old) if old else None
+
+@receiver(post_save, sender="app.Contribution")
+@receiver(post_save, sender="app.Member")
+def count_chama_stats(sender, instance, created, raw=False, **kwargs):
+    from payments.utils import chama_stats
+    if raw:
+        return
+    before = getattr(instance, "_counted_stats", None)
+    if before:
+        chama_stats.uncount(*before)
+    chama_stats.count(*chama_stats.counted(instance))
+
+@receiver(post_delete, sender="app.Contribution")
+@receiver(post_delete, sender="app.Member")
+def uncount_chama_stats(sender, instance, **kwargs):
+    from payments.utils import chama_stats
+    chama_stats.uncount(*chama_stats.counted(instance))
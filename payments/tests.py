@@ -1,220 +1,1137 @@
-import requests, base64, json, re, os
-from datetime import datetime
-from django.shortcuts import render, redirect
-from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponseBadRequest
-from .models import Transaction
-from .forms import PaymentForm
-from dotenv import load_dotenv
-from django.conf import settings
-from django.utils.timezone import make_aware
-
-from app.models import Chama, Member, Contribution, CustomUser
-
-# Load environment variables
-load_dotenv()
-
-# Retrieve variables from the environment
-CONSUMER_KEY = settings.CONSUMER_KEY
-CONSUMER_SECRET = settings.CONSUMER_SECRET
-MPESA_PASSKEY = settings.MPESA_PASSKEY
-
-MPESA_SHORTCODE = settings.MPESA_SHORTCODE
-CALLBACK_URL = settings.CALLBACK_URL
-MPESA_BASE_URL = settings.MPESA_BASE_URL
-
-# Phone number formatting and validation
-def format_phone_number(phone):
-    phone = phone.replace("+", "")
-    if re.match(r"^254\d{9}$", phone):
-        return phone
-    elif phone.startswith("0") and len(phone) == 10:
-        return "254" + phone[1:]
-    else:
-        raise ValueError("Invalid phone number format")
-
-# Generate M-Pesa access token
-def generate_access_token():
-    try:
-        credentials = f"{CONSUMER_KEY}:{CONSUMER_SECRET}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-
-        headers = {
-            "Authorization": f"Basic {encoded_credentials}",
-            "Content-Type": "application/json",
+import asyncio
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+import requests
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Count, F, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from requests.adapters import BaseAdapter
+
+from app.models import Chama, Member, CustomUser, VirtualAccount
+from .management.commands.backfill_receipts import CHECKPOINT_KEY
+from .models import (
+    AuditLog, BalanceCheck, CallbackSpool, ChamaStats, Job, JournalEntry, MonthlyBalance, PendingPayment, Posting,
+    StoredReceipt, Transaction,
+)
+from .utils import counters
+from .utils.callbacks import CALLBACK_STATS_KEYS, drain_spool
+from .utils.consistency import check_balances
+from .utils.daraja import (
+    AsyncDarajaClient, DarajaClient, ThreadedDarajaClient, get_async_client, get_client, set_client,
+)
+from .utils.jobs import claim, enqueue, heartbeat, requeue_stale, run
+from .utils.ledger import (
+    InsufficientFunds, UnbalancedEntry, chama_accounts, ledger_balance, post_entries, post_transactions,
+)
+from .utils.periods import (
+    BeforeLedgerStart, balance_at, close_periods, ledger_start, month_bounds, month_start, monthly_report, previous_month,
+)
+from .utils.receipt_storage import (
+    LocalObjectStorage, ShardedReceiptStorage, get_receipt_storage, receipt_name, set_receipt_storage,
+)
+from .utils.receipts import record_stored, render_receipt_canvas, render_receipt_pdf
+from .utils.statements import statement_chunks
+from .utils.stk_status import (
+    PENDING, mark_started, notify_stk_result, remember_result, resolve_stk_status, wait_for_stk_status,
+)
+from .utils.tokens import AccessTokenProvider
+from .views import record_deposit
+
+
+# jobs are stored by dotted path, so test tasks live at module level
+job_calls = []
+
+
+def recording_job(**kwargs):
+    job_calls.append(kwargs)
+
+
+def failing_job(**kwargs):
+    raise RuntimeError("receipt printer on fire")
+
+
+class StkStatusWaitTests(TestCase):
+    async def push(self, *args):
+        return {"ResponseCode": "0", "CheckoutRequestID": "ws_CO_WAIT", "MerchantRequestID": "29115-1"}
+
+    def wait(self, timeout):
+        return self.client.get(reverse('stk_status_wait', args=["ws_CO_WAIT"]), {"timeout": timeout})
+
+    def test_rejects_bad_timeouts(self):
+        # NaN would slip through min() and never time out
+        for timeout in ("nan", "inf", "-inf", "-1", "soon", ""):
+            with self.subTest(timeout=timeout):
+                response = self.wait(timeout)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"error": "Invalid timeout"})
+
+    def test_zero_timeout_answers_at_once(self):
+        mark_started("ws_CO_WAIT")
+        response = self.wait("0")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"status": PENDING})
+
+    def test_pending_page_long_polls_only_under_asgi(self):
+        user = CustomUser.objects.create_user(username="njeri", email="njeri@example.com", password="pw")
+        chama = Chama.objects.create(name="Poll Chama", created_by=user)
+        form = {"phone_number": "0711000000", "amount": 100}
+        with mock.patch("payments.views.ainitiate_stk_push", self.push):
+            # a held request would tie up a sync worker for the whole wait
+            response = self.client.post(reverse('payment', args=[chama.id]), form)
+            self.assertFalse(response.context["long_poll"])
+            self.assertNotContains(response, reverse('stk_status_wait', args=["ws_CO_WAIT"]))
+
+            PendingPayment.objects.all().delete()
+            response = async_to_sync(self.async_client.post)(reverse('payment', args=[chama.id]), form)
+            self.assertTrue(response.context["long_poll"])
+            self.assertContains(response, reverse('stk_status_wait', args=["ws_CO_WAIT"]))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "stk-status-tests"}},
+    MPESA_STATUS_RECHECK_INTERVAL=30,
+)
+class StkStatusResolveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.queries = []
+
+    async def query(self, checkout_request_id, answer=None):
+        self.queries.append(checkout_request_id)
+        await asyncio.sleep(0.05)  # Daraja is slow; other polls pile up meanwhile
+        return answer or {"ResultCode": "0", "ResultDesc": "The service request is processed successfully."}
+
+    async def still_processing(self, checkout_request_id):
+        return await self.query(checkout_request_id, {"errorCode": "500.001.1001", "errorMessage": "Being processed"})
+
+    def test_concurrent_polls_share_one_query(self):
+        async def poll(count):
+            return await asyncio.gather(*(resolve_stk_status("ws_CO_FLIGHT", self.query) for _ in range(count)))
+
+        results = async_to_sync(poll)(10)
+        self.assertEqual(self.queries, ["ws_CO_FLIGHT"])
+        self.assertEqual({r["ResultCode"] for r in results}, {"0"})
+
+        # the final result is cached: later polls don't query at all
+        self.assertEqual(async_to_sync(poll)(3)[0]["ResultCode"], "0")
+        self.assertEqual(len(self.queries), 1)
+
+    def test_cheaper_sources_come_first(self):
+        mark_started("ws_CO_GRACE")
+        self.assertEqual(async_to_sync(resolve_stk_status)("ws_CO_GRACE", self.query), PENDING)
+
+        user = CustomUser.objects.create_user(username="wairimu", email="wairimu@example.com", password="pw")
+        chama = Chama.objects.create(name="Resolved Chama", created_by=user)
+        Transaction.objects.create(
+            chama=chama, amount=20, checkout_id="ws_CO_RECORDED", mpesa_code="RESOLVED1",
+            phone_number="254700000020", status="Success",
+        )
+        status = async_to_sync(resolve_stk_status)("ws_CO_RECORDED", self.query)
+        self.assertEqual(status, {"ResultCode": "0", "ResultDesc": "Payment successful"})
+        self.assertEqual(self.queries, [])
+
+    def test_waiters_are_woken_with_the_final_result(self):
+        def callback():
+            # the callback is handled on another thread, as under a threaded server
+            remember_result("ws_CO_WAKE", 1032, "Request cancelled by user")
+            notify_stk_result("ws_CO_WAKE")
+
+        async def scenario():
+            waiters = [
+                asyncio.ensure_future(wait_for_stk_status("ws_CO_WAKE", self.still_processing, 10))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0.2)
+            self.assertFalse(any(w.done() for w in waiters))
+            start = time.monotonic()
+            await asyncio.to_thread(callback)
+            results = await asyncio.gather(*waiters)
+            return results, time.monotonic() - start
+
+        results, elapsed = async_to_sync(scenario)()
+        self.assertEqual(results, [{"ResultCode": "1032", "ResultDesc": "Request cancelled by user"}] * 3)
+        # woken, not picked up at the 30s recheck
+        self.assertLess(elapsed, 5)
+        self.assertEqual(self.queries, ["ws_CO_WAKE"])
+
+class ReconcilePaymentsTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="kamau", email="kamau@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Recon Chama", created_by=user)
+
+    def pending(self, checkout_id):
+        return PendingPayment.objects.create(
+            chama=self.chama, checkout_request_id=checkout_id, phone_number="254722000000", amount=100,
+        )
+
+    def reconcile(self, statuses):
+        def query(checkout_id):
+            status = statuses[checkout_id]
+            if isinstance(status, Exception):
+                raise status
+            return status
+
+        out, err = io.StringIO(), io.StringIO()
+        with mock.patch("payments.management.commands.reconcile_payments.query_stk_push", query):
+            call_command("reconcile_payments", "--min-age=0", "--rate=0", stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_one_failing_query_does_not_end_the_run(self):
+        self.pending("ws_CO_BROKEN")
+        self.pending("ws_CO_PAID")
+        out, err = self.reconcile({
+            "ws_CO_BROKEN": RuntimeError("unexpected reply"),
+            "ws_CO_PAID": {"ResultCode": "0", "ResultDesc": "Paid"},
+        })
+
+        self.assertIn("ws_CO_BROKEN: RuntimeError: unexpected reply", err)
+        self.assertIn("Checked 2", out)
+        self.assertTrue(Transaction.objects.filter(checkout_id="ws_CO_PAID").exists())
+        self.assertEqual(PendingPayment.objects.get(checkout_request_id="ws_CO_BROKEN").status, "pending")
+
+    def test_spooled_callback_is_left_to_the_drain(self):
+        self.pending("ws_CO_SPOOLED")
+        CallbackSpool.objects.create(body="{}", checkout_request_id="ws_CO_SPOOLED")
+        out, _ = self.reconcile({"ws_CO_SPOOLED": {"ResultCode": "0", "ResultDesc": "Paid"}})
+
+        self.assertIn("1 awaiting the spool", out)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(PendingPayment.objects.get().status, "pending")
+
+
+    @override_settings(MPESA_PENDING_EXPIRY=3600)
+    def test_old_pushes_are_queried_before_expiring(self):
+        for checkout_id in ("ws_CO_LATE_PAID", "ws_CO_LATE_UNKNOWN", "ws_CO_LATE_UNREACHABLE"):
+            self.pending(checkout_id)
+        # the reconciler was down for longer than the expiry window
+        PendingPayment.objects.update(created_at=timezone.now() - timedelta(hours=2))
+
+        out, _ = self.reconcile({
+            "ws_CO_LATE_PAID": {"ResultCode": "0", "ResultDesc": "Paid"},
+            "ws_CO_LATE_UNKNOWN": {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"},
+            "ws_CO_LATE_UNREACHABLE": {"error": "M-Pesa request timed out"},
+        })
+
+        statuses = dict(PendingPayment.objects.values_list("checkout_request_id", "status"))
+        self.assertEqual(statuses, {
+            "ws_CO_LATE_PAID": "success",
+            "ws_CO_LATE_UNKNOWN": "expired",
+            "ws_CO_LATE_UNREACHABLE": "pending",  # Daraja never answered
+        })
+        self.assertTrue(Transaction.objects.filter(checkout_id="ws_CO_LATE_PAID").exists())
+        self.assertIn("1 expired", out)
+
+@override_settings(MPESA_CALLBACK_MODE="spool")
+class CallbackSpoolTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="achieng", email="achieng@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Spool Chama", created_by=user)
+
+    def spool(self, checkout_id, receipt, chama=None):
+        body = {"Body": {"stkCallback": {
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": 0,
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": 100},
+                {"Name": "MpesaReceiptNumber", "Value": receipt},
+                {"Name": "PhoneNumber", "Value": 254733000000},
+                {"Name": "AccountReference", "Value": (chama or self.chama).account_number},
+            ]},
+        }}}
+        response = self.client.post(reverse('payment_callback'), body, content_type="application/json")
+        self.assertEqual(response.json()["ResultCode"], 0)
+        return CallbackSpool.objects.get(checkout_request_id=checkout_id)
+
+    def test_duplicate_receipt_is_skipped(self):
+        # recorded inline (or by another drainer) before this row was drained
+        Transaction.objects.create(
+            chama=self.chama, amount=100, checkout_id="ws_CO_INLINE", mpesa_code="SPOOLDUP1",
+            phone_number="254733000000", status="Success",
+        )
+        row = self.spool("ws_CO_REPLAY", "SPOOLDUP1")
+
+        self.assertEqual(drain_spool(10), (1, 0, 1, 0))
+        row.refresh_from_db()
+        self.assertEqual(row.status, "done")
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_chama_without_wallet_fails_alone(self):
+        orphan = Chama.objects.create(name="No Wallet", created_by=self.chama.created_by)
+        VirtualAccount.objects.filter(chama=orphan).delete()
+        row = self.spool("ws_CO_ORPHAN", "SPOOLORPH", chama=orphan)
+
+        self.assertEqual(drain_spool(10), (1, 0, 0, 1))
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.attempts), ("failed", 1))
+        self.assertIn("KeyError", row.error)
+        self.assertFalse(Transaction.objects.exists())
+        # and it isn't claimed again
+        self.assertEqual(drain_spool(10), (0, 0, 0, 0))
+
+    def test_mixed_batch_applies_the_good_rows(self):
+        orphan = Chama.objects.create(name="No Wallet", created_by=self.chama.created_by)
+        VirtualAccount.objects.filter(chama=orphan).delete()
+        good = [self.spool("ws_CO_GOOD1", "SPOOLGOOD1"), self.spool("ws_CO_GOOD2", "SPOOLGOOD2")]
+        bad = self.spool("ws_CO_BAD", "SPOOLBAD", chama=orphan)
+        garbage = CallbackSpool.objects.create(body="not json")
+
+        self.assertEqual(drain_spool(10), (4, 2, 0, 2))
+        statuses = dict(CallbackSpool.objects.values_list("pk", "status"))
+        self.assertEqual(
+            [statuses[row.pk] for row in good + [bad, garbage]],
+            ["done", "done", "failed", "failed"],
+        )
+        self.assertEqual(
+            set(Transaction.objects.values_list("mpesa_code", flat=True)), {"SPOOLGOOD1", "SPOOLGOOD2"},
+        )
+        self.assertEqual(VirtualAccount.objects.get(chama=self.chama).balance, 200)
+
+
+@override_settings(COUNTER_FLUSH_INTERVAL=3600)
+class DuplicateCallbackTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(
+            username="mutua", email="mutua@example.com", password="pw", phone_number="254744000000"
+        )
+        self.chama = Chama.objects.create(name="Replay Chama", created_by=user)
+        Member.objects.create(user=user, chama=self.chama, role='leader')
+        # counts live in memory until flushed, so they outlast a test's rollback
+        counters.reset(CALLBACK_STATS_KEYS)
+
+    def callback(self):
+        body = {"Body": {"stkCallback": {
+            "CheckoutRequestID": "ws_CO_REPLAY",
+            "ResultCode": 0,
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": 300},
+                {"Name": "MpesaReceiptNumber", "Value": "REPLAY0001"},
+                {"Name": "PhoneNumber", "Value": 254744000000},
+                {"Name": "AccountReference", "Value": self.chama.account_number},
+            ]},
+        }}}
+        response = self.client.post(reverse('payment_callback'), body, content_type="application/json")
+        self.assertEqual(response.json(), {"ResultCode": 0, "ResultDesc": "Payment successful"})
+
+    def snapshot(self):
+        return {
+            "transactions": Transaction.objects.count(),
+            "audit_logs": AuditLog.objects.count(),
+            "jobs": Job.objects.count(),
+            "postings": Posting.objects.count(),
+            "balance": VirtualAccount.objects.get(chama=self.chama).balance,
+            "deposits": ChamaStats.objects.get(chama=self.chama).deposit_total,
         }
-        response = requests.get(
-            f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
-            headers=headers,
-        ).json()
-
-        if "access_token" in response:
-            return response["access_token"]
-        else:
-            raise Exception("Access token missing in response.")
-
-    except requests.RequestException as e:
-        raise Exception(f"Failed to connect to M-Pesa: {str(e)}")
-
-# Initiate STK Push and handle response
-def initiate_stk_push(phone, amount, chama):
-    try:
-        token = generate_access_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        stk_password = base64.b64encode(
-            (MPESA_SHORTCODE + MPESA_PASSKEY + timestamp).encode()
-        ).decode()
-
-        request_body = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": stk_password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",  # Paybill
-            "Amount": amount,
-            "PartyA": phone,
-            "PartyB": MPESA_SHORTCODE,
-            "PhoneNumber": phone,
-            "CallBackURL": CALLBACK_URL,
-            "AccountReference": chama.account_number,  # dynamic account number per chama
-            "TransactionDesc": f"Contribution to {chama.name}",
+
+    def test_replay_is_a_read(self):
+        self.callback()
+        before = self.snapshot()
+        self.assertEqual((before["transactions"], before["balance"]), (1, 300))
+
+        with CaptureQueriesContext(connection) as captured:
+            self.callback()
+        writes = [q["sql"] for q in captured.captured_queries if not q["sql"].lstrip().upper().startswith("SELECT")]
+        self.assertEqual(writes, [])
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(counters.read(CALLBACK_STATS_KEYS)["duplicates"], 1)
+
+    def test_token_cache_hit_writes_nothing(self):
+        provider = AccessTokenProvider(fetch_token=lambda: ("token", 3600))
+        provider.reset_stats()
+        provider.get_token()
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(provider.get_token(), "token")
+        self.assertEqual([q["sql"].split()[0] for q in captured.captured_queries], ["SELECT"])
+        self.assertEqual(provider.stats(), {"hits": 1, "misses": 1, "refreshes": 1})
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="wekesa", email="wekesa@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Ledger Chama", created_by=self.user)
+        self.leader = Member.objects.create(user=self.user, chama=self.chama, role='leader')
+        self.client.force_login(self.user)
+
+    def deposit(self, amount):
+        n = Transaction.objects.count()
+        return record_deposit(self.chama, self.leader, Decimal(amount), f"ws_CO_LEDGER{n}", f"LEDGER{n}", "254755000000")
+
+    def withdraw(self, amount):
+        return self.client.post(reverse('withdraw', args=[self.chama.id]), {"amount": amount, "phone_number": "254755000000"})
+
+    def balance(self):
+        return VirtualAccount.objects.get(chama=self.chama).balance
+
+    def test_every_entry_sums_to_zero(self):
+        self.deposit(500)
+        self.deposit(120)
+        self.withdraw(300)
+
+        entries = JournalEntry.objects.annotate(total=Sum("postings__amount"), legs=Count("postings"))
+        self.assertEqual(len(entries), 3)
+        for entry in entries:
+            with self.subTest(entry=entry.description):
+                self.assertEqual(entry.legs, 2)
+                self.assertEqual(entry.total, 0)
+
+    def test_unbalanced_entry_is_refused(self):
+        wallet = chama_accounts([self.chama.id])[self.chama.id]
+        entry = JournalEntry(chama=self.chama, description="Lopsided")
+        with self.assertRaises(UnbalancedEntry), transaction.atomic():
+            post_entries([(entry, [(wallet, Decimal("-10"))])])
+        self.assertFalse(JournalEntry.objects.exists())
+        self.assertEqual(self.balance(), 0)
+
+    def test_overdraft_writes_nothing(self):
+        self.deposit(100)
+        before = (Transaction.objects.count(), AuditLog.objects.count(), Job.objects.count(), Posting.objects.count())
+
+        response = self.withdraw(150)
+
+        self.assertContains(response, "Insufficient balance.")
+        self.assertEqual(
+            (Transaction.objects.count(), AuditLog.objects.count(), Job.objects.count(), Posting.objects.count()),
+            before,
+        )
+        self.assertEqual(self.balance(), 100)
+
+    def test_post_entries_raises_on_overdraft(self):
+        txn = Transaction.objects.create(
+            chama=self.chama, amount=50, checkout_id="WITHDRAW-DIRECT", mpesa_code="WDR-DIRECT",
+            phone_number="254755000000", status="Simulated", transaction_type="withdrawal",
+        )
+        with self.assertRaises(InsufficientFunds), transaction.atomic():
+            post_transactions([txn])
+        self.assertFalse(JournalEntry.objects.exists())
+        self.assertEqual(self.balance(), 0)
+
+    def test_balances_follow_transaction_history(self):
+        for amount in (1000, 250):
+            self.deposit(amount)
+        self.withdraw(400)
+        self.deposit(75)
+        self.withdraw(1000)  # refused
+        self.withdraw(925)
+
+        totals = dict(Transaction.objects.values_list("transaction_type").annotate(Sum("amount")))
+        expected = totals["deposit"] - totals["withdrawal"]
+        self.assertEqual(expected, 0)
+        self.assertEqual(Transaction.objects.filter(transaction_type="withdrawal").count(), 2)
+        self.assertEqual(self.balance(), expected)
+        self.assertEqual(ledger_balance(chama_accounts([self.chama.id])[self.chama.id]), expected)
+
+    def test_chama_stats_counted_last(self):
+        with CaptureQueriesContext(connection) as captured:
+            record_deposit(self.chama, self.leader, Decimal(500), "ws_CO_STATS", "STATS1", "254755000000")
+        statements = [q["sql"] for q in captured.captured_queries if "SAVEPOINT" not in q["sql"]]
+        self.assertTrue(statements[-1].startswith('UPDATE "payments_chamastats"'), statements[-1])
+        # no read-back of the row being inserted
+        self.assertFalse([sql for sql in statements if sql.startswith('SELECT') and '"payments_transaction"' in sql])
+
+        self.withdraw(200)
+        stats = ChamaStats.objects.get(chama=self.chama)
+        self.assertEqual((stats.deposit_total, stats.withdrawal_total), (500, 200))
+
+        # a repair rebuild agrees with what the request paths counted
+        call_command("rebuild_chama_stats", stdout=io.StringIO())
+        stats.refresh_from_db()
+        self.assertEqual((stats.deposit_total, stats.withdrawal_total), (500, 200))
+
+
+    def test_transactions_outside_the_payment_paths_are_left_to_rebuild(self):
+        self.deposit(100)
+        # as the admin or a shell would: never counted, so never uncounted
+        stray = Transaction.objects.create(
+            chama=self.chama, amount=50, checkout_id="ws_CO_ADMIN", mpesa_code="ADMIN1",
+            phone_number="254755000000", status="Success",
+        )
+        self.assertEqual(ChamaStats.objects.get(chama=self.chama).deposit_total, 100)
+        stray.delete()
+        self.assertEqual(ChamaStats.objects.get(chama=self.chama).deposit_total, 100)
+
+        call_command("rebuild_chama_stats", stdout=io.StringIO())
+        self.assertEqual(ChamaStats.objects.get(chama=self.chama).deposit_total, 100)
+
+class PeriodCloseTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="chebet", email="chebet@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Period Chama", created_by=user)
+        self.wallet = chama_accounts([self.chama.id])[self.chama.id]
+        self.this_month = month_start(timezone.now())
+        self.last_month = previous_month(self.this_month)
+        self.month_before = previous_month(self.last_month)
+
+    def deposit(self, amount, when):
+        n = Transaction.objects.count()
+        txn = record_deposit(self.chama, None, Decimal(amount), f"ws_CO_PERIOD{n}", f"PERIOD{n}", "254766000000")
+        # entries can't be edited, so they are backdated around the model
+        JournalEntry.objects.filter(transaction=txn).update(created_at=when)
+        Posting.objects.filter(entry__transaction=txn).update(created_at=when)
+
+    def raw_balance(self, when):
+        total = Posting.objects.filter(account=self.wallet, entry__created_at__lt=when).aggregate(total=Sum("amount"))["total"]
+        return -(total or 0)
+
+    def test_balance_at_matches_raw_postings_across_a_close(self):
+        start, boundary = month_bounds(self.last_month)
+        self.deposit(100, month_bounds(self.month_before)[0] + timedelta(days=3))
+        self.deposit(40, boundary - timedelta(seconds=1))  # last second of the closed month
+        self.deposit(25, boundary)  # first instant of the open month
+        self.deposit(10, timezone.now())
+
+        list(close_periods(self.this_month))
+        closing = MonthlyBalance.objects.get(chama=self.chama, month=self.last_month).closing_balance
+        self.assertEqual(closing, 140)
+
+        second = timedelta(seconds=1)
+        for when in (start, boundary - second, boundary, boundary + second, timezone.now() + second):
+            with self.subTest(when=when):
+                self.assertEqual(balance_at(self.chama.id, when), self.raw_balance(when))
+
+    def test_dates_before_the_ledger_are_refused(self):
+        self.deposit(100, month_bounds(self.last_month)[0] + timedelta(days=1))
+        # recorded before the ledger existed and never journaled, e.g. 31 March
+        # with the ledger opened on 1 April
+        older = Transaction.objects.create(
+            chama=self.chama, amount=60, checkout_id="ws_CO_PRELEDGER", mpesa_code="PRELEDGER",
+            phone_number="254766000000", status="Success",
+        )
+        opened = JournalEntry.objects.get().created_at
+        Transaction.objects.filter(pk=older.pk).update(timestamp=opened - timedelta(days=1))
+
+        self.assertEqual(ledger_start(self.chama.id), opened)
+        with self.assertRaises(BeforeLedgerStart):
+            balance_at(self.chama.id, opened - timedelta(hours=1))
+        with self.assertRaises(BeforeLedgerStart):
+            monthly_report(self.chama.id, self.month_before, self.this_month)
+        self.assertEqual(balance_at(self.chama.id, opened + timedelta(seconds=1)), 100)
+
+    def test_a_new_chama_starts_at_creation(self):
+        self.assertEqual(ledger_start(self.chama.id), self.chama.created_at)
+        with self.assertRaises(BeforeLedgerStart):
+            balance_at(self.chama.id, self.chama.created_at - timedelta(days=1))
+
+        self.deposit(30, timezone.now())
+        report = monthly_report(self.chama.id, self.this_month, self.this_month)
+        self.assertEqual(
+            (report[0].opening_balance, report[0].deposits, report[0].closing_balance), (0, 30, 30),
+        )
+
+    def test_tail_is_an_index_range(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("plan check is written against SQLite")
+        self.deposit(100, month_bounds(self.last_month)[0])
+        list(close_periods(self.this_month))
+        with CaptureQueriesContext(connection) as captured:
+            balance_at(self.chama.id, timezone.now())
+        sql = next(q["sql"] for q in captured.captured_queries if '"payments_posting"' in q["sql"])
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            plan = " ".join(row[-1] for row in cursor.fetchall())
+        self.assertRegex(plan, r"SEARCH \w+ USING (COVERING )?INDEX payments_po_account_d53258_idx \(account_id=\? AND created_at>\? AND created_at<\?\)")
+
+
+class BalanceCheckTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="nyambura", email="nyambura@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Checked Chama", created_by=user)
+
+    def deposit(self, amount):
+        n = Transaction.objects.count()
+        record_deposit(self.chama, None, Decimal(amount), f"ws_CO_CHECK{n}", f"CHECK{n}", "254777000000")
+
+    def check(self, *args):
+        out = io.StringIO()
+        call_command("check_balances", "--lag=0", *args, stdout=out)
+        return out.getvalue()
+
+    def test_injected_mismatch_is_reported(self):
+        self.deposit(200)
+        self.assertIn("0 drifted", self.check())
+
+        VirtualAccount.objects.filter(chama=self.chama).update(balance=F("balance") + 5)
+        with self.assertRaisesMessage(CommandError, "1 chama balance(s) drifted."):
+            self.check()
+        self.assertEqual(BalanceCheck.objects.get(chama=self.chama).drift, 5)
+
+        # once accepted, the same difference is no longer reported
+        self.check("--accept", str(self.chama.id))
+        self.assertIn("0 drifted", self.check())
+
+    def test_high_water_mark_advances(self):
+        self.deposit(100)
+        self.deposit(50)
+        first, _ = check_balances(lag=0)
+        self.assertEqual(first.transactions_checked, 2)
+
+        again, _ = check_balances(lag=0)
+        self.assertEqual(again.transactions_checked, 0)
+        self.assertEqual(again.transaction_high_water, first.transaction_high_water)
+
+        self.deposit(25)
+        latest, drift = check_balances(lag=0)
+        self.assertEqual(latest.transactions_checked, 1)
+        self.assertGreater(latest.transaction_high_water, first.transaction_high_water)
+        self.assertEqual(drift, [])
+        self.assertEqual(BalanceCheck.objects.get(chama=self.chama).expected_balance, 175)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        job_calls.clear()
+
+    def test_claim_takes_due_jobs_by_priority(self):
+        low = enqueue(recording_job, n=1)
+        high = enqueue(recording_job, priority=5, n=2)
+        enqueue(recording_job, priority=9, delay=3600, n=3)  # not due yet
+
+        first = claim("worker-a", limit=1)
+        second = claim("worker-b", limit=5)
+
+        self.assertEqual([job.id for job in first], [high.id])
+        self.assertEqual([job.id for job in second], [low.id])
+        self.assertEqual(claim("worker-c", limit=5), [])
+        for job in first + second:
+            self.assertEqual((job.status, job.attempts), ("running", 1))
+        self.assertEqual(first[0].locked_by, "worker-a")
+
+    def test_failed_job_is_retried_then_given_up(self):
+        job = enqueue(failing_job, max_attempts=2)
+
+        self.assertFalse(run(claim("worker")[0]))
+        job.refresh_from_db()
+        self.assertEqual(job.status, "queued")
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIn("receipt printer on fire", job.last_error)
+
+        Job.objects.filter(id=job.id).update(run_at=timezone.now())
+        self.assertFalse(run(claim("worker")[0]))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+
+    def test_successful_job_is_done(self):
+        enqueue(recording_job, n=7)
+        self.assertTrue(run(claim("worker")[0]))
+        self.assertEqual(job_calls, [{"n": 7}])
+        self.assertEqual(Job.objects.get().status, "done")
+
+    @override_settings(JOBS_STALE_AFTER=600)
+    def test_only_jobs_without_a_heartbeat_are_reclaimed(self):
+        long_running = enqueue(recording_job, n=1)
+        abandoned = enqueue(recording_job, n=2)
+        out_of_attempts = enqueue(recording_job, max_attempts=1, n=3)
+        claim("alive", limit=1)
+        claim("dead", limit=2)
+
+        # all started long ago, but only the live worker is still beating
+        long_ago = timezone.now() - timedelta(hours=1)
+        Job.objects.update(started_at=long_ago, heartbeat_at=long_ago)
+        self.assertEqual(heartbeat("alive"), 1)
+
+        self.assertEqual(requeue_stale(), (1, 1))
+        statuses = dict(Job.objects.values_list("id", "status"))
+        self.assertEqual(statuses[long_running.id], "running")
+        self.assertEqual(statuses[abandoned.id], "queued")
+        self.assertEqual(statuses[out_of_attempts.id], "failed")
+
+    @override_settings(JOBS_MODE="immediate")
+    def test_immediate_failure_is_recorded_not_raised(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue(failing_job, transaction_id=42)
+            enqueue(recording_job, transaction_id=43)
+
+        failed = Job.objects.get()
+        self.assertEqual(
+            (failed.task, failed.status, failed.kwargs), ("payments.tests.failing_job", "failed", {"transaction_id": 42}),
+        )
+        self.assertIn("receipt printer on fire", failed.last_error)
+        self.assertEqual(job_calls, [{"transaction_id": 43}])
+
+
+class ReceiptDownloadTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="odhiambo", email="odhiambo@example.com", password="pw")
+        chama = Chama.objects.create(name="Receipt Chama", created_by=user)
+        self.txn = Transaction.objects.create(
+            chama=chama, amount=150, checkout_id="ws_CO_RECEIPT", mpesa_code="RECEIPT001",
+            phone_number="254788000000", status="Success",
+        )
+        self.url = reverse('download_receipt', args=[self.txn.id])
+
+    def test_matching_etag_is_not_modified(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["Content-Type"], "application/pdf")
+        self.assertTrue(first.content.startswith(b"%PDF"))
+
+        cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b"")
+        self.assertEqual(cached["ETag"], first["ETag"])
+
+        other = self.client.get(self.url, HTTP_IF_NONE_MATCH='"something-else"')
+        self.assertEqual(other.status_code, 200)
+
+    def test_edited_transaction_changes_the_etag(self):
+        before = self.client.get(self.url)["ETag"]
+        self.txn.amount = 175
+        self.txn.save()
+
+        after = self.client.get(self.url, HTTP_IF_NONE_MATCH=before)
+        self.assertEqual(after.status_code, 200)
+        self.assertNotEqual(after["ETag"], before)
+        self.assertTrue(after.content.startswith(b"%PDF"))
+
+
+    def test_template_matches_the_canvas(self):
+        cases = {
+            "plain": {},
+            "parentheses": {"initiated_by": "M-Changa (group)) ("},
+            "backslash": {"initiated_by": "C:\\chama\\"},
+            "empty": {"phone_number": ""},
+            "tab": {"initiated_by": "tab\there"},
+            "line breaks": {"initiated_by": "cr\rlf\nend"},
+            "nul and del": {"initiated_by": "\x00\x7f"},
+            "non-ascii": {"initiated_by": "Wanjirū"},
         }
+        for name, fields in cases.items():
+            with self.subTest(name):
+                for field, value in fields.items():
+                    setattr(self.txn, field, value)
+                self.assertEqual(render_receipt_pdf(self.txn), render_receipt_canvas(self.txn))
+                self.txn.refresh_from_db()
+
+
+class LedgerBackfillTests(TransactionTestCase):
+    """Runs the ledger migration over transactions recorded before the ledger existed."""
+
+    before = [("app", "0009_remove_virtualaccount_member_and_more"), ("payments", "0009_ledger")]
+    after = [("payments", "0010_ledger_opening_balances")]
+
+    def migrate(self, targets=None):
+        executor = MigrationExecutor(connection)
+        targets = targets or executor.loader.graph.leaf_nodes()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate()
+
+    def test_transactions_are_journaled_on_their_dates(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model("app", "CustomUser")
+        OldChama = apps.get_model("app", "Chama")
+        OldVirtualAccount = apps.get_model("app", "VirtualAccount")
+        OldTransaction = apps.get_model("payments", "Transaction")
+
+        user = User.objects.create(username="chebet", email="chebet@example.com")
+        chama = OldChama.objects.create(name="Old Chama", created_by=user, account_number="70000001")
+        # 500 of the balance predates the transactions we have
+        OldVirtualAccount.objects.create(chama=chama, account_number="70000001", balance=1000)
+        march = timezone.now().replace(year=2025, month=3, day=31, hour=12)
+        history = [("deposit", 700, march), ("withdrawal", 200, march + timedelta(days=10))]
+        for i, (kind, amount, when) in enumerate(history):
+            txn = OldTransaction.objects.create(
+                chama=chama, amount=amount, checkout_id=f"ws_CO_OLD{i}", mpesa_code=f"OLD{i}",
+                phone_number="254700000009", status="Success", transaction_type=kind,
+            )
+            OldTransaction.objects.filter(pk=txn.pk).update(timestamp=when)
+
+        apps = self.migrate(self.after)
+        entries = list(apps.get_model("payments", "JournalEntry").objects.order_by("created_at"))
+        self.assertEqual(
+            [(e.description, e.transaction_id is not None) for e in entries],
+            [("Opening balance", False), ("Deposit OLD0", True), ("Withdrawal OLD1", True)],
+        )
+        self.assertLess(entries[0].created_at, march)
+        self.assertEqual([e.created_at for e in entries[1:]], [when for _, _, when in history])
+
+        self.migrate()
+        wallet = chama_accounts([chama.id])[chama.id]
+        self.assertEqual(ledger_balance(wallet), 1000)
+        for entry in JournalEntry.objects.annotate(total=Sum("postings__amount")):
+            self.assertEqual(entry.total, 0)
+        self.assertEqual(balance_at(chama.id, march), 500)
+        self.assertEqual(balance_at(chama.id, march + timedelta(days=1)), 1200)
+        self.assertEqual(balance_at(chama.id, timezone.now()), 1000)
 
-        response = requests.post(
-            f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest",
-            json=request_body,
-            headers=headers,
-        ).json()
 
+class DarajaStub(BaseAdapter):
+    """A requests adapter answering Daraja calls in-process, recording their paths."""
+
+    def __init__(self):
+        super().__init__()
+        self.paths = []
+
+    def send(self, request, **kwargs):
+        self.paths.append(request.path_url)
+        body = {"access_token": "token", "expires_in": "3599"} if "oauth" in request.path_url else {"ResultCode": "0"}
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode()
+        response.request = request
         return response
 
-    except Exception as e:
-        print(f"Failed to initiate STK Push: {str(e)}")
-        return e
-
-# Payment View
-def payment_view(request, chama_id):
-    chama = Chama.objects.get(id=chama_id) # get chama
-    if request.method == "POST":
-        form = PaymentForm(request.POST)
-        if form.is_valid():
-            try:
-                phone = format_phone_number(form.cleaned_data["phone_number"])
-                amount = form.cleaned_data["amount"]
-
-                # use chama’s account number
-                response = initiate_stk_push(phone, amount, chama)
-                print(response)
-
-                if response.get("ResponseCode") == "0":
-                    checkout_request_id = response["CheckoutRequestID"]
-                    return render(
-                        request,
-                        "payments/pending.html",
-                        {"checkout_request_id": checkout_request_id, "chama": chama},
-                    )
-                else:
-                    error_message = response.get("errorMessage", "Failed to send STK push. Please try again.")
-                    return render(request, "payments/payment_form.html", {"form": form, "error_message": error_message, "chama": chama})
-
-            except ValueError as e:
-                return render(request, "payments/payment_form.html", {"form": form, "error_message": str(e), "chama": chama})
-            except Exception as e:
-                return render(request, "payments/payment_form.html", {"form": form, "error_message": f"An unexpected error occurred: {str(e)}", "chama": chama})
-
-    else:
-        form = PaymentForm()
-
-    return render(request, "payments/payment_form.html", {"form": form, "chama": chama})
-
-
-# Query STK Push status
-def query_stk_push(checkout_request_id):
-    print("Quering...")
-    try:
-        token = generate_access_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password = base64.b64encode(
-            (MPESA_SHORTCODE + MPESA_PASSKEY + timestamp).encode()
-        ).decode()
-
-        request_body = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id
-        }
+    def close(self):
+        pass
+
 
-        response = requests.post(
-            f"{MPESA_BASE_URL}/mpesa/stkpushquery/v1/query",
-            json=request_body,
-            headers=headers,
+class AsyncDarajaClientTests(TestCase):
+    def setUp(self):
+        self.stub = DarajaStub()
+        previous = get_client()
+        client = DarajaClient(
+            transport=self.stub, base_url="https://daraja.test", consumer_key="key", consumer_secret="secret",
+            shortcode="174379", passkey="passkey", callback_url="https://chama.test/callback",
         )
-        print(response.json())
-        return response.json()
+        # calls run in worker threads that commit on their own connections,
+        # so the token must not land in the shared cache
+        client.tokens = AccessTokenProvider(client.fetch_access_token, token_cache=LocMemCache("daraja-tests", {}))
+        set_client(client)
+        self.addCleanup(set_client, previous)
+
+    def test_outside_asgi_calls_share_the_sync_pool(self):
+        async def query():
+            client = get_async_client()
+            return client, await client.stk_query("ws_CO_POOL")
+
+        # each call runs on an event loop of its own, as async views do under WSGI
+        with mock.patch("httpx.AsyncClient", side_effect=AssertionError("httpx pool opened per request")):
+            (first, answer), (second, _) = async_to_sync(query)(), async_to_sync(query)()
+
+        self.assertIsInstance(first, ThreadedDarajaClient)
+        self.assertIs(first.client, second.client)
+        self.assertEqual(answer, {"ResultCode": "0"})
+        # one token for both queries, from the shared client
+        self.assertEqual(len(self.stub.paths), 3)
 
-    except requests.RequestException as e:
-        print(f"Error querying STK status: {str(e)}")
-        return {"error": str(e)}
+    def test_asgi_keeps_one_client_per_loop(self):
+        async def clients():
+            return get_async_client(), get_async_client()
 
-# View to query the STK status and return it to the frontend
-def stk_status_view(request):
-    if request.method == 'POST':
+        loop = asyncio.new_event_loop()
         try:
-            # Parse the JSON body
-            data = json.loads(request.body)
-            checkout_request_id = data.get('checkout_request_id')
-            print("CheckoutRequestID:", checkout_request_id)
-
-            # Query the STK push status using your backend function
-            status = query_stk_push(checkout_request_id)
-
-            # Return the status as a JSON response
-            return JsonResponse({"status": status})
-        except json.JSONDecodeError:
-            return JsonResponse({"error": "Invalid JSON body"}, status=400)
-
-    return JsonResponse({"error": "Invalid request method"}, status=405)
-
-@csrf_exempt  # To allow POST requests from external sources like M-Pesa
-def payment_callback(request):
-    if request.method != "POST":
-        return HttpResponseBadRequest("Only POST requests are allowed")
-
-    try:
-        callback_data = json.loads(request.body)
-        result_code = callback_data["Body"]["stkCallback"]["ResultCode"]
-
-        if result_code == 0:
-            checkout_id = callback_data["Body"]["stkCallback"]["CheckoutRequestID"]
-            metadata = callback_data["Body"]["stkCallback"]["CallbackMetadata"]["Item"]
-
-            amount = next(item["Value"] for item in metadata if item["Name"] == "Amount")
-            mpesa_code = next(item["Value"] for item in metadata if item["Name"] == "MpesaReceiptNumber")
-            phone = next(item["Value"] for item in metadata if item["Name"] == "PhoneNumber")
-            account_ref = next(item["Value"] for item in metadata if item["Name"] == "AccountReference")
-
-            # get chama by account number
-            try:
-                chama = Chama.objects.get(account_number=account_ref)
-            except Chama.DoesNotExist:
-                return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid account reference"})
-
-            # save transaction
+            with mock.patch("payments.utils.daraja._long_lived_loops", True):
+                first, second = loop.run_until_complete(clients())
+            self.assertIsInstance(first, AsyncDarajaClient)
+            self.assertIs(first, second)
+            loop.run_until_complete(first.aclose())
+        finally:
+            loop.close()
+
+    def test_zero_timeouts_are_kept(self):
+        client = DarajaClient(connect_timeout=0, read_timeout=0)
+        self.assertEqual(client.timeout, (0, 0))
+        client.close()
+
+
+def pdf_texts(pdf):
+    """
+    Checks the cross-reference table of a PDF written by PDFStreamWriter and
+    returns (page count, the strings shown on its pages, in order).
+    """
+    startxref = int(re.search(rb"startxref\n(\d+)\n%%EOF\n$", pdf).group(1))
+    assert pdf[startxref:].startswith(b"xref\n"), "startxref doesn't point at the xref table"
+    for obj_id, offset in enumerate(re.findall(rb"^(\d{10}) 00000 n $", pdf[startxref:], re.M), start=1):
+        assert pdf[int(offset):].startswith(b"%d 0 obj" % obj_id), f"xref offset of object {obj_id} is wrong"
+
+    texts = []
+    for stream in re.findall(rb"stream\n(.*?)\nendstream", pdf, re.S):
+        for literal in re.findall(rb"\(((?:\\.|[^\\)])*)\) Tj", zlib.decompress(stream), re.S):
+            # a reader turns raw CR/LF inside a string into a newline
+            assert not re.search(rb"[\x00-\x1f]", literal), f"unescaped control byte in {literal!r}"
+            literal = re.sub(rb"\\([0-7]{3})", lambda m: bytes([int(m.group(1), 8)]), literal)
+            texts.append(re.sub(rb"\\(.)", rb"\1", literal, flags=re.S).decode("cp1252"))
+    return pdf.count(b"/Type /Page "), texts
+
+
+class StatementTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="muthoni", email="muthoni@example.com", password="pw")
+        self.chama = Chama.objects.create(name="Statement Chama", created_by=self.user)
+        self.member = Member.objects.create(user=self.user, chama=self.chama, role='leader')
+        self.month = month_start(timezone.now())
+        self.client.force_login(self.user)
+
+    def url(self, year, month):
+        return reverse('chama_statement', args=[self.chama.id, year, month])
+
+    def amount_after(self, texts, label):
+        return texts[next(i for i, text in enumerate(texts) if text.startswith(label)) + 1]
+
+    def test_streamed_pdf_totals(self):
+        with transaction.atomic():
+            txns = Transaction.objects.bulk_create([
+                Transaction(
+                    chama=self.chama, amount=10 + i, checkout_id=f"ws_CO_STMT{i}", mpesa_code=f"STMT{i}",
+                    phone_number="254700000010", status="Success", initiated_by=f"payer\t({i})\r\n\\",
+                )
+                for i in range(120)
+            ])
+            post_transactions(txns)
+        record_deposit(self.chama, self.member, Decimal(500), "ws_CO_STMT_LAST", "STMTLAST", "254700000010")
+        self.client.post(reverse('withdraw', args=[self.chama.id]), {"amount": 300, "phone_number": "254700000010"})
+
+        pages, texts = pdf_texts(b"".join(statement_chunks(self.chama, self.month)))
+        money_in = sum(10 + i for i in range(120)) + 500
+        self.assertGreater(pages, 2)
+        self.assertEqual(self.amount_after(texts, "Opening balance"), "0.00")
+        self.assertEqual(self.amount_after(texts, "Total money in"), f"{money_in:,.2f}")
+        self.assertEqual(self.amount_after(texts, "Total money out"), "300.00")
+        self.assertEqual(self.amount_after(texts, "Closing balance"), f"{money_in - 300:,.2f}")
+        self.assertNotIn("Adjustments", texts)
+        # control characters come back as written, not as line breaks
+        self.assertIn("payer\t(0)\r\n\\", texts)
+
+    def test_view_streams_the_statement(self):
+        record_deposit(self.chama, self.member, Decimal(75), "ws_CO_STMT_VIEW", "STMTVIEW", "254700000010")
+        response = self.client.get(self.url(self.month.year, self.month.month))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        async def read():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        _, texts = pdf_texts(async_to_sync(read)())
+        self.assertEqual(self.amount_after(texts, "Closing balance"), "75.00")
+
+    def test_out_of_range_months_are_not_found(self):
+        before_ledger = previous_month(self.month)
+        for year, month in ((0, 1), (9999, 12), (2025, 13), (before_ledger.year, before_ledger.month)):
+            with self.subTest(year=year, month=month):
+                self.assertEqual(self.client.get(self.url(year, month)).status_code, 404)
+
+    def test_non_members_are_sent_away(self):
+        outsider = CustomUser.objects.create_user(username="kerubo", email="kerubo@example.com", password="pw")
+        self.client.force_login(outsider)
+        self.assertRedirects(
+            self.client.get(self.url(self.month.year, self.month.month)), reverse('dashboard'),
+            fetch_redirect_response=False,
+        )
+
+
+
+def thread_pool(max_workers, mp_context=None, initializer=None):
+    """Stands in for the command's process pool: same interface, no spawned interpreters."""
+    return ThreadPoolExecutor(max_workers)
+
+
+class BackfillReceiptsTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        set_receipt_storage(ShardedReceiptStorage(location=self.media.name))
+        self.addCleanup(set_receipt_storage, None)
+        cache.delete(CHECKPOINT_KEY)
+
+        user = CustomUser.objects.create_user(username="barasa", email="barasa@example.com", password="pw")
+        chama = Chama.objects.create(name="Backfill Chama", created_by=user)
+        self.txns = [
             Transaction.objects.create(
-                chama=chama,
-                amount=amount,
-                checkout_id=checkout_id,
-                mpesa_code=mpesa_code,
-                phone_number=phone,
-                status="Success",
+                chama=chama, amount=10 * (i + 1), checkout_id=f"ws_CO_BACKFILL{i}", mpesa_code=f"BACKFILL{i}",
+                phone_number="254700000030", status="Success",
             )
-            return JsonResponse({"ResultCode": 0, "ResultDesc": "Payment successful"})
+            for i in range(5)
+        ]
+
+    def backfill(self, *args):
+        out = io.StringIO()
+        with mock.patch("payments.management.commands.backfill_receipts.ProcessPoolExecutor", thread_pool):
+            call_command("backfill_receipts", "--workers=2", "--chunk-size=2", "--batch-size=1", *args, stdout=out)
+        return out.getvalue()
+
+    def test_interrupted_run_resumes_after_its_checkpoint(self):
+        calls = []
+
+        def record_then_die(receipts):
+            calls.append(receipts)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            record_stored(receipts)
+
+        with mock.patch("payments.management.commands.backfill_receipts.record_stored", record_then_die):
+            with self.assertRaises(KeyboardInterrupt):
+                self.backfill()
+        # the first chunk was recorded before the second one failed
+        self.assertEqual(cache.get(CHECKPOINT_KEY), self.txns[1].id)
+        self.assertEqual(StoredReceipt.objects.count(), 2)
+
+        out = self.backfill()
+        self.assertIn(f"Resuming after transaction #{self.txns[1].id}", out)
+        self.assertIn("Done: 3 transactions checked, 3 receipts rendered", out)
+        self.assertEqual(StoredReceipt.objects.count(), 5)
+        self.assertIsNone(cache.get(CHECKPOINT_KEY))
+
+    def test_unchanged_receipts_are_skipped(self):
+        self.assertIn("Done: 5 transactions checked, 5 receipts rendered", self.backfill())
+        self.assertIn("Done: 5 transactions checked, 0 receipts rendered", self.backfill())
+
+        Transaction.objects.filter(pk=self.txns[3].pk).update(status="Reversed")
+        self.assertIn("Done: 5 transactions checked, 1 receipts rendered", self.backfill())
+        self.assertIn("Done: 5 transactions checked, 5 receipts rendered", self.backfill("--force"))
+
+        stored = StoredReceipt.objects.get(transaction=self.txns[3])
+        with get_receipt_storage().open(stored.name) as f:
+            self.assertEqual(f.read(), render_receipt_pdf(Transaction.objects.get(pk=self.txns[3].pk)))
+
+    def test_workers_render_in_spawned_processes(self):
+        # spawned workers read their settings from the environment, not from override_settings
+        objects = tempfile.TemporaryDirectory()
+        self.addCleanup(objects.cleanup)
+        storage = "payments.utils.receipt_storage.LocalObjectStorage"
+        env = {"RECEIPT_STORAGE": storage, "RECEIPT_OBJECT_STORE_ROOT": objects.name}
+        with mock.patch.dict(os.environ, env), override_settings(RECEIPT_STORAGE=storage):
+            out = io.StringIO()
+            call_command("backfill_receipts", "--workers=2", "--batch-size=2", stdout=out)
+
+        self.assertIn("5 receipts rendered", out.getvalue())
+        self.assertEqual(
+            sorted(StoredReceipt.objects.values_list("name", flat=True)),
+            sorted(receipt_name(txn.mpesa_code) for txn in self.txns),
+        )
+        self.assertEqual(len(os.listdir(objects.name)), 5)
+
+
+
+class FailingContent(ContentFile):
+    """A file whose upload breaks off after the first chunk."""
+
+    def chunks(self, chunk_size=None):
+        yield b"%PDF-half"
+        raise OSError("connection reset")
+
+
+class ReceiptStorageTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def files(self):
+        return sorted(
+            os.path.relpath(os.path.join(path, f), self.root.name)
+            for path, _, names in os.walk(self.root.name) for f in names
+        )
+
+    def test_names_are_sharded_by_hash(self):
+        name = receipt_name("SIM1234")
+        self.assertRegex(name, r"^[0-9a-f]{2}/[0-9a-f]{2}/receipt_SIM1234\.pdf$")
+        self.assertEqual(name, receipt_name("SIM1234"))
+        # codes spread across shards rather than piling into one directory
+        self.assertGreater(len({receipt_name(f"SIM{i}")[:5] for i in range(50)}), 40)
+
+    def test_sharded_storage_overwrites_in_place(self):
+        storage = ShardedReceiptStorage(location=self.root.name, base_url="/media/receipts/")
+        name = receipt_name("SHARD1")
+        self.assertEqual(storage.save(name, ContentFile(b"%PDF-old")), name)
+        self.assertEqual(storage.save(name, ContentFile(b"%PDF-new")), name)
+
+        self.assertEqual(self.files(), [name])
+        with storage.open(name) as f:
+            self.assertEqual(f.read(), b"%PDF-new")
+        self.assertEqual(storage.url(name), f"/media/receipts/{name}")
+
+    def test_object_storage_keys_are_flat(self):
+        storage = LocalObjectStorage(location=self.root.name, base_url="https://bucket.test/")
+        name = receipt_name("OBJECT1")
+        storage.save(name, ContentFile(b"%PDF-object"))
+
+        self.assertEqual(self.files(), [name.replace("/", "%2F")])
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(storage.size(name), len(b"%PDF-object"))
+        self.assertEqual(storage.listdir(name[:5]), ([], [name[6:]]))
+        # the key keeps its slashes in the URL, as a bucket's would
+        self.assertEqual(storage.url(name), f"https://bucket.test/{name}")
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_broken_writes_keep_the_old_file(self):
+        for storage in (ShardedReceiptStorage(location=self.root.name), LocalObjectStorage(location=self.root.name)):
+            with self.subTest(type(storage).__name__):
+                name = receipt_name("ATOMIC1")
+                storage.save(name, ContentFile(b"%PDF-complete"))
+                with self.assertRaises(OSError):
+                    storage.save(name, FailingContent(b""))
+                with storage.open(name) as f:
+                    self.assertEqual(f.read(), b"%PDF-complete")
+                self.assertFalse([f for f in self.files() if f.endswith(".tmp")])
+
+
+@override_settings(RECEIPT_ACCEL_PREFIX="/protected/receipts/")
+class ReceiptServeModeTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.storage = ShardedReceiptStorage(location=self.root.name, base_url="/media/receipts/")
+        set_receipt_storage(self.storage)
+        self.addCleanup(set_receipt_storage, None)
+
+        user = CustomUser.objects.create_user(username="wafula", email="wafula@example.com", password="pw")
+        chama = Chama.objects.create(name="Served Chama", created_by=user)
+        self.txn = Transaction.objects.create(
+            chama=chama, amount=80, checkout_id="ws_CO_SERVE", mpesa_code="SERVE001",
+            phone_number="254700000040", status="Success",
+        )
+        self.url = reverse('download_receipt', args=[self.txn.id])
+        self.name = receipt_name("SERVE001")
+
+    def get(self, mode):
+        with override_settings(RECEIPT_SERVE_MODE=mode):
+            return self.client.get(self.url)
+
+    def assertStored(self):
+        with self.storage.open(self.name) as f:
+            self.assertEqual(f.read(), render_receipt_pdf(self.txn))
+        self.assertEqual(StoredReceipt.objects.get(transaction=self.txn).name, self.name)
+
+    def test_django_streams_the_pdf_itself(self):
+        response = self.get("django")
+        self.assertEqual(response.content, render_receipt_pdf(self.txn))
+        self.assertNotIn("X-Accel-Redirect", response)
+
+    def test_x_accel_redirect_hands_the_file_to_nginx(self):
+        response = self.get("x-accel-redirect")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/receipts/{self.name}")
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(response.content, b"")
+        self.assertStored()
+
+    def test_x_sendfile_names_the_path_on_disk(self):
+        response = self.get("x-sendfile")
+        self.assertEqual(response["X-Sendfile"], os.path.join(self.root.name, self.name))
+        self.assertEqual(response.content, b"")
+        self.assertStored()
+
+    def test_redirect_points_at_the_storage_url(self):
+        response = self.get("redirect")
+        self.assertRedirects(response, f"/media/receipts/{self.name}", fetch_redirect_response=False)
+        self.assertTrue(response["ETag"])
+        self.assertStored()
 
-        return JsonResponse({"ResultCode": result_code, "ResultDesc": "Payment failed"})
+    def test_stored_copy_is_reused(self):
+        self.get("x-accel-redirect")
+        with mock.patch("payments.utils.receipts.render_receipt_pdf") as render:
+            self.assertEqual(self.get("redirect").status_code, 302)
+        render.assert_not_called()
 
-    except (json.JSONDecodeError, KeyError) as e:
-        return HttpResponseBadRequest(f"Invalid request data: {str(e)}")
+    def test_unknown_mode_is_an_error(self):
+        with self.assertRaisesMessage(ValueError, "Unknown RECEIPT_SERVE_MODE: carrier-pigeon"):
+            self.get("carrier-pigeon")
@@ -5,5 +5,19 @@ urlpatterns = [
     path('<int:chama_id>/', views.payment_view, name='payment'),
     path('callback/', views.payment_callback, name='payment_callback'),
     path('stk-status/', views.stk_status_view, name='stk_status'),
+    path('stk-status/<str:checkout_request_id>/wait/', views.stk_status_wait, name='stk_status_wait'),
     path('receipt/<int:transaction_id>/download/', views.download_receipt, name='download_receipt'),
+    path('statement/<int:chama_id>/<int:year>/<int:month>/', views.chama_statement, name='chama_statement'),
 ]
+
+# Most queries a request to each URL may make; see app/urls.py
+QUERY_BUDGETS = {
+    'payment': 6,
+    'payment_callback': 17,
+    'stk_status': 4,
+    # long-polls, re-checking until the result arrives or it times out
+    'stk_status_wait': None,
+    'download_receipt': 3,
+    # queries made while the PDF streams aren't counted
+    'chama_statement': 7,
+}
@@ -0,0 +1,22 @@
+from django.db.models import F
+
+from app.models import VirtualAccount
+
+# Balance changes are single UPDATE statements evaluated by the database, so
+# concurrent deposits and withdrawals on one chama never overwrite each
+# other and the row is only locked for the statement, not a read-modify-write.
+
+
+def credit(chama_id, amount):
+    """Add `amount` to the chama's account. Returns False if it has no account."""
+    return VirtualAccount.objects.filter(chama_id=chama_id).update(balance=F("balance") + amount) == 1
+
+
+def debit(chama_id, amount):
+    """
+    Take `amount` from the chama's account if the balance covers it.
+    Returns False (and changes nothing) when it doesn't.
+    """
+    return VirtualAccount.objects.filter(chama_id=chama_id, balance__gte=amount).update(
+        balance=F("balance") - amount
+    ) == 1
@@ -0,0 +1,209 @@
+import json
+import uuid
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from app.models import Chama, Member
+from payments.models import AuditLog, CallbackSpool, PendingPayment, Transaction
+from payments.utils import counters
+from payments.utils.chama_stats import record_transactions
+from payments.utils.jobs import enqueue_many
+from payments.utils.ledger import post_transactions
+from payments.utils.receipts import render_receipt
+from payments.utils.stk_status import remember_result
+
+CALLBACK_STATS_KEYS = {
+    "duplicates": "mpesa:callback:duplicates",
+    "duplicate_races": "mpesa:callback:duplicate_races",
+}
+
+
+def parse_stk_callback(callback_data):
+    """
+    Pulls the fields we use out of a Daraja STK callback. Raises KeyError or
+    ValueError when the payload is malformed.
+    """
+    stk_data = callback_data["Body"]["stkCallback"]
+    parsed = {
+        "checkout_id": stk_data["CheckoutRequestID"],
+        "result_code": stk_data["ResultCode"],
+        "result_desc": stk_data.get("ResultDesc", "Payment failed or cancelled"),
+    }
+
+    if parsed["result_code"] == 0:
+        metadata = {item["Name"]: item.get("Value") for item in stk_data["CallbackMetadata"]["Item"]}
+        parsed.update({
+            "amount": Decimal(metadata["Amount"]),
+            "mpesa_code": metadata["MpesaReceiptNumber"],
+            "phone": str(metadata["PhoneNumber"]),
+            "account_ref": str(metadata["AccountReference"]),
+        })
+    return parsed
+
+
+async def ais_duplicate_callback(checkout_id, mpesa_code):
+    """
+    True when this successful callback was already recorded. Both columns
+    are unique, so this is a single indexed read; a replayed callback never
+    opens a write transaction (the duplicate is counted in memory).
+    """
+    duplicate = await Transaction.objects.filter(Q(checkout_id=checkout_id) | Q(mpesa_code=mpesa_code)).aexists()
+    if duplicate:
+        await counters.aincr(CALLBACK_STATS_KEYS["duplicates"])
+    return duplicate
+
+
+def drain_spool(batch_size):
+    """
+    Applies up to `batch_size` queued callbacks in one transaction: one
+    bulk insert for the transactions (and their audit logs) and one balance
+    update per chama. If the batch fails as a whole, it is applied again row
+    by row so only the offending rows are marked failed. Returns (rows,
+    applied, duplicates, failed) counts.
+    """
+    with transaction.atomic():
+        # SKIP LOCKED lets several drain workers run side by side
+        rows = list(
+            CallbackSpool.objects.select_for_update(skip_locked=True)
+            .filter(status="queued").order_by("id")[:batch_size]
+        )
+        if not rows:
+            return 0, 0, 0, 0
+
+        try:
+            with transaction.atomic():
+                applied, skipped, errors = _apply_rows(rows)
+        except Exception:
+            # e.g. a receipt another drainer just inserted, or a value the
+            # column can't hold: without isolating it the same batch would
+            # be claimed and rolled back on every pass
+            applied, skipped, errors = 0, 0, {}
+            for row in rows:
+                try:
+                    with transaction.atomic():
+                        row_applied, row_skipped, row_errors = _apply_rows([row])
+                except Exception as e:
+                    row_applied, row_skipped, row_errors = 0, 0, {row.pk: f"{type(e).__name__}: {e}"}
+                applied += row_applied
+                skipped += row_skipped
+                errors.update(row_errors)
+
+        now = timezone.now()
+        failed_ids = list(errors)
+        CallbackSpool.objects.filter(pk__in=[r.pk for r in rows]).exclude(pk__in=failed_ids).update(
+            status="done", processed_at=now,
+        )
+        for pk, error in errors.items():
+            CallbackSpool.objects.filter(pk=pk).update(
+                status="failed", error=error, attempts=F("attempts") + 1, processed_at=now,
+            )
+
+    # counted once the batch is in, not for a bulk attempt that was rolled back
+    if skipped:
+        counters.incr(CALLBACK_STATS_KEYS["duplicates"], skipped)
+    return len(rows), applied, skipped, len(errors)
+
+
+def _apply_rows(rows):
+    """Applies spooled callbacks; returns (applied, duplicates, {row pk: error}) for rows it rejected."""
+    deposits, failures, errors = [], [], {}
+    for row in rows:
+        try:
+            parsed = parse_stk_callback(json.loads(row.body))
+        except (json.JSONDecodeError, KeyError, ValueError, TypeError) as e:
+            errors[row.pk] = f"Invalid callback: {str(e)}"
+            continue
+        if parsed["result_code"] == 0:
+            deposits.append((row, parsed))
+        else:
+            failures.append(parsed)
+
+    applied, skipped = _apply_deposits(deposits, errors)
+    _apply_failures(failures)
+    return applied, skipped, errors
+
+
+def _apply_deposits(deposits, errors):
+    if not deposits:
+        return 0, 0
+
+    chamas = Chama.objects.in_bulk([p["account_ref"] for _, p in deposits], field_name="account_number")
+
+    # redelivered callbacks: already recorded, or repeated within this batch
+    seen_checkout = set(Transaction.objects.filter(
+        checkout_id__in=[p["checkout_id"] for _, p in deposits]
+    ).values_list("checkout_id", flat=True))
+    seen_codes = set(Transaction.objects.filter(
+        mpesa_code__in=[p["mpesa_code"] for _, p in deposits]
+    ).values_list("mpesa_code", flat=True))
+
+    members = {}
+    for member in Member.objects.select_related("user").filter(
+        chama__in=chamas.values(), user__phone_number__in={p["phone"] for _, p in deposits}
+    ):
+        members.setdefault((member.chama_id, member.user.phone_number), member)
+
+    txns = []
+    skipped = 0
+    for row, p in deposits:
+        chama = chamas.get(p["account_ref"])
+        if chama is None:
+            errors[row.pk] = "Invalid account reference"
+            continue
+        if p["checkout_id"] in seen_checkout or p["mpesa_code"] in seen_codes:
+            skipped += 1
+            continue
+        seen_checkout.add(p["checkout_id"])
+        seen_codes.add(p["mpesa_code"])
+
+        member = members.get((chama.id, p["phone"]))
+        txns.append(Transaction(
+            chama=chama,
+            member=member,
+            initiated_by=member.user.username if member else "phone",
+            amount=p["amount"],
+            checkout_id=p["checkout_id"],
+            mpesa_code=p["mpesa_code"],
+            phone_number=p["phone"],
+            status="Success",
+            transaction_type="deposit",
+        ))
+
+    if not txns:
+        return 0, skipped
+
+    # bulk_create skips post_save, so the audit logs are written here too
+    Transaction.objects.bulk_create(txns)
+    AuditLog.objects.bulk_create([
+        AuditLog(
+            transaction=txn,
+            chama=txn.chama,
+            action_type=txn.transaction_type,
+            amount=txn.amount,
+            reference_no=f"TXN-{uuid.uuid4().hex[:8].upper()}",
+        )
+        for txn in txns
+    ])
+    enqueue_many(render_receipt, [{"transaction_id": txn.id} for txn in txns])
+
+    # the whole batch posts as one journal write, one balance update per chama
+    post_transactions(txns)
+    # and the running totals, one UPDATE per chama
+    record_transactions(txns)
+
+    PendingPayment.objects.filter(checkout_request_id__in=[t.checkout_id for t in txns]).update(
+        status="success", result_code="0", result_desc="Payment successful", updated_at=timezone.now(),
+    )
+    return len(txns), skipped
+
+
+def _apply_failures(failures):
+    for p in failures:
+        PendingPayment.objects.filter(checkout_request_id=p["checkout_id"], status="pending").update(
+            status="failed", result_code=str(p["result_code"]), result_desc=p["result_desc"][:255],
+            updated_at=timezone.now(),
+        )
+        remember_result(p["checkout_id"], p["result_code"], p["result_desc"])
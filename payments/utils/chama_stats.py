@@ -0,0 +1,106 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from app.models import Chama, Contribution, Member
+from payments.models import ChamaStats, Transaction
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+TOTAL_FIELDS = {"deposit": "deposit_total", "withdrawal": "withdrawal_total"}
+
+
+def adjust(chama_id, activity=None, **deltas):
+    """
+    Adds `deltas` (e.g. deposit_total=50, member_count=-1) to a chama's
+    stats in one UPDATE on the caller's connection, so it commits or rolls
+    back with the change it counts. `activity` moves last_activity forward.
+    """
+    changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+    if activity is not None:
+        changes["last_activity"] = Greatest(Coalesce("last_activity", Value(activity)), Value(activity))
+    if changes:
+        ChamaStats.objects.filter(chama_id=chama_id).update(**changes)
+
+
+def counted(instance):
+    """(chama_id, {field: amount}, activity time) a Transaction, Contribution or Member adds to its chama's stats."""
+    if isinstance(instance, Transaction):
+        return instance.chama_id, {TOTAL_FIELDS[instance.transaction_type]: instance.amount}, instance.timestamp
+    if isinstance(instance, Contribution):
+        return instance.member.chama_id, {"contribution_total": instance.amount}, instance.date
+    return instance.chama_id, {"member_count": 1}, instance.joined_at
+
+
+def count(chama_id, deltas, activity):
+    adjust(chama_id, activity=activity, **deltas)
+
+
+def uncount(chama_id, deltas, activity=None):
+    adjust(chama_id, **{field: -delta for field, delta in deltas.items()})
+
+
+def record_transactions(txns):
+    """Counts newly recorded transactions: one UPDATE per chama rather than per transaction."""
+    by_chama = defaultdict(lambda: {"deposit_total": Decimal("0"), "withdrawal_total": Decimal("0"), "activity": None})
+    for txn in txns:
+        stats = by_chama[txn.chama_id]
+        stats[TOTAL_FIELDS[txn.transaction_type]] += txn.amount
+        stats["activity"] = max(filter(None, [stats["activity"], txn.timestamp]))
+    for chama_id, stats in by_chama.items():
+        adjust(chama_id, **stats)
+
+
+def _total(queryset, field):
+    return Coalesce(
+        Subquery(queryset.order_by().values("chama_id").annotate(total=Sum(field)).values("total")),
+        Value(Decimal("0")),
+        output_field=MONEY,
+    )
+
+
+def _latest(queryset, field):
+    return Subquery(queryset.order_by().values("chama_id").annotate(latest=Max(field)).values("latest"))
+
+
+def rebuild(chama_ids=None):
+    """
+    Recomputes stats from the underlying rows (all chamas, or just
+    `chama_ids`) and writes them in one upsert. For repair after writes
+    that went around the model signals. Returns the number of chamas.
+    """
+    transactions = Transaction.objects.filter(chama_id=OuterRef("pk"))
+    contributions = Contribution.objects.filter(member__chama_id=OuterRef("pk")).annotate(chama_id=F("member__chama_id"))
+    members = Member.objects.filter(chama_id=OuterRef("pk"))
+
+    chamas = Chama.objects.annotate(
+        contribution_total=_total(contributions, "amount"),
+        deposit_total=_total(transactions.filter(transaction_type="deposit"), "amount"),
+        withdrawal_total=_total(transactions.filter(transaction_type="withdrawal"), "amount"),
+        member_count=Coalesce(Subquery(members.order_by().values("chama_id").annotate(n=Count("id")).values("n")), 0),
+        last_transaction=_latest(transactions, "timestamp"),
+        last_contribution=_latest(contributions, "date"),
+        last_member=_latest(members, "joined_at"),
+    )
+    if chama_ids is not None:
+        chamas = chamas.filter(pk__in=chama_ids)
+
+    rows = [
+        ChamaStats(
+            chama_id=c.pk,
+            contribution_total=c.contribution_total,
+            deposit_total=c.deposit_total,
+            withdrawal_total=c.withdrawal_total,
+            member_count=c.member_count,
+            last_activity=max(filter(None, [c.last_transaction, c.last_contribution, c.last_member]), default=None),
+        )
+        for c in chamas
+    ]
+    ChamaStats.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["chama"],
+        update_fields=["contribution_total", "deposit_total", "withdrawal_total", "member_count", "last_activity"],
+    )
+    return len(rows)
@@ -0,0 +1,141 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from app.models import VirtualAccount
+from payments.models import BalanceCheck, BalanceCheckRun, Transaction
+
+LOCK_KEY = "balances:check:lock"
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+ZERO = Value(Decimal("0"), output_field=MONEY)
+
+# deposits add to a chama's balance, withdrawals take from it
+SIGNED_AMOUNT = Case(
+    When(transaction_type="withdrawal", then=-F("amount")),
+    default=F("amount"),
+    output_field=MONEY,
+)
+
+
+def _transaction_net(transactions):
+    return transactions.order_by().values("chama_id").annotate(net=Sum(SIGNED_AMOUNT), count=Count("id"))
+
+
+def _fold(rows, chunk_size):
+    """Adds streamed {chama_id, net} rows onto BalanceCheck.expected_balance, a chunk at a time."""
+    folded = 0
+    chunk = {}
+
+    def flush():
+        checks = BalanceCheck.objects.in_bulk(list(chunk), field_name="chama_id")
+        for chama_id, net in chunk.items():
+            if chama_id in checks:
+                checks[chama_id].expected_balance += net
+        BalanceCheck.objects.bulk_update(checks.values(), ["expected_balance"])
+        BalanceCheck.objects.bulk_create([
+            BalanceCheck(chama_id=chama_id, expected_balance=net)
+            for chama_id, net in chunk.items() if chama_id not in checks
+        ])
+        chunk.clear()
+
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk[row["chama_id"]] = chunk.get(row["chama_id"], Decimal("0")) + row["net"]
+        folded += row["count"]
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return folded
+
+
+def _drifted(transaction_hwm):
+    """
+    Every chama whose balance differs from its expected balance plus the
+    transactions newer than the high-water mark, in one statement (so one
+    snapshot of the tables).
+    """
+    check = BalanceCheck.objects.filter(chama_id=OuterRef("chama_id"))
+    tail = Transaction.objects.filter(chama_id=OuterRef("chama_id"), id__gt=transaction_hwm)
+    expected = (
+        Coalesce(Subquery(check.values("expected_balance")[:1], output_field=MONEY), ZERO)
+        + Coalesce(Subquery(check.values("accepted_drift")[:1], output_field=MONEY), ZERO)
+        + Coalesce(Subquery(_transaction_net(tail).values("net")[:1], output_field=MONEY), ZERO)
+    )
+    return (
+        VirtualAccount.objects.annotate(expected=expected)
+        .filter(~Q(balance=F("expected")))
+        .values("chama_id", "chama__name", "balance", "expected")
+        .order_by("chama_id")
+    )
+
+
+def check_balances(lag=300, full=False, chunk_size=2000):
+    """
+    Verifies every chama's VirtualAccount.balance against its transactions.
+
+    Only transactions newer than the last run's high-water mark are
+    aggregated (server-side, grouped by chama) and folded into BalanceCheck; anything younger than `lag` seconds is left
+    for the next run so rows still being committed aren't skipped. `full`
+    starts again from nothing. Returns (run, drift rows).
+    """
+    # two runs folding the same range would count it twice
+    if not cache.add(LOCK_KEY, 1, timeout=6 * 3600):
+        raise RuntimeError("Another balance check is already running.")
+    try:
+        return _check_balances(lag, full, chunk_size)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _check_balances(lag, full, chunk_size):
+    cutoff = timezone.now() - timedelta(seconds=lag)
+    # the mark is saved in the same transaction as the fold, so the latest
+    # run is always the right place to resume from, finished or not
+    previous = None if full else BalanceCheckRun.objects.order_by("-id").first()
+    transaction_from = previous.transaction_high_water if previous else 0
+
+    with transaction.atomic():
+        if full:
+            BalanceCheck.objects.update(expected_balance=0)
+
+        transaction_hwm = Transaction.objects.filter(id__gt=transaction_from, timestamp__lt=cutoff).aggregate(
+            hwm=Max("id")
+        )["hwm"] or transaction_from
+
+        checked = _fold(
+            _transaction_net(Transaction.objects.filter(id__gt=transaction_from, id__lte=transaction_hwm)), chunk_size
+        )
+
+        run = BalanceCheckRun.objects.create(
+            transaction_high_water=transaction_hwm,
+            transactions_checked=checked,
+        )
+
+    drift = [
+        dict(row, drift=row["balance"] - row["expected"])
+        for row in _drifted(transaction_hwm).iterator(chunk_size=chunk_size)
+    ]
+
+    BalanceCheck.objects.exclude(drift=0).update(drift=0)
+    for row in drift:
+        BalanceCheck.objects.update_or_create(chama_id=row["chama_id"], defaults={"drift": row["drift"]})
+
+    run.chamas_checked = VirtualAccount.objects.count()
+    run.drifted = len(drift)
+    run.finished_at = timezone.now()
+    run.save()
+    return run, drift
+
+
+def accept_drift(chama_ids):
+    """Marks the current drift of these chamas as explained, so later runs stop reporting it."""
+    for check in BalanceCheck.objects.filter(chama_id__in=chama_ids).exclude(drift=0):
+        check.accepted_drift += check.drift
+        check.drift = 0
+        check.save(update_fields=["accepted_drift", "drift", "checked_at"])
@@ -0,0 +1,89 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models import F
+
+from payments.models import Counter
+
+# Counts are added up in memory and written to the Counter table at most once
+# per COUNTER_FLUSH_INTERVAL per process, so hot paths (token cache hits,
+# replayed callbacks) don't all queue on the same row. Each write is an
+# in-database increment, so workers flushing at the same time never lose
+# counts. A flush never happens inside a transaction, where the row lock would
+# be held until the caller commits; those counts wait for the next one.
+
+_pending = defaultdict(int)
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _add(name, amount):
+    """Adds to the in-memory count; True when a flush is due."""
+    with _lock:
+        _pending[name] += amount
+        return time.monotonic() - _last_flush >= settings.COUNTER_FLUSH_INTERVAL
+
+
+def incr(name, amount=1):
+    if _add(name, amount):
+        flush()
+
+
+async def aincr(name, amount=1):
+    if _add(name, amount):
+        await sync_to_async(flush)()
+
+
+def flush(force=False):
+    """Writes this process's pending counts to the Counter table."""
+    global _last_flush
+    if connection.in_atomic_block and not force:
+        return
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+
+    for name, amount in pending.items():
+        try:
+            _write(name, amount)
+        except DatabaseError:
+            # keep them for the next flush rather than lose them
+            _add(name, amount)
+
+
+def _write(name, amount):
+    if not Counter.objects.filter(name=name).update(value=F("value") + amount):
+        _, created = Counter.objects.get_or_create(name=name, defaults={"value": amount})
+        if not created:
+            Counter.objects.filter(name=name).update(value=F("value") + amount)
+
+
+def read(names):
+    """
+    {label: value} for a {label: counter_name} mapping; missing counters read 0.
+    Counts other processes haven't flushed yet show up within a flush interval.
+    """
+    flush(force=True)
+    values = dict(Counter.objects.filter(name__in=names.values()).values_list("name", "value"))
+    return {label: values.get(name, 0) for label, name in names.items()}
+
+
+def reset(names):
+    with _lock:
+        for name in names.values():
+            _pending.pop(name, None)
+    Counter.objects.filter(name__in=names.values()).update(value=0)
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush(force=True)
+    except Exception:
+        pass
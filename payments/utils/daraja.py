@@ -0,0 +1,285 @@
+import asyncio
+import base64
+import weakref
+from datetime import datetime
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from payments.utils.tokens import AccessTokenProvider
+
+OAUTH_PATH = "/oauth/v1/generate?grant_type=client_credentials"
+STK_PUSH_PATH = "/mpesa/stkpush/v1/processrequest"
+STK_QUERY_PATH = "/mpesa/stkpushquery/v1/query"
+
+
+class DarajaError(Exception):
+    pass
+
+
+class BaseDarajaClient:
+    """Credentials and request bodies shared by the sync and async clients."""
+
+    def __init__(self, base_url=None, consumer_key=None, consumer_secret=None,
+                 shortcode=None, passkey=None, callback_url=None,
+                 connect_timeout=None, read_timeout=None, pool_size=None):
+        self.base_url = (base_url or settings.MPESA_BASE_URL or "").rstrip("/")
+        self.consumer_key = consumer_key or settings.CONSUMER_KEY
+        self.consumer_secret = consumer_secret or settings.CONSUMER_SECRET
+        self.shortcode = shortcode or settings.MPESA_SHORTCODE
+        self.passkey = passkey or settings.MPESA_PASSKEY
+        self.callback_url = callback_url or settings.CALLBACK_URL
+        # an explicit 0 is a timeout too, so only None falls back to the settings
+        self.connect_timeout = settings.MPESA_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+        self.read_timeout = settings.MPESA_READ_TIMEOUT if read_timeout is None else read_timeout
+        self.pool_size = pool_size or settings.MPESA_POOL_SIZE
+
+    def _basic_auth(self):
+        credentials = f"{self.consumer_key}:{self.consumer_secret}"
+        return {"Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}"}
+
+    def _password(self):
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(
+            (self.shortcode + self.passkey + timestamp).encode()
+        ).decode()
+        return timestamp, password
+
+    def _stk_push_body(self, phone, amount, account_reference, description):
+        timestamp, password = self._password()
+        return {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",  # Paybill
+            "Amount": amount,
+            "PartyA": phone,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone,
+            "CallBackURL": self.callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": description,
+        }
+
+    def _stk_query_body(self, checkout_request_id):
+        timestamp, password = self._password()
+        return {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+
+    def _token_from(self, data):
+        if "access_token" not in data:
+            raise DarajaError("Access token missing in response.")
+        return data["access_token"], int(data.get("expires_in", 3599))
+
+
+class DarajaClient(BaseDarajaClient):
+    """
+    Talks to the Safaricom Daraja API (OAuth, STK push, STK query) over one
+    pooled keep-alive session with bounded connect/read timeouts.
+
+    `transport` is any requests adapter; it is mounted on the base URL so
+    tests (or the local simulator) can answer Daraja calls in-process.
+    """
+
+    def __init__(self, transport=None, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        # no automatic retries: a retried STK push would prompt the customer twice
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0))
+        if transport is not None:
+            self.session.mount(self.base_url, transport)
+
+        self.tokens = AccessTokenProvider(self.fetch_access_token)
+
+    # ---- OAuth ----
+    def fetch_access_token(self):
+        return self._token_from(self._json(self._send("GET", OAUTH_PATH, headers=self._basic_auth())))
+
+    def access_token(self):
+        return self.tokens.get_token()
+
+    # ---- STK push ----
+    def stk_push(self, phone, amount, account_reference, description):
+        return self._authorized_post(STK_PUSH_PATH, self._stk_push_body(phone, amount, account_reference, description))
+
+    def stk_query(self, checkout_request_id):
+        return self._authorized_post(STK_QUERY_PATH, self._stk_query_body(checkout_request_id))
+
+    def close(self):
+        self.session.close()
+
+    # ---- helpers ----
+    def _authorized_post(self, path, body):
+        response = self._send("POST", path, json=body, headers=self._bearer())
+
+        # token revoked before its expiry: refresh once and retry
+        if response.status_code == 401:
+            self.tokens.invalidate()
+            response = self._send("POST", path, json=body, headers=self._bearer())
+
+        return self._json(response)
+
+    def _bearer(self):
+        return {"Authorization": f"Bearer {self.access_token()}"}
+
+    def _send(self, method, path, **kwargs):
+        try:
+            return self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        except requests.Timeout as e:
+            raise DarajaError(f"M-Pesa request timed out: {str(e)}")
+        except requests.RequestException as e:
+            raise DarajaError(f"Failed to connect to M-Pesa: {str(e)}")
+
+    def _json(self, response):
+        try:
+            return response.json()
+        except ValueError:
+            raise DarajaError(f"Unexpected M-Pesa response ({response.status_code}).")
+
+
+class AsyncDarajaClient(BaseDarajaClient):
+    """
+    Non-blocking twin of DarajaClient built on httpx, for the async payment
+    views. `transport` is any httpx.AsyncBaseTransport.
+    """
+
+    def __init__(self, transport=None, **kwargs):
+        super().__init__(**kwargs)
+        self.http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Content-Type": "application/json"},
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            transport=transport,
+        )
+        self.tokens = AccessTokenProvider(None, afetch_token=self.fetch_access_token)
+
+    async def fetch_access_token(self):
+        return self._token_from(self._json(await self._send("GET", OAUTH_PATH, headers=self._basic_auth())))
+
+    async def access_token(self):
+        return await self.tokens.aget_token()
+
+    async def stk_push(self, phone, amount, account_reference, description):
+        return await self._authorized_post(STK_PUSH_PATH, self._stk_push_body(phone, amount, account_reference, description))
+
+    async def stk_query(self, checkout_request_id):
+        return await self._authorized_post(STK_QUERY_PATH, self._stk_query_body(checkout_request_id))
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def _authorized_post(self, path, body):
+        response = await self._send("POST", path, json=body, headers=await self._bearer())
+
+        if response.status_code == 401:
+            await self.tokens.ainvalidate()
+            response = await self._send("POST", path, json=body, headers=await self._bearer())
+
+        return self._json(response)
+
+    async def _bearer(self):
+        return {"Authorization": f"Bearer {await self.access_token()}"}
+
+    async def _send(self, method, path, **kwargs):
+        try:
+            return await self.http.request(method, path, **kwargs)
+        except httpx.TimeoutException as e:
+            raise DarajaError(f"M-Pesa request timed out: {str(e)}")
+        except httpx.HTTPError as e:
+            raise DarajaError(f"Failed to connect to M-Pesa: {str(e)}")
+
+    def _json(self, response):
+        try:
+            return response.json()
+        except ValueError:
+            raise DarajaError(f"Unexpected M-Pesa response ({response.status_code}).")
+
+
+class ThreadedDarajaClient:
+    """
+    The AsyncDarajaClient interface over the pooled sync client, each call
+    run in a worker thread. Used outside ASGI: there every async view runs
+    on an event loop of its own, which an httpx pool would not outlive.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def access_token(self):
+        return await sync_to_async(self.client.access_token, thread_sensitive=False)()
+
+    async def stk_push(self, phone, amount, account_reference, description):
+        return await sync_to_async(self.client.stk_push, thread_sensitive=False)(
+            phone, amount, account_reference, description,
+        )
+
+    async def stk_query(self, checkout_request_id):
+        return await sync_to_async(self.client.stk_query, thread_sensitive=False)(checkout_request_id)
+
+    async def aclose(self):
+        # the sync client is shared by the whole process
+        pass
+
+
+_client = None
+# httpx clients are bound to the event loop that created them
+_async_clients = weakref.WeakKeyDictionary()
+# set by asgi.py: the server's event loop lives as long as the process
+_long_lived_loops = False
+
+def get_client():
+    """
+    Returns the per-process Daraja client. Set MPESA_TRANSPORT to the dotted
+    path of a requests adapter class to route calls somewhere other than Safaricom.
+    """
+    global _client
+    if _client is None:
+        transport = import_string(settings.MPESA_TRANSPORT)() if settings.MPESA_TRANSPORT else None
+        _client = DarajaClient(transport=transport)
+    return _client
+
+def set_client(client):
+    """Swap the per-process client, e.g. for one wired to a fake transport in tests."""
+    global _client
+    _client = client
+
+def use_long_lived_loops():
+    """Called once by the ASGI entry point, where one httpx client per loop is reused."""
+    global _long_lived_loops
+    _long_lived_loops = True
+
+def get_async_client():
+    """
+    Returns the async client for the running event loop. Under ASGI that is
+    one httpx client per server loop, kept for the life of the process.
+    Anywhere else (async views under WSGI run on a new loop per request) the
+    calls go through the pooled sync client in a worker thread instead of
+    opening, and leaking, an httpx pool per request.
+
+    MPESA_ASYNC_TRANSPORT names an httpx transport class, the async
+    counterpart of MPESA_TRANSPORT.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None and not _long_lived_loops:
+        return ThreadedDarajaClient(get_client())
+    if client is None:
+        transport = import_string(settings.MPESA_ASYNC_TRANSPORT)() if settings.MPESA_ASYNC_TRANSPORT else None
+        client = _async_clients[loop] = AsyncDarajaClient(transport=transport)
+    return client
+
+def set_async_client(client):
+    _async_clients[asyncio.get_running_loop()] = client
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from app.models import Contribution, Member
+
+
+def summary_key(user_id):
+    return f"dashboard:{user_id}"
+
+
+def build_summary(user_id):
+    """
+    Everything the dashboard shows for a user, as plain values: their
+    chamas (split by role) with balance, leader and member count, the
+    totals, and their five latest contributions. Two queries.
+    """
+    memberships = (
+        Member.objects.filter(user_id=user_id)
+        .select_related('chama__virtual_accounts', 'chama__created_by', 'chama__stats')
+        .order_by('joined_at', 'id')
+    )
+
+    leader_chamas, member_chamas = [], []
+    for m in memberships:
+        chama = m.chama
+        account = getattr(chama, 'virtual_accounts', None)
+        row = {
+            'id': chama.id,
+            'name': chama.name,
+            'description': chama.description,
+            'leader': chama.created_by.username,
+            'member_count': chama.stats.member_count if hasattr(chama, 'stats') else 0,
+            'balance_display': account.balance if account else 0,
+        }
+        (leader_chamas if m.role == 'leader' else member_chamas).append(row)
+
+    chamas = leader_chamas + member_chamas
+    recent = (
+        Contribution.objects.filter(member__user_id=user_id)
+        .order_by('-date')
+        .values('member__user__username', 'amount', 'payment_method', 'date')[:5]
+    )
+    return {
+        'leader_chamas': leader_chamas,
+        'member_chamas': member_chamas,
+        'total_chamas': len(chamas),
+        'total_members': sum(c['member_count'] for c in chamas),
+        'total_balance': sum(c['balance_display'] for c in chamas),
+        'recent_transactions': [
+            {
+                'username': c['member__user__username'],
+                'amount': c['amount'],
+                'payment_method': c['payment_method'],
+                'date': c['date'],
+            }
+            for c in recent
+        ],
+    }
+
+
+def get_summary(user_id):
+    """The user's dashboard summary from the cache, built and cached first on a miss."""
+    summary = cache.get(summary_key(user_id))
+    if summary is None:
+        summary = build_summary(user_id)
+        cache.set(summary_key(user_id), summary, settings.DASHBOARD_CACHE_TIMEOUT)
+    return summary
+
+
+def invalidate_users(user_ids):
+    # after commit: dropped any earlier, a concurrent dashboard load could
+    # rebuild from the uncommitted (old) rows and cache them again
+    keys = [summary_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_chamas(chama_ids):
+    """Drop the summaries of everyone in these chamas (their balances or members changed)."""
+    invalidate_users(Member.objects.filter(chama_id__in=list(chama_ids)).values_list('user_id', flat=True))
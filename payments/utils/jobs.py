@@ -0,0 +1,207 @@
+import random
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from payments.models import Job
+
+
+def task_path(func):
+    return func if isinstance(func, str) else f"{func.__module__}.{func.__qualname__}"
+
+
+def enqueue(func, priority=0, delay=0, max_attempts=None, **kwargs):
+    """
+    Queue `func(**kwargs)` to run in a worker. The job row is written on the
+    caller's connection, so inside transaction.atomic() it commits (or rolls
+    back) with the business write. kwargs must be JSON-serializable.
+    """
+    return enqueue_many(func, [kwargs], priority=priority, delay=delay, max_attempts=max_attempts)[0]
+
+
+def enqueue_many(func, kwargs_list, priority=0, delay=0, max_attempts=None):
+    """Queue one job per kwargs dict with a single INSERT."""
+    path = task_path(func)
+    if settings.JOBS_MODE == "immediate":
+        for kwargs in kwargs_list:
+            # the same commit semantics, minus the table and the worker
+            transaction.on_commit(lambda kwargs=kwargs: _run_now(path, kwargs))
+        return [None] * len(kwargs_list)
+
+    run_at = timezone.now() + timedelta(seconds=delay)
+    return Job.objects.bulk_create([
+        Job(
+            task=path,
+            kwargs=kwargs,
+            priority=priority,
+            run_at=run_at,
+            max_attempts=max_attempts or settings.JOBS_MAX_ATTEMPTS,
+        )
+        for kwargs in kwargs_list
+    ])
+
+
+def _run_now(path, kwargs):
+    """
+    Runs a job in-process after the enqueuing transaction committed. The
+    caller's write is already in, so a failure is recorded as a failed job
+    rather than raised at it.
+    """
+    try:
+        import_string(path)(**kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        print(f"Job {path} failed: {error.strip().splitlines()[-1]}")
+        now = timezone.now()
+        Job.objects.create(
+            task=path, kwargs=kwargs, status="failed", attempts=1,
+            started_at=now, finished_at=now, last_error=error,
+        )
+
+
+def backoff(attempts):
+    """Seconds before retry number `attempts`: doubling, capped, with jitter so failures don't retry in lockstep."""
+    delay = min(settings.JOBS_BACKOFF_MAX, settings.JOBS_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay + random.uniform(0, delay / 2)
+
+
+def claim(worker, limit=1):
+    """
+    Marks up to `limit` due jobs as running for `worker` and returns them,
+    highest priority first. SKIP LOCKED lets any number of workers claim
+    side by side without waiting on each other or taking the same job.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status="queued", run_at__lte=now)
+            .order_by("-priority", "run_at", "id")
+            .values_list("id", flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        Job.objects.filter(id__in=ids).update(
+            status="running", started_at=now, heartbeat_at=now, locked_by=worker, attempts=F("attempts") + 1,
+        )
+    return list(Job.objects.filter(id__in=ids).order_by("-priority", "run_at", "id"))
+
+
+def run(job):
+    """Runs a claimed job, then marks it done or schedules its retry. Returns True on success."""
+    try:
+        import_string(job.task)(**job.kwargs)
+    except Exception:
+        _fail(job, traceback.format_exc())
+        return False
+
+    Job.objects.filter(id=job.id, status="running").update(
+        status="done", finished_at=timezone.now(), last_error="",
+    )
+    return True
+
+
+def _fail(job, error):
+    now = timezone.now()
+    if job.attempts >= job.max_attempts:
+        print(f"Job {job.id} {job.task} failed for good after {job.attempts} attempts")
+        Job.objects.filter(id=job.id).update(status="failed", finished_at=now, last_error=error)
+    else:
+        retry_at = now + timedelta(seconds=backoff(job.attempts))
+        print(f"Job {job.id} {job.task} failed (attempt {job.attempts}), retrying at {retry_at:%H:%M:%S}")
+        Job.objects.filter(id=job.id).update(status="queued", run_at=retry_at, last_error=error)
+
+
+def heartbeat(worker):
+    """Marks `worker`'s running jobs as still in progress, however long they take."""
+    return Job.objects.filter(status="running", locked_by=worker).update(heartbeat_at=timezone.now())
+
+
+def _keep_alive(worker, stop):
+    # a thread of its own (and so its own connection), beating while jobs run
+    try:
+        while not stop.wait(settings.JOBS_HEARTBEAT_INTERVAL):
+            try:
+                heartbeat(worker)
+            except DatabaseError as e:
+                print(f"Job worker {worker} heartbeat failed: {e}")
+            close_old_connections()
+    finally:
+        connection.close()
+
+
+def requeue_stale():
+    """
+    Puts back running jobs whose worker died mid-job (or fails them if
+    they're out of attempts). A live worker keeps its jobs' heartbeat fresh,
+    so a long job is never taken away from it.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.JOBS_STALE_AFTER)
+    stale = Job.objects.filter(status="running", heartbeat_at__lt=cutoff)
+    failed = stale.filter(attempts__gte=F("max_attempts")).update(
+        status="failed", finished_at=timezone.now(), last_error="Worker stopped responding",
+    )
+    requeued = stale.update(status="queued", run_at=timezone.now(), last_error="Worker stopped responding")
+    return requeued, failed
+
+
+def purge_finished(days=None):
+    cutoff = timezone.now() - timedelta(days=days or settings.JOBS_RETENTION_DAYS)
+    return Job.objects.filter(status="done", finished_at__lt=cutoff).delete()[0]
+
+
+def work(worker=None, batch_size=10, stop=None, once=False):
+    """
+    Worker loop: claim a batch, run it, repeat; when the queue is empty,
+    tidy up stale and old jobs and poll again after JOBS_POLL_INTERVAL.
+    `once` returns as soon as nothing is due. Returns (done, failed).
+    """
+    worker = worker or f"{socket.gethostname()}:{threading.get_ident()}"
+    stop = stop or threading.Event()
+
+    beating = threading.Event()
+    threading.Thread(target=_keep_alive, args=(worker, beating), daemon=True).start()
+    try:
+        return _work(worker, batch_size, stop, once)
+    finally:
+        beating.set()
+
+
+def _work(worker, batch_size, stop, once):
+    done = failed = 0
+    last_tidy = 0
+
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            jobs = claim(worker, batch_size)
+            for job in jobs:
+                if run(job):
+                    done += 1
+                else:
+                    failed += 1
+        except DatabaseError as e:
+            # a job left "running" by this is picked up again by requeue_stale
+            print(f"Job worker {worker} database error: {e}")
+            stop.wait(settings.JOBS_POLL_INTERVAL)
+            continue
+        if jobs:
+            continue
+
+        if time.monotonic() - last_tidy > 60:
+            requeue_stale()
+            purge_finished()
+            last_tidy = time.monotonic()
+        if once:
+            break
+        stop.wait(settings.JOBS_POLL_INTERVAL)
+
+    return done, failed
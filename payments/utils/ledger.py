@@ -0,0 +1,105 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Sum
+
+from app.models import VirtualAccount
+from payments.models import JournalEntry, LedgerAccount, Posting
+from payments.utils.balances import credit, debit
+from payments.utils.dashboard import invalidate_chamas
+
+# System accounts on the other side of chama wallets
+CLEARING = ("mpesa:clearing", "M-Pesa paybill clearing")
+OPENING = ("equity:opening", "Opening balances")
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+class UnbalancedEntry(ValueError):
+    pass
+
+
+def system_account(account):
+    code, name = account
+    return LedgerAccount.objects.get_or_create(code=code, defaults={"name": name})[0]
+
+
+def chama_accounts(chama_ids):
+    """{chama_id: wallet LedgerAccount}, creating wallets for chamas that don't have one yet."""
+    chama_ids = set(chama_ids)
+    accounts = {
+        a.virtual_account.chama_id: a
+        for a in LedgerAccount.objects.select_related("virtual_account").filter(virtual_account__chama_id__in=chama_ids)
+    }
+    for va in VirtualAccount.objects.filter(chama_id__in=chama_ids - accounts.keys()).select_related("chama"):
+        account, _ = LedgerAccount.objects.get_or_create(
+            code=f"chama:{va.chama_id}",
+            defaults={"name": f"{va.chama.name} wallet", "virtual_account": va},
+        )
+        account.virtual_account = va
+        accounts[va.chama_id] = account
+    return accounts
+
+
+def deposit_entry(txn, wallet, clearing):
+    """Money received on the paybill for a chama: debit clearing, credit the wallet."""
+    return (
+        JournalEntry(chama_id=txn.chama_id, transaction=txn, description=f"Deposit {txn.mpesa_code}"),
+        [(clearing, txn.amount), (wallet, -txn.amount)],
+    )
+
+
+def withdrawal_entry(txn, wallet, clearing):
+    """Money paid out of a chama: debit the wallet, credit clearing."""
+    return (
+        JournalEntry(chama_id=txn.chama_id, transaction=txn, description=f"Withdrawal {txn.mpesa_code}"),
+        [(wallet, txn.amount), (clearing, -txn.amount)],
+    )
+
+
+def post_entries(entries):
+    """
+    Posts many (JournalEntry, [(account, amount), ...]) pairs at once: one
+    INSERT for the entries, one for all their postings, and one balance
+    UPDATE per chama wallet touched. Must run inside transaction.atomic();
+    raises InsufficientFunds (rolling the caller back) if a wallet would go
+    negative.
+    """
+    deltas = defaultdict(Decimal)
+    for entry, postings in entries:
+        if not postings or sum(amount for _, amount in postings) != 0:
+            raise UnbalancedEntry(f"Postings for '{entry.description}' don't sum to zero.")
+        for account, amount in postings:
+            if account.virtual_account_id:
+                deltas[account.virtual_account.chama_id] -= amount
+
+    # the VirtualAccount balance is the wallet's projection (credit-normal)
+    for chama_id, delta in deltas.items():
+        if delta >= 0:
+            credit(chama_id, delta)
+        elif not debit(chama_id, -delta):
+            raise InsufficientFunds("Insufficient balance.")
+    # F() updates skip post_save, and bulk-recorded transactions have none either
+    invalidate_chamas(deltas)
+
+    JournalEntry.objects.bulk_create([entry for entry, _ in entries])
+    Posting.objects.bulk_create([
+        Posting(entry=entry, account=account, amount=amount, created_at=entry.created_at)
+        for entry, postings in entries
+        for account, amount in postings
+    ])
+
+
+def post_transactions(txns):
+    """Journal entries for recorded deposits/withdrawals, posted in one batch."""
+    wallets = chama_accounts(t.chama_id for t in txns)
+    clearing = system_account(CLEARING)
+    make_entry = {"deposit": deposit_entry, "withdrawal": withdrawal_entry}
+    post_entries([make_entry[t.transaction_type](t, wallets[t.chama_id], clearing) for t in txns])
+
+
+def ledger_balance(account):
+    """Balance of a wallet from its postings alone (credits minus debits)."""
+    return -(account.postings.aggregate(total=Sum("amount"))["total"] or Decimal("0"))
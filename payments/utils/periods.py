@@ -0,0 +1,237 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
+
+from app.models import Chama
+from payments.models import JournalEntry, LedgerAccount, MonthlyBalance, Posting, Transaction
+
+ZERO = Decimal("0")
+
+
+class BeforeLedgerStart(ValueError):
+    """The ledger has no history for a chama that far back."""
+
+
+def month_start(value):
+    """First day of the month `value` (a date or datetime) falls in."""
+    if isinstance(value, datetime):
+        value = timezone.localtime(value).date()
+    return value.replace(day=1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def previous_month(month):
+    return date(month.year - (month.month == 1), (month.month - 2) % 12 + 1, 1)
+
+
+def month_bounds(month):
+    """[start, end) of a month as aware datetimes."""
+    start = timezone.make_aware(datetime(month.year, month.month, 1))
+    end = timezone.make_aware(datetime.combine(next_month(month), datetime.min.time()))
+    return start, end
+
+
+def _wallets(chama_ids=None):
+    """{chama_id: wallet account id}"""
+    wallets = LedgerAccount.objects.filter(virtual_account__isnull=False)
+    if chama_ids is not None:
+        wallets = wallets.filter(virtual_account__chama_id__in=chama_ids)
+    return dict(wallets.values_list("virtual_account__chama_id", "id"))
+
+
+def _activity(account_ids, start, end):
+    """
+    Deposits, withdrawals and net change per wallet between start and end, in
+    one grouped query. Bounded on the (account, created_at) index, so only the
+    postings in the period are read.
+    """
+    postings = Posting.objects.filter(account_id__in=account_ids, created_at__lt=end)
+    if start is not None:
+        postings = postings.filter(created_at__gte=start)
+
+    deposit = Q(entry__transaction__transaction_type="deposit")
+    withdrawal = Q(entry__transaction__transaction_type="withdrawal")
+    rows = postings.values("account_id").annotate(
+        deposits=Sum("amount", filter=deposit),
+        deposit_count=Count("id", filter=deposit),
+        withdrawals=Sum("amount", filter=withdrawal),
+        withdrawal_count=Count("id", filter=withdrawal),
+        net=Sum("amount"),
+    )
+
+    # wallets are credit-normal: credits (negative postings) add to the balance
+    return {
+        row["account_id"]: {
+            "deposits": -(row["deposits"] or ZERO),
+            "deposit_count": row["deposit_count"],
+            "withdrawals": row["withdrawals"] or ZERO,
+            "withdrawal_count": row["withdrawal_count"],
+            "net": -(row["net"] or ZERO),
+        }
+        for row in rows
+    }
+
+
+def _summary(chama_id, month, opening, activity):
+    activity = activity or {"deposits": ZERO, "deposit_count": 0, "withdrawals": ZERO, "withdrawal_count": 0, "net": ZERO}
+    return MonthlyBalance(
+        chama_id=chama_id,
+        month=month,
+        opening_balance=opening,
+        deposits=activity["deposits"],
+        deposit_count=activity["deposit_count"],
+        withdrawals=activity["withdrawals"],
+        withdrawal_count=activity["withdrawal_count"],
+        adjustments=activity["net"] - activity["deposits"] + activity["withdrawals"],
+        closing_balance=opening + activity["net"],
+    )
+
+
+def close_month(month):
+    """
+    Writes the MonthlyBalance row of every chama that doesn't have one for
+    `month` yet. Openings come from the previous month's close; a chama
+    closing its first month gets its opening from one scan of its history.
+    Returns the number of rows written.
+    """
+    start, end = month_bounds(month)
+    if end > timezone.now():
+        raise ValueError(f"{month:%Y-%m} has not ended yet.")
+
+    closed = MonthlyBalance.objects.filter(month=month).values_list("chama_id", flat=True)
+    chama_ids = (
+        Chama.objects.filter(Q(created_at__lt=end) | Q(journal_entries__created_at__lt=end))
+        .exclude(id__in=closed).values_list("id", flat=True).distinct()
+    )
+    wallets = _wallets(chama_ids)
+    if not wallets:
+        return 0
+
+    openings = dict(
+        MonthlyBalance.objects.filter(month=previous_month(month), chama_id__in=wallets)
+        .values_list("chama_id", "closing_balance")
+    )
+    unopened = [account for chama_id, account in wallets.items() if chama_id not in openings]
+    if unopened:
+        history = _activity(unopened, None, start)
+        for chama_id, account in wallets.items():
+            if chama_id not in openings:
+                openings[chama_id] = history.get(account, {}).get("net", ZERO)
+
+    activity = _activity(list(wallets.values()), start, end)
+    rows = [
+        _summary(chama_id, month, openings[chama_id], activity.get(account))
+        for chama_id, account in wallets.items()
+    ]
+    # a second close_periods run racing this one just skips the rows it lost
+    MonthlyBalance.objects.bulk_create(rows, ignore_conflicts=True)
+    return len(rows)
+
+
+def close_periods(until=None):
+    """
+    Closes every month that has ended, up to (not including) `until`'s
+    month, that some chama hasn't closed yet. Meant to run from cron early
+    each month; safe to re-run. Yields (month, rows written).
+    """
+    until = month_start(until or timezone.now())
+
+    newest = MonthlyBalance.objects.aggregate(newest=Max("month"))["newest"]
+    months = [next_month(newest)] if newest else []
+
+    # chamas with no closed months yet start from their first entry
+    first_entry = JournalEntry.objects.filter(
+        chama__in=Chama.objects.filter(monthly_balances__isnull=True)
+    ).aggregate(first=Min("created_at"))["first"]
+    if first_entry:
+        months.append(month_start(first_entry))
+    if not months:
+        return
+
+    month = min(months)
+    while month < until:
+        yield month, close_month(month)
+        month = next_month(month)
+
+
+def ledger_start(chama_id):
+    """
+    The earliest moment the ledger accounts for a chama's balance: when the
+    chama was created, or its first journal entry if that is earlier (an
+    opening balance). If the chama has transactions older than its first
+    entry, the ledger never saw them and starts at that entry.
+    """
+    created = Chama.objects.filter(pk=chama_id).values_list("created_at", flat=True).first()
+    first_entry = JournalEntry.objects.filter(chama_id=chama_id).aggregate(first=Min("created_at"))["first"]
+    if first_entry is None:
+        return created
+    if created is None or first_entry < created:
+        return first_entry
+    if Transaction.objects.filter(chama_id=chama_id, timestamp__lt=first_entry).exists():
+        return first_entry
+    return created
+
+
+def balance_at(chama_id, when):
+    """
+    A chama's wallet balance at `when`: the closing balance of the last
+    month closed before it, plus the postings since. Never scans more than
+    the months since the last close. Raises BeforeLedgerStart for a moment
+    before ledger_start(), rather than answering with a balance the ledger
+    can't know.
+    """
+    start = ledger_start(chama_id)
+    if start is not None and when < start:
+        raise BeforeLedgerStart(f"The ledger for chama {chama_id} starts at {start:%Y-%m-%d %H:%M}.")
+
+    snapshot = (
+        MonthlyBalance.objects.filter(chama_id=chama_id, month__lt=month_start(when))
+        .order_by("-month").first()
+    )
+    wallets = _wallets([chama_id])
+    if chama_id not in wallets:
+        return ZERO
+
+    if snapshot is None:
+        since, balance = None, ZERO
+    else:
+        since, balance = month_bounds(snapshot.month)[1], snapshot.closing_balance
+
+    tail = _activity([wallets[chama_id]], since, when)
+    return balance + tail.get(wallets[chama_id], {}).get("net", ZERO)
+
+
+def monthly_report(chama_id, first_month, last_month):
+    """
+    MonthlyBalance rows for a chama from `first_month` to `last_month`.
+    Closed months are read as they are; months not closed yet (such as the
+    current one) are summarized on the fly and not saved.
+    """
+    first_month, last_month = month_start(first_month), month_start(last_month)
+    begins = ledger_start(chama_id)
+    if begins is not None and month_bounds(first_month)[1] <= begins:
+        raise BeforeLedgerStart(f"The ledger for chama {chama_id} starts at {begins:%Y-%m-%d %H:%M}.")
+    closed = {
+        row.month: row
+        for row in MonthlyBalance.objects.filter(chama_id=chama_id, month__gte=first_month, month__lte=last_month)
+    }
+    wallets = _wallets([chama_id])
+
+    report = []
+    month = first_month
+    while month <= last_month:
+        row = closed.get(month)
+        if row is None:
+            start, end = month_bounds(month)
+            # the month the ledger starts in opens at nothing, and its opening entry is an adjustment
+            opening = report[-1].closing_balance if report else balance_at(chama_id, max(start, begins or start))
+            activity = _activity(list(wallets.values()), start, min(end, timezone.now()))
+            row = _summary(chama_id, month, opening, activity.get(wallets.get(chama_id)))
+        report.append(row)
+        month = next_month(month)
+    return report
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+from urllib.parse import quote, unquote
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils.module_loading import import_string
+
+
+def receipt_name(mpesa_code):
+    """
+    Storage name of a receipt, e.g. "3f/a9/receipt_SIM1234.pdf". Two levels of
+    256 hash shards keep each directory small with millions of receipts.
+    """
+    digest = hashlib.sha1(mpesa_code.encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/receipt_{mpesa_code}.pdf"
+
+
+def _write_atomically(path, content, mode=0o644):
+    # write beside the target and rename it into place: readers (including
+    # a proxy serving the file) see the old file or the new one, never half of one
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class ShardedReceiptStorage(FileSystemStorage):
+    """Default receipt storage: MEDIA_ROOT/receipts/<shard>/<shard>/receipt_<code>.pdf on local disk."""
+
+    def __init__(self, location=None, base_url=None):
+        super().__init__(
+            location=location or os.path.join(settings.MEDIA_ROOT, "receipts"),
+            base_url=base_url or f"{settings.MEDIA_URL}receipts/",
+            allow_overwrite=True,
+        )
+
+    def _save(self, name, content):
+        _write_atomically(self.path(name), content, self.file_permissions_mode or 0o644)
+        return name
+
+
+class LocalObjectStorage(Storage):
+    """
+    Local stand-in for an S3-style bucket, for developing against object
+    store semantics: flat keys, whole-object writes, no directories and no
+    filesystem path (so no X-Sendfile). A real backend such as
+    django-storages' S3Storage drops in through RECEIPT_STORAGE the same way.
+    """
+
+    def __init__(self, location=None, base_url=None):
+        self.location = location or settings.RECEIPT_OBJECT_STORE_ROOT
+        self.base_url = base_url or settings.RECEIPT_OBJECT_STORE_URL
+
+    def _object_path(self, name):
+        # keys are opaque: "3f/a9/receipt_X.pdf" is one object, not nested folders
+        return os.path.join(self.location, quote(name, safe=""))
+
+    def _open(self, name, mode="rb"):
+        return File(open(self._object_path(name), mode), name=name)
+
+    def _save(self, name, content):
+        _write_atomically(self._object_path(name), content)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # PUT overwrites, like a bucket
+        return name
+
+    def delete(self, name):
+        try:
+            os.unlink(self._object_path(name))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, name):
+        return os.path.exists(self._object_path(name))
+
+    def size(self, name):
+        return os.path.getsize(self._object_path(name))
+
+    def url(self, name):
+        return f"{self.base_url}{quote(name)}"
+
+    def listdir(self, path):
+        prefix = path.rstrip("/") + "/" if path else ""
+        keys = [unquote(f) for f in os.listdir(self.location)] if os.path.isdir(self.location) else []
+        return [], [k[len(prefix):] for k in keys if k.startswith(prefix) and not k.endswith(".tmp")]
+
+
+_storage = None
+
+def get_receipt_storage():
+    """Per-process receipt storage; RECEIPT_STORAGE is the dotted path of a Django Storage class."""
+    global _storage
+    if _storage is None:
+        _storage = import_string(settings.RECEIPT_STORAGE)()
+    return _storage
+
+def set_receipt_storage(storage):
+    """Swap the per-process storage, e.g. for a temporary directory in tests."""
+    global _storage
+    _storage = storage
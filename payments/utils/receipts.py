@@ -1,22 +1,58 @@
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
+from reportlab.lib.rl_accel import escapePDF
 from django.conf import settings
-import os
+from django.core.files.base import ContentFile
+from collections import OrderedDict
+from io import BytesIO
+import hashlib
+import re
+import threading
 
-def generate_transaction_receipt(transaction):
+from payments.models import StoredReceipt, Transaction
+from payments.utils.receipt_storage import get_receipt_storage, receipt_name
+
+# bump when the receipt layout changes, so cached copies and ETags change with it
+RECEIPT_LAYOUT_VERSION = 2
+
+
+def receipt_etag(transaction):
     """
-    Generates a PDF receipt for a given transaction and returns the file path.
+    Strong ETag for a transaction's receipt, from the fields printed on it.
+    Recorded transactions don't change, so neither does the tag.
     """
+    fields = [
+        RECEIPT_LAYOUT_VERSION,
+        transaction.pk,
+        transaction.mpesa_code,
+        transaction.transaction_type,
+        transaction.amount,
+        transaction.member.user.username if transaction.member else "",
+        transaction.initiated_by or "",
+        transaction.phone_number,
+        transaction.status,
+        transaction.timestamp.isoformat(),
+    ]
+    return hashlib.sha256("|".join(str(f) for f in fields).encode()).hexdigest()[:32]
+
 
-    # file path
-    receipts_dir = os.path.join(settings.MEDIA_ROOT, 'receipts')
-    os.makedirs(receipts_dir, exist_ok=True)
+def _receipt_values(transaction):
+    """The variable parts of a receipt: the detail values, then the footer year."""
+    return [
+        transaction.mpesa_code,
+        transaction.get_transaction_type_display(),
+        f"{transaction.amount:,.2f}",
+        transaction.member.user.username if transaction.member else "N/A",
+        transaction.initiated_by or "System",
+        transaction.phone_number,
+        transaction.status,
+        transaction.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        str(transaction.timestamp.year),
+    ]
 
-    file_name = f"receipt_{transaction.mpesa_code}.pdf"
-    file_path = os.path.join(receipts_dir, file_name)
 
-    c = canvas.Canvas(file_path, pagesize=A4)
+def _draw_receipt(c, values):
     width, height = A4
 
     # Header
@@ -30,27 +66,217 @@ def generate_transaction_receipt(transaction):
     c.setFont("Helvetica", 12)
     y = height - 100
 
-    details = [
-        ("Reference Number:", transaction.mpesa_code),
-        ("Transaction Type", transaction.get_transaction_type_display()),
-        ("Amount (KES)", f"{transaction.amount:,.2f}"),
-        ("Member", transaction.member.user.username if transaction.member else "N/A"),
-        ("Initiated By", transaction.initiated_by or "System"),
-        ("Phone Number", transaction.phone_number),
-        ("Status", transaction.status),
-        ("Date", transaction.timestamp.strftime("%Y-%m-%d %H:%M:%S")),
+    labels = [
+        "Reference Number:",
+        "Transaction Type",
+        "Amount (KES)",
+        "Member",
+        "Initiated By",
+        "Phone Number",
+        "Status",
+        "Date",
     ]
 
-    for label, value in details:
+    for label, value in zip(labels, values):
         c.drawString(50, y, f"{label}: {value}")
         y -= 20
-    
+
     # Footer
     c.setFont("Helvetica-Oblique", 10)
     c.drawString(50, 30, "Generated by Chama App")
-    c.drawString(50, 35, f"© {transaction.timestamp.year} Chama App. All rights reserved.")
+    c.drawString(50, 35, f"© {values[8]} Chama App. All rights reserved.")
 
     c.showPage()
+
+
+def render_receipt_canvas(transaction):
+    """
+    Renders a receipt by drawing it on a fresh canvas. The reference
+    renderer: render_receipt_pdf produces the same bytes from a template.
+    """
+    buffer = BytesIO()
+    # invariant: no timestamps or random document ID, so equal inputs give equal bytes
+    c = canvas.Canvas(buffer, pagesize=A4, invariant=1, pageCompression=0)
+    _draw_receipt(c, _receipt_values(transaction))
     c.save()
+    return buffer.getvalue()
+
+
+class ReceiptTemplate:
+    """
+    A receipt rendered once with placeholders in place of the variable
+    fields, split so a receipt is just the pieces joined around the escaped
+    values, with the stream length and xref offsets patched. No canvas or
+    PDF object graph is built per receipt.
+    """
+
+    def __init__(self):
+        buffer = BytesIO()
+        c = canvas.Canvas(buffer, pagesize=A4, invariant=1, pageCompression=0)
+        _draw_receipt(c, [f"@@F{i}@@" for i in range(9)])
+        c.save()
+        pdf = buffer.getvalue()
+
+        # the page's content stream is the only part that varies
+        match = re.search(rb"/Length (\d+)\n>>\nstream\n", pdf)
+        length_start, length_end, stream_start = match.start(1), match.end(1), match.end()
+        stream_end = stream_start + int(match.group(1))
+        parts = re.split(rb"@@F(\d+)@@", pdf[stream_start:stream_end])
+        self.literals = parts[0::2]
+        self.slots = [int(i) for i in parts[1::2]]
+
+        xref_start = pdf.index(b"\nxref\n", stream_end) + 1
+        startxref = pdf.index(b"startxref\n", xref_start)
+        xref_lines = pdf[xref_start:startxref].split(b"\n")
+        count = int(xref_lines[1].split()[1])
+        entries = xref_lines[2:2 + count]
+
+        self.head = pdf[:length_start]
+        self.between = pdf[length_end:stream_start]
+        self.after_stream = pdf[stream_end:xref_start]
+        self.xref_header = b"\n".join(xref_lines[:2]) + b"\n"
+        self.trailer = b"\n".join(xref_lines[2 + count:])
+        # (offset, generation/type suffix, shifts when the stream grows)
+        self.entries = [(int(e[:10]), e[10:], int(e[:10]) > length_start) for e in entries]
+        self.base_xref = xref_start
+
+    def render(self, values):
+        escaped = [escapePDF(v).encode("latin-1") for v in values]
+        pieces = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            pieces.append(escaped[slot])
+            pieces.append(literal)
+        stream = b"".join(pieces)
+
+        length = str(len(stream)).encode()
+        out = [self.head, length, self.between, stream, self.after_stream]
+        shift = sum(len(p) for p in out) - self.base_xref
+
+        out.append(self.xref_header)
+        for offset, suffix, moves in self.entries:
+            out.append(b"%010d%s\n" % (offset + shift if moves else offset, suffix))
+        out.append(self.trailer)
+        out.append(b"startxref\n%d\n%%%%EOF\n" % (self.base_xref + shift))
+        return b"".join(out)
+
+
+_template = None
+
+def render_receipt_pdf(transaction):
+    """Renders a transaction's PDF receipt into memory and returns the bytes."""
+    global _template
+    values = _receipt_values(transaction)
+    # the template is stamped in plain Helvetica encoding; anything outside
+    # printable ASCII goes through the canvas, which handles font encoding
+    # (and draws control characters with a fallback font)
+    if not all(v.isascii() and v.isprintable() for v in values):
+        return render_receipt_canvas(transaction)
+    if _template is None:
+        _template = ReceiptTemplate()
+    return _template.render(values)
+
+
+def store_receipt(transaction, etag=None):
+    """
+    Renders a transaction's receipt into receipt storage. Returns a
+    StoredReceipt (unsaved) describing what was written.
+    """
+    name = get_receipt_storage().save(
+        receipt_name(transaction.mpesa_code), ContentFile(render_receipt_pdf(transaction))
+    )
+    return StoredReceipt(
+        transaction_id=transaction.pk,
+        etag=etag or receipt_etag(transaction),
+        storage=settings.RECEIPT_STORAGE,
+        name=name,
+    )
+
+
+def record_stored(receipts):
+    """Upserts StoredReceipt rows in one statement."""
+    StoredReceipt.objects.bulk_create(
+        receipts,
+        update_conflicts=True,
+        unique_fields=["transaction"],
+        update_fields=["etag", "storage", "name", "rendered_at"],
+    )
+
+
+def is_current(stored, etag):
+    """True when a StoredReceipt was rendered from these inputs into the storage in use."""
+    return stored is not None and stored.etag == etag and stored.storage == settings.RECEIPT_STORAGE
+
+
+def generate_transaction_receipt(transaction):
+    """
+    Renders a transaction's PDF receipt into receipt storage and returns its
+    storage name.
+    """
+    stored = store_receipt(transaction)
+    record_stored([stored])
+    return stored.name
+
+
+def ensure_receipt(transaction):
+    """Storage name of the receipt, rendering it first if there's no current copy in storage."""
+    stored = StoredReceipt.objects.filter(transaction_id=transaction.pk).first()
+    if is_current(stored, receipt_etag(transaction)):
+        return stored.name
+    return generate_transaction_receipt(transaction)
+
+
+def render_receipt(transaction_id):
+    """Background job: render the receipt PDF of a recorded transaction."""
+    generate_transaction_receipt(Transaction.objects.select_related("chama", "member__user").get(id=transaction_id))
+
+
+class ReceiptCache:
+    """In-process LRU of rendered receipts, bounded by total bytes rather than entries."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            pdf = self._entries.get(key)
+            if pdf is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pdf
+
+    def put(self, key, pdf):
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = pdf
+            self.size += len(pdf)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+receipt_cache = ReceiptCache(settings.RECEIPT_CACHE_BYTES)
+
 
-    return file_path
+def get_receipt_pdf(transaction, etag=None):
+    """The receipt's PDF bytes, from the LRU when it has them, else rendered in memory."""
+    etag = etag or receipt_etag(transaction)
+    pdf = receipt_cache.get(etag)
+    if pdf is None:
+        pdf = render_receipt_pdf(transaction)
+        receipt_cache.put(etag, pdf)
+    return pdf
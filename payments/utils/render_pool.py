@@ -0,0 +1,19 @@
+"""
+Entry points for receipt rendering worker processes. Workers are spawned
+rather than forked (no inherited database connections), so this module
+must import without Django being set up: everything else is imported
+inside the functions.
+"""
+
+
+def init_worker():
+    import django
+
+    django.setup()
+
+
+def render_batch(batch):
+    """Renders (transaction, etag) pairs into receipt storage; returns their unsaved StoredReceipt rows."""
+    from payments.utils.receipts import store_receipt
+
+    return [store_receipt(txn, etag) for txn, etag in batch]
@@ -0,0 +1,356 @@
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from django.conf import settings
+
+from payments.utils.daraja import OAUTH_PATH, STK_PUSH_PATH, STK_QUERY_PATH
+
+
+def parse_latency(spec):
+    """
+    Turns a latency spec into a sampler returning seconds:
+    "0.2" (fixed), "uniform:0.1,0.5", "normal:0.3,0.05" or "lognormal:0.3,0.5"
+    (median, sigma; gives the long tail real Daraja calls have).
+    """
+    if not spec:
+        return lambda: 0.0
+
+    kind, _, args = spec.partition(":")
+    if not args:
+        value = float(kind)
+        return lambda: value
+
+    a, b = (float(x) for x in args.split(","))
+    if kind == "uniform":
+        return lambda: random.uniform(a, b)
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(a, b))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(0, b) * a
+    raise ValueError(f"Unknown latency distribution: {kind}")
+
+
+def summarize(latencies):
+    """Count, p50/p95/p99 and max of a list of seconds."""
+    if not latencies:
+        return {"count": 0, "p50": 0, "p95": 0, "p99": 0, "max": 0}
+
+    ordered = sorted(latencies)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    return {"count": len(ordered), "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "max": ordered[-1]}
+
+
+class DarajaSimulator:
+    """
+    Stand-in for Safaricom's OAuth, STK push and STK query endpoints. Every
+    accepted push later gets a callback POSTed to `callback_url`; callbacks
+    can be delayed, duplicated and delivered out of order.
+    """
+
+    def __init__(self, callback_url=None, latency=None, callback_delay="uniform:1,5",
+                 error_rate=0.0, cancel_rate=0.0, duplicate_rate=0.0, deliver_callbacks=True,
+                 callback_workers=8, seed=None):
+        self.callback_url = callback_url or settings.CALLBACK_URL
+        self.latency = parse_latency(latency)
+        self.callback_delay = parse_latency(callback_delay)
+        self.error_rate = error_rate
+        self.cancel_rate = cancel_rate
+        self.duplicate_rate = duplicate_rate
+        self.deliver_callbacks = deliver_callbacks
+
+        if seed is not None:
+            random.seed(seed)
+
+        self.pushes = {}
+        self.lock = threading.Lock()
+        self._sequence = itertools.count()
+        self.stats = {"oauth": 0, "stk_push": 0, "stk_query": 0, "errors": 0, "callbacks": 0, "callback_failures": 0}
+        self.callback_latencies = []
+
+        # callbacks wait in a heap ordered by due time, so their delays
+        # decide delivery order rather than push order
+        self._queue = []
+        self._queue_ready = threading.Condition(self.lock)
+        self._session = requests.Session()
+        self._pool = ThreadPoolExecutor(max_workers=callback_workers)
+        self._running = True
+        if deliver_callbacks:
+            threading.Thread(target=self._deliver_loop, daemon=True).start()
+
+    # ---- Daraja endpoints ----
+    def handle(self, method, path, body=None):
+        """Returns (status_code, json_body, seconds_to_delay_the_response)."""
+        delay = self.latency()
+        route = urlsplit(path).path
+
+        if method == "GET" and route == urlsplit(OAUTH_PATH).path:
+            self._count("oauth")
+            return 200, {"access_token": uuid.uuid4().hex, "expires_in": "3599"}, delay
+
+        if random.random() < self.error_rate:
+            self._count("errors")
+            return 503, {"requestId": uuid.uuid4().hex, "errorCode": "503.001.01", "errorMessage": "Service Unavailable"}, delay
+
+        if method == "POST" and route == STK_PUSH_PATH:
+            self._count("stk_push")
+            return 200, self._accept_push(body or {}), delay
+
+        if method == "POST" and route == STK_QUERY_PATH:
+            self._count("stk_query")
+            return 200, self._query(body or {}), delay
+
+        return 404, {"errorCode": "404.001.01", "errorMessage": "Resource not found"}, delay
+
+    def _accept_push(self, body):
+        push = self._new_push(
+            body.get("Amount"),
+            body.get("PhoneNumber"),
+            body.get("AccountReference"),
+            1032 if random.random() < self.cancel_rate else 0,
+        )
+        checkout_id = push["checkout_id"]
+        with self.lock:
+            self.pushes[checkout_id] = push
+
+        due = time.monotonic() + self.callback_delay()
+        self.schedule_callback(push, due)
+        if random.random() < self.duplicate_rate:
+            # Daraja re-delivers, sometimes long after the first attempt
+            self.schedule_callback(push, due + self.callback_delay())
+
+        return {
+            "MerchantRequestID": push["merchant_id"],
+            "CheckoutRequestID": checkout_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing",
+        }
+
+    def _query(self, body):
+        with self.lock:
+            push = self.pushes.get(body.get("CheckoutRequestID"))
+
+        if push is None:
+            return {"requestId": uuid.uuid4().hex, "errorCode": "400.002.02", "errorMessage": "Bad Request - Invalid CheckoutRequestID"}
+        if not push["done"]:
+            return {"requestId": uuid.uuid4().hex, "errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"}
+        return {
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successsfully",
+            "MerchantRequestID": push["merchant_id"],
+            "CheckoutRequestID": push["checkout_id"],
+            "ResultCode": str(push["result_code"]),
+            "ResultDesc": self._result_desc(push["result_code"]),
+        }
+
+    # ---- callbacks ----
+    def callback_body(self, push):
+        callback = {
+            "MerchantRequestID": push["merchant_id"],
+            "CheckoutRequestID": push["checkout_id"],
+            "ResultCode": push["result_code"],
+            "ResultDesc": self._result_desc(push["result_code"]),
+        }
+        if push["result_code"] == 0:
+            callback["CallbackMetadata"] = {"Item": [
+                {"Name": "Amount", "Value": push["amount"]},
+                {"Name": "MpesaReceiptNumber", "Value": push["receipt"]},
+                {"Name": "TransactionDate", "Value": int(time.strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": push["phone"]},
+                {"Name": "AccountReference", "Value": push["account_reference"]},
+            ]}
+        return {"Body": {"stkCallback": callback}}
+
+    def schedule_callback(self, push, due):
+        if not self.deliver_callbacks:
+            push["done"] = True
+            return
+        with self._queue_ready:
+            heapq.heappush(self._queue, (due, next(self._sequence), push))
+            self._queue_ready.notify()
+
+    def send_callback(self, push):
+        """POST one callback and record how long the app took to acknowledge it."""
+        push["done"] = True
+        start = time.perf_counter()
+        try:
+            response = self._session.post(self.callback_url, json=self.callback_body(push), timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.stats["callbacks"] += 1
+            self.callback_latencies.append(elapsed)
+            if not ok:
+                self.stats["callback_failures"] += 1
+        return ok
+
+    def burst(self, count, account_reference, phone="254700000000", amount=1, concurrency=50, duplicate_rate=None):
+        """
+        Fire `count` successful callbacks (plus duplicates) at the callback URL
+        at once, like a contribution-day spike, and return latency stats.
+        """
+        duplicate_rate = self.duplicate_rate if duplicate_rate is None else duplicate_rate
+        pushes = []
+        for _ in range(count):
+            push = self._new_push(amount, phone, account_reference, 0)
+            pushes.append(push)
+            if random.random() < duplicate_rate:
+                pushes.append(push)
+        random.shuffle(pushes)
+
+        with self.lock:
+            self.callback_latencies = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(self.send_callback, pushes))
+        elapsed = time.perf_counter() - start
+
+        stats = summarize(self.callback_latencies)
+        stats.update({"sent": len(pushes), "failed": results.count(False), "elapsed": elapsed})
+        return stats
+
+    def close(self):
+        with self._queue_ready:
+            self._running = False
+            self._queue_ready.notify()
+        self._pool.shutdown(wait=False)
+
+    def _deliver_loop(self):
+        while True:
+            with self._queue_ready:
+                while self._running and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._queue_ready.wait(timeout)
+                if not self._running:
+                    return
+                _, _, push = heapq.heappop(self._queue)
+            self._pool.submit(self.send_callback, push)
+
+    def _new_push(self, amount, phone, account_reference, result_code):
+        return {
+            "checkout_id": f"ws_CO_{time.strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:10]}",
+            "merchant_id": uuid.uuid4().hex[:20],
+            # random so receipts stay unique across simulator runs
+            "receipt": f"SIM{uuid.uuid4().hex[:7].upper()}",
+            "amount": amount,
+            "phone": phone,
+            "account_reference": account_reference,
+            "result_code": result_code,
+            "done": False,
+        }
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _result_desc(self, result_code):
+        if result_code == 0:
+            return "The service request is processed successfully."
+        return "Request cancelled by user"
+
+
+_simulator = None
+
+def get_simulator():
+    """Process-wide simulator used by the in-process transports below."""
+    global _simulator
+    if _simulator is None:
+        _simulator = DarajaSimulator()
+    return _simulator
+
+
+class SimulatorAdapter(BaseAdapter):
+    """requests adapter answering Daraja calls from the simulator (MPESA_TRANSPORT)."""
+
+    def __init__(self, simulator=None):
+        super().__init__()
+        self.simulator = simulator or get_simulator()
+
+    def send(self, request, **kwargs):
+        body = json.loads(request.body) if request.body else None
+        status, data, delay = self.simulator.handle(request.method, request.path_url, body)
+        time.sleep(delay)
+
+        response = Response()
+        response.status_code = status
+        response.url = request.url
+        response.request = request
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(data).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+class SimulatorTransport(httpx.AsyncBaseTransport):
+    """httpx transport answering Daraja calls from the simulator (MPESA_ASYNC_TRANSPORT)."""
+
+    def __init__(self, simulator=None):
+        self.simulator = simulator or get_simulator()
+
+    async def handle_async_request(self, request):
+        content = await request.aread()
+        body = json.loads(content) if content else None
+        path = request.url.raw_path.decode()
+        status, data, delay = self.simulator.handle(request.method, path, body)
+        await asyncio.sleep(delay)
+        return httpx.Response(status, json=data, request=request)
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # callback bursts and benchmarks open many connections at once
+    request_queue_size = 1024
+
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    simulator = None
+
+    def do_GET(self):
+        self._answer(None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self._answer(json.loads(self.rfile.read(length) or b"{}"))
+
+    def _answer(self, body):
+        status, data, delay = self.simulator.handle(self.command, self.path, body)
+        time.sleep(delay)
+
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(simulator, host="127.0.0.1", port=0):
+    """Start the simulator over real HTTP in a background thread and return the server."""
+    handler = type("BoundSimulatorRequestHandler", (SimulatorRequestHandler,), {"simulator": simulator})
+    server = SimulatorServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
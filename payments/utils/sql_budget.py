@@ -0,0 +1,143 @@
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.urls import URLResolver, get_resolver
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """Queries run while recording: count, total time and how often each statement repeated."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # a connection execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.count += 1
+            self.statements[sql] += 1
+
+    @property
+    def duplicates(self):
+        """SQL run more than once (with any parameters): {sql: times}, most repeated first. N+1 loops show up here."""
+        return {sql: n for sql, n in self.statements.most_common() if n > 1}
+
+    def summary(self):
+        return f"{self.count} queries in {self.time * 1000:.1f} ms, {sum(self.duplicates.values())} repeated"
+
+
+@contextmanager
+def record_queries():
+    """Records every query on every database connection inside the block: `with record_queries() as stats:`."""
+    stats = QueryStats()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+_budgets = None
+
+def query_budgets():
+    """
+    {url name: max queries}, gathered from the QUERY_BUDGETS dict of each
+    URLconf included by the root one (app/urls.py, payments/urls.py).
+    """
+    global _budgets
+    if _budgets is None:
+        _budgets = {}
+        for pattern in get_resolver().url_patterns:
+            if isinstance(pattern, URLResolver):
+                _budgets.update(getattr(pattern.urlconf_module, "QUERY_BUDGETS", {}))
+    return _budgets
+
+
+def budget_for(url_name):
+    return query_budgets().get(url_name)
+
+
+@contextmanager
+def query_budget(budget):
+    """
+    Test helper: fails if the block runs more queries than `budget` (a
+    number or a URL name from QUERY_BUDGETS), listing the repeated SQL.
+
+        with query_budget('dashboard'):
+            self.client.get(reverse('dashboard'))
+    """
+    label, limit = (budget, budget_for(budget)) if isinstance(budget, str) else ("block", budget)
+    with record_queries() as stats:
+        yield stats
+    if limit is not None and stats.count > limit:
+        repeated = "".join(f"\n  {n}x {sql}" for sql, n in stats.duplicates.items())
+        raise AssertionError(f"{label}: {stats.summary()}, budget {limit}{repeated}")
+
+
+class SQLBudgetMiddleware:
+    """
+    Counts the queries each request makes and reports them against the URL
+    name's budget: a Server-Timing/X-SQL-Queries header and/or a log line,
+    per SQL_BUDGET_REPORT. With SQL_BUDGET_ENABLED off, Django drops the
+    middleware at startup, so it costs nothing. Queries a streaming
+    response makes while streaming aren't counted.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.SQL_BUDGET_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with record_queries() as stats:
+            response = self.get_response(request)
+        self.report(request, response, stats)
+        return response
+
+    async def __acall__(self, request):
+        with record_queries() as stats:
+            response = await self.get_response(request)
+        self.report(request, response, stats)
+        return response
+
+    def report(self, request, response, stats):
+        match = getattr(request, "resolver_match", None)
+        url_name = match.url_name if match else None
+        budget = budget_for(url_name)
+        over = budget is not None and stats.count > budget
+        # for tests and anything else holding the response
+        response.sql_stats = stats
+
+        if settings.SQL_BUDGET_REPORT in ("header", "both"):
+            response["X-SQL-Queries"] = f"{stats.count}" + (f"/{budget}" if budget is not None else "")
+            response["Server-Timing"] = f'db;dur={stats.time * 1000:.1f};desc="{stats.count} queries"'
+        if settings.SQL_BUDGET_REPORT in ("log", "both") or over:
+            line = f"[sql] {request.method} {request.path} ({url_name or '-'}): {stats.summary()}"
+            if budget is not None:
+                line += f", budget {budget}"
+            if over:
+                line += " -- OVER BUDGET"
+                top = next(iter(stats.duplicates.items()), None)
+                if top:
+                    line += f"; most repeated ({top[1]}x): {top[0][:200]}"
+            logger.log(logging.WARNING if over else logging.INFO, line)
@@ -0,0 +1,224 @@
+import re
+import zlib
+from datetime import timedelta
+from decimal import Decimal
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from django.utils import timezone
+
+from payments.models import Transaction
+from payments.utils.periods import balance_at, ledger_start, month_bounds, next_month
+
+WIDTH, HEIGHT = A4
+MARGIN = 40
+ROW_HEIGHT = 14
+
+# (header, x, right-aligned)
+COLUMNS = [
+    ("Date", MARGIN, False),
+    ("Reference", 118, False),
+    ("Type", 200, False),
+    ("Member / initiator", 262, False),
+    ("Money in", 420, True),
+    ("Money out", 488, True),
+    ("Balance", WIDTH - MARGIN, True),
+]
+
+FONTS = {"F1": "Helvetica", "F2": "Helvetica-Bold"}
+
+
+class PDFStreamWriter:
+    """
+    Writes a PDF as a sequence of byte chunks, one page at a time, so a
+    document of any length is produced in bounded memory. Only object
+    offsets and page ids are kept until the cross-reference table is written
+    at the end; the page tree comes last, which PDF readers allow.
+    """
+
+    CATALOG, PAGES, INFO = 1, 2, 3
+
+    def __init__(self):
+        self.offset = 0
+        self.offsets = {}
+        self.pages = []
+        self.fonts = {}
+        self.next_id = 4
+
+    def _object(self, obj_id, body):
+        data = b"%d 0 obj\n%s\nendobj\n" % (obj_id, body)
+        self.offsets[obj_id] = self.offset
+        self.offset += len(data)
+        return data
+
+    def _new_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def start(self, title):
+        chunks = [b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"]
+        self.offset = len(chunks[0])
+        for name, base_font in FONTS.items():
+            self.fonts[name] = self._new_id()
+            chunks.append(self._object(
+                self.fonts[name],
+                b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>" % base_font.encode(),
+            ))
+        chunks.append(self._object(
+            self.INFO, b"<< /Title (%s) /Producer (Chama App) >>" % _pdf_string(title),
+        ))
+        return b"".join(chunks)
+
+    def page(self, content):
+        stream = zlib.compress(content)
+        content_id, page_id = self._new_id(), self._new_id()
+        self.pages.append(page_id)
+        fonts = b" ".join(b"/%s %d 0 R" % (name.encode(), obj_id) for name, obj_id in self.fonts.items())
+        return self._object(
+            content_id,
+            b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" % (len(stream), stream),
+        ) + self._object(
+            page_id,
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] /Contents %d 0 R /Resources << /Font << %s >> >> >>"
+            % (self.PAGES, _num(WIDTH), _num(HEIGHT), content_id, fonts),
+        )
+
+    def finish(self):
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.pages)
+        chunks = [
+            self._object(self.PAGES, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages))),
+            self._object(self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES),
+        ]
+        size = self.next_id
+        xref = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        xref += [b"%010d 00000 n \n" % self.offsets[obj_id] for obj_id in range(1, size)]
+        chunks += xref
+        chunks.append(
+            b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (size, self.CATALOG, self.INFO, self.offset)
+        )
+        return b"".join(chunks)
+
+
+def _pdf_string(text):
+    # the standard fonts use WinAnsi (cp1252); anything outside it prints as "?"
+    data = text.encode("cp1252", "replace").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+    # a raw CR or LF inside a string is read back as a newline, and other
+    # control bytes trip up some viewers; octal escapes keep them literal
+    return re.sub(rb"[\x00-\x1f\x7f]", lambda m: b"\\%03o" % m.group()[0], data)
+
+
+def _num(value):
+    # reportlab's fp_str is pure Python without its C extension and
+    # dominated statement time; two decimals is plenty for text positions
+    return b"%.2f" % value
+
+
+class _Page:
+    def __init__(self):
+        self.ops = []
+
+    def text(self, x, y, text, font="F1", size=9, right=False):
+        if not text:
+            return
+        if right:
+            x -= stringWidth(text, FONTS[font], size)
+        self.ops.append(b"BT /%s %s Tf %s %s Td (%s) Tj ET" % (
+            font.encode(), _num(size), _num(x), _num(y), _pdf_string(text),
+        ))
+
+    def line(self, x1, y1, x2, y2):
+        self.ops.append(b"%s %s m %s %s l S" % tuple(_num(v) for v in (x1, y1, x2, y2)))
+
+    def content(self):
+        return b"\n".join(self.ops)
+
+
+def _money(amount):
+    return f"{amount:,.2f}"
+
+
+def statement_chunks(chama, month):
+    """
+    Yields a chama's statement for `month` as PDF byte chunks, roughly one
+    page each: opening balance, every transaction with a running balance,
+    totals and closing balance. Transactions are read through a database
+    cursor, so memory stays flat however many there are.
+    """
+    start, end = month_bounds(month)
+    title = f"{chama.name} statement, {month:%B %Y}"
+    writer = PDFStreamWriter()
+    yield writer.start(title)
+
+    # the month the ledger starts in opens at nothing; raises BeforeLedgerStart for earlier months
+    begins = ledger_start(chama.id)
+    opening = balance_at(chama.id, max(start, begins) if begins and begins < end else start)
+    balance = opening
+    money_in = money_out = Decimal("0")
+    page_number = 0
+
+    def new_page():
+        nonlocal page_number
+        page_number += 1
+        page = _Page()
+        page.text(MARGIN, HEIGHT - MARGIN, title, font="F2", size=14)
+        page.text(MARGIN, HEIGHT - MARGIN - 16, f"Account {chama.account_number or '-'}", size=9)
+        page.text(WIDTH - MARGIN, HEIGHT - MARGIN - 16, f"Page {page_number}", size=9, right=True)
+        y = HEIGHT - MARGIN - 44
+        for header, x, right in COLUMNS:
+            page.text(x, y, header, font="F2", right=right)
+        page.line(MARGIN, y - 4, WIDTH - MARGIN, y - 4)
+        return page, y - ROW_HEIGHT - 4
+
+    page, y = new_page()
+    page.text(MARGIN, y, f"Opening balance on {month:%d %b %Y}", font="F2")
+    page.text(WIDTH - MARGIN, y, _money(opening), font="F2", right=True)
+    y -= ROW_HEIGHT
+
+    rows = (
+        Transaction.objects.filter(chama=chama, timestamp__gte=start, timestamp__lt=end)
+        .order_by("timestamp", "id")
+        .values_list("timestamp", "mpesa_code", "transaction_type", "amount", "initiated_by", "member__user__username")
+        .iterator(chunk_size=500)
+    )
+    for timestamp, code, kind, amount, initiated_by, username in rows:
+        if y < MARGIN + ROW_HEIGHT:
+            yield writer.page(page.content())
+            page, y = new_page()
+
+        deposit = kind == "deposit"
+        if deposit:
+            balance += amount
+            money_in += amount
+        else:
+            balance -= amount
+            money_out += amount
+
+        page.text(MARGIN, y, timezone.localtime(timestamp).strftime("%d %b %H:%M"))
+        page.text(118, y, code[:14])
+        page.text(200, y, kind.capitalize())
+        page.text(262, y, (username or initiated_by or "")[:26])
+        page.text(420, y, _money(amount) if deposit else "", right=True)
+        page.text(488, y, "" if deposit else _money(amount), right=True)
+        page.text(WIDTH - MARGIN, y, _money(balance), right=True)
+        y -= ROW_HEIGHT
+
+    # the closing balance comes from the ledger; anything the transactions
+    # don't explain (e.g. opening balances) shows as an adjustment
+    closing = balance_at(chama.id, min(end, timezone.now()))
+    summary = [("Total money in", money_in), ("Total money out", money_out)]
+    if closing != balance:
+        summary.append(("Adjustments", closing - balance))
+    summary.append((f"Closing balance on {next_month(month) - timedelta(days=1):%d %b %Y}", closing))
+
+    if y < MARGIN + ROW_HEIGHT * (len(summary) + 1):
+        yield writer.page(page.content())
+        page, y = new_page()
+    page.line(MARGIN, y + ROW_HEIGHT - 4, WIDTH - MARGIN, y + ROW_HEIGHT - 4)
+    for label, amount in summary:
+        page.text(MARGIN, y, label, font="F2")
+        page.text(WIDTH - MARGIN, y, _money(amount), font="F2", right=True)
+        y -= ROW_HEIGHT
+
+    yield writer.page(page.content())
+    yield writer.finish()
@@ -0,0 +1,138 @@
+import asyncio
+import math
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+
+from payments.models import Transaction
+
+STARTED_KEY = "mpesa:stk_started:{}"
+RESULT_KEY = "mpesa:stk_result:{}"
+QUERY_LOCK_KEY = "mpesa:stk_query_lock:{}"
+
+# cached long enough for any pending page still open on the request
+FINAL_RESULT_TIMEOUT = 60 * 60 * 24
+
+PENDING = {"ResultDesc": "Waiting for confirmation"}
+
+# polls for the same CheckoutRequestID in this process share one query
+_inflight = weakref.WeakKeyDictionary()
+
+# long-poll waiters: CheckoutRequestID -> {(loop, event)}
+_waiters = {}
+
+
+def mark_started(checkout_request_id):
+    cache.set(STARTED_KEY.format(checkout_request_id), time.time(), FINAL_RESULT_TIMEOUT)
+
+async def amark_started(checkout_request_id):
+    await cache.aset(STARTED_KEY.format(checkout_request_id), time.time(), FINAL_RESULT_TIMEOUT)
+
+def remember_result(checkout_request_id, result_code, result_desc):
+    """Store a final STK result (e.g. from the callback) so polls never reach Daraja."""
+    cache.set(RESULT_KEY.format(checkout_request_id), {
+        "ResultCode": str(result_code),
+        "ResultDesc": result_desc,
+    }, FINAL_RESULT_TIMEOUT)
+
+async def aremember_result(checkout_request_id, result_code, result_desc):
+    await cache.aset(RESULT_KEY.format(checkout_request_id), {
+        "ResultCode": str(result_code),
+        "ResultDesc": result_desc,
+    }, FINAL_RESULT_TIMEOUT)
+
+
+async def resolve_stk_status(checkout_request_id, query):
+    """
+    Status for the pending page, cheapest source first: the Transaction
+    written by the callback, then the cache, and only once the grace period
+    has passed, Daraja itself via `query` (an async callable).
+    """
+    if await Transaction.objects.filter(checkout_id=checkout_request_id).aexists():
+        return {"ResultCode": "0", "ResultDesc": "Payment successful"}
+
+    result = await cache.aget(RESULT_KEY.format(checkout_request_id))
+    if result:
+        return result
+
+    started = await cache.aget(STARTED_KEY.format(checkout_request_id))
+    if started and time.time() - started < settings.MPESA_STATUS_GRACE_PERIOD:
+        return PENDING
+
+    return await _single_flight_query(checkout_request_id, query)
+
+
+async def _single_flight_query(checkout_request_id, query):
+    inflight = _inflight.setdefault(asyncio.get_running_loop(), {})
+    task = inflight.get(checkout_request_id)
+    if task is None:
+        task = asyncio.ensure_future(_query_once(checkout_request_id, query))
+        inflight[checkout_request_id] = task
+        task.add_done_callback(lambda _: inflight.pop(checkout_request_id, None))
+    return await asyncio.shield(task)
+
+
+async def _query_once(checkout_request_id, query):
+    # across workers: one query per CheckoutRequestID per interval
+    if not await cache.aadd(QUERY_LOCK_KEY.format(checkout_request_id), 1, settings.MPESA_STATUS_QUERY_INTERVAL):
+        return await cache.aget(RESULT_KEY.format(checkout_request_id)) or PENDING
+
+    status = await query(checkout_request_id)
+
+    # a ResultCode means Daraja has a final answer; "still processing" and
+    # errors come back as errorCode and are retried after the interval
+    if "ResultCode" in status:
+        await aremember_result(checkout_request_id, status["ResultCode"], status.get("ResultDesc", ""))
+        return status
+
+    if "error" in status:
+        return status
+    return PENDING
+
+
+def is_final(status):
+    return "ResultCode" in status or "error" in status
+
+
+def notify_stk_result(checkout_request_id):
+    """Wake every long-poll waiter in this process for this CheckoutRequestID."""
+    for loop, event in list(_waiters.get(checkout_request_id, ())):
+        # the callback may be running on another thread/loop than the waiter
+        loop.call_soon_threadsafe(event.set)
+
+
+async def wait_for_stk_status(checkout_request_id, query, timeout):
+    """
+    Long-poll: return as soon as the STK push has a final status, or the
+    pending status once `timeout` seconds pass. A callback handled by this
+    process wakes the waiter immediately; one handled by another worker is
+    picked up at the next recheck, so idle waiters cost a cheap read every
+    MPESA_STATUS_RECHECK_INTERVAL seconds.
+    """
+    if not math.isfinite(timeout) or timeout < 0:
+        raise ValueError(f"Invalid long-poll timeout: {timeout!r}")
+
+    deadline = time.monotonic() + timeout
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    _waiters.setdefault(checkout_request_id, set()).add(waiter)
+
+    try:
+        while True:
+            waiter[1].clear()
+            status = await resolve_stk_status(checkout_request_id, query)
+            remaining = deadline - time.monotonic()
+            if is_final(status) or remaining <= 0:
+                return status
+
+            try:
+                await asyncio.wait_for(waiter[1].wait(), min(remaining, settings.MPESA_STATUS_RECHECK_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        waiters = _waiters.get(checkout_request_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                _waiters.pop(checkout_request_id, None)
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from payments.utils import counters
+
+TOKEN_CACHE_KEY = "mpesa:access_token"
+TOKEN_LOCK_KEY = "mpesa:access_token:lock"
+TOKEN_STATS_KEYS = {
+    "hits": "mpesa:access_token:hits",
+    "misses": "mpesa:access_token:misses",
+    "refreshes": "mpesa:access_token:refreshes",
+}
+
+
+class AccessTokenProvider:
+    """
+    Hands out the Daraja OAuth token from the shared cache and refreshes it
+    shortly before `expires_in` runs out. Only one caller (across all
+    workers) refreshes at a time; the others wait for the new token.
+    """
+
+    def __init__(self, fetch_token, token_cache=None, refresh_margin=None, lock_timeout=None, afetch_token=None):
+        # fetch_token() must return (access_token, expires_in_seconds);
+        # afetch_token is its coroutine twin used by aget_token()
+        self.fetch_token = fetch_token
+        self.afetch_token = afetch_token
+        self.cache = token_cache or cache
+        self.refresh_margin = settings.MPESA_TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        self.lock_timeout = settings.MPESA_TOKEN_LOCK_TIMEOUT if lock_timeout is None else lock_timeout
+
+    def get_token(self):
+        token = self.cache.get(TOKEN_CACHE_KEY)
+        if token:
+            self._count("hits")
+            return token
+
+        self._count("misses")
+
+        # only the caller that wins the lock talks to Daraja
+        if self.cache.add(TOKEN_LOCK_KEY, 1, self.lock_timeout):
+            try:
+                return self._refresh()
+            finally:
+                self.cache.delete(TOKEN_LOCK_KEY)
+
+        # someone else is refreshing, wait for their token
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            token = self.cache.get(TOKEN_CACHE_KEY)
+            if token:
+                return token
+
+        # the refreshing worker died or failed, don't block the payment on it
+        return self._refresh()
+
+    async def aget_token(self):
+        token = await self.cache.aget(TOKEN_CACHE_KEY)
+        if token:
+            await self._acount("hits")
+            return token
+
+        await self._acount("misses")
+
+        if await self.cache.aadd(TOKEN_LOCK_KEY, 1, self.lock_timeout):
+            try:
+                return await self._arefresh()
+            finally:
+                await self.cache.adelete(TOKEN_LOCK_KEY)
+
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            token = await self.cache.aget(TOKEN_CACHE_KEY)
+            if token:
+                return token
+
+        return await self._arefresh()
+
+    def invalidate(self):
+        self.cache.delete(TOKEN_CACHE_KEY)
+
+    async def ainvalidate(self):
+        await self.cache.adelete(TOKEN_CACHE_KEY)
+
+    def stats(self):
+        return counters.read(TOKEN_STATS_KEYS)
+
+    def reset_stats(self):
+        counters.reset(TOKEN_STATS_KEYS)
+
+    def _refresh(self):
+        token, expires_in = self.fetch_token()
+        self._count("refreshes")
+
+        timeout = int(expires_in) - self.refresh_margin
+        if timeout > 0:
+            self.cache.set(TOKEN_CACHE_KEY, token, timeout)
+        return token
+
+    async def _arefresh(self):
+        token, expires_in = await self.afetch_token()
+        await self._acount("refreshes")
+
+        timeout = int(expires_in) - self.refresh_margin
+        if timeout > 0:
+            await self.cache.aset(TOKEN_CACHE_KEY, token, timeout)
+        return token
+
+    async def _acount(self, name):
+        await counters.aincr(TOKEN_STATS_KEYS[name])
+
+    def _count(self, name):
+        counters.incr(TOKEN_STATS_KEYS[name])
@@ -1,47 +1,117 @@
-import requests, base64, json, re, os
+import json, math, re
 from datetime import datetime
 from django.shortcuts import render, redirect
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse, HttpResponseBadRequest
-from .models import Transaction, AuditLog
+from .models import Transaction, AuditLog, PendingPayment, CallbackSpool
 from .forms import PaymentForm
 from dotenv import load_dotenv
 from django.conf import settings
 from django.utils.timezone import make_aware
-from decimal import Decimal
 import uuid
-from django.db import transaction
-from django.http import FileResponse, Http404
-
-from payments.utils.receipts import generate_transaction_receipt
-
-from app.models import Chama, Member, Contribution, CustomUser, VirtualAccount
+from django.db import transaction, IntegrityError
+from django.http import HttpResponse, HttpResponseRedirect, Http404, StreamingHttpResponse
+from django.contrib.auth.decorators import login_required
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+from payments.utils.receipts import ensure_receipt, get_receipt_pdf, receipt_etag, render_receipt
+from payments.utils.receipt_storage import get_receipt_storage
+from payments.utils.statements import statement_chunks
+from payments.utils.periods import ledger_start, month_bounds
+from payments.utils.jobs import enqueue
+from payments.utils.daraja import DarajaError, get_client, get_async_client
+from payments.utils import counters
+from payments.utils.ledger import post_transactions
+from payments.utils.chama_stats import record_transactions
+from payments.utils.callbacks import CALLBACK_STATS_KEYS, ais_duplicate_callback, parse_stk_callback
+from payments.utils.stk_status import (
+    amark_started, aremember_result, notify_stk_result, resolve_stk_status, wait_for_stk_status,
+)
+from asgiref.sync import sync_to_async
+
+from app.models import Chama, Member, Contribution
 
 # Load environment variables
 load_dotenv()
 
-# Retrieve variables from the environment
-CONSUMER_KEY = settings.CONSUMER_KEY
-CONSUMER_SECRET = settings.CONSUMER_SECRET
-MPESA_PASSKEY = settings.MPESA_PASSKEY
-
-MPESA_SHORTCODE = settings.MPESA_SHORTCODE
-CALLBACK_URL = settings.CALLBACK_URL
-MPESA_BASE_URL = settings.MPESA_BASE_URL
+# templates touch request.user (session + DB), so async views render in a thread
+arender = sync_to_async(render)
 
 # write your views here
 def download_receipt(request, transaction_id):
     try:
-        transaction = Transaction.objects.get(id=transaction_id)
+        transaction = Transaction.objects.select_related("member__user").get(id=transaction_id)
     except Transaction.DoesNotExist:
         raise Http404("Transaction not found.")
-    
-    file_path = os.path.join(settings.MEDIA_ROOT, f"receipts/receipt_{transaction.mpesa_code}.pdf")
 
-    if not os.path.exists(file_path):
-        generate_transaction_receipt(transaction)
-    
-    return FileResponse(open(file_path, 'rb'), content_type = 'application/pdf')
+    # receipts never change once recorded, so a matching ETag is a 304
+    # without rendering or reading anything
+    etag = quote_etag(receipt_etag(transaction))
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified["ETag"] = etag
+        return not_modified
+
+    mode = settings.RECEIPT_SERVE_MODE
+    if mode == "django":
+        response = HttpResponse(get_receipt_pdf(transaction, etag), content_type='application/pdf')
+    else:
+        # the front proxy (or the object store) streams the stored file,
+        # so no Python worker is tied up sending bytes
+        name = ensure_receipt(transaction)
+        if mode == "redirect":
+            response = HttpResponseRedirect(get_receipt_storage().url(name))
+        else:
+            response = HttpResponse(content_type='application/pdf')
+            if mode == "x-accel-redirect":
+                response["X-Accel-Redirect"] = f"{settings.RECEIPT_ACCEL_PREFIX}{name}"
+            elif mode == "x-sendfile":
+                response["X-Sendfile"] = get_receipt_storage().path(name)
+            else:
+                raise ValueError(f"Unknown RECEIPT_SERVE_MODE: {mode}")
+
+    response["ETag"] = etag
+    response["Content-Disposition"] = f'inline; filename="receipt_{transaction.mpesa_code}.pdf"'
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@login_required
+async def chama_statement(request, chama_id, year, month):
+    # next_month() of December 9999 is past what a date can hold
+    if not 1 <= year <= 9998 or not 1 <= month <= 12:
+        raise Http404("Statement not found.")
+    chama = await Chama.objects.filter(id=chama_id).afirst()
+    if chama is None:
+        raise Http404("Statement not found.")
+    user = await request.auser()
+    if not await Member.objects.filter(user=user, chama=chama).aexists():
+        return redirect('dashboard')
+
+    # a month that ended before the ledger began has no balance to show
+    statement_month = datetime(year, month, 1).date()
+    begins = await sync_to_async(ledger_start)(chama.id)
+    if begins is not None and month_bounds(statement_month)[1] <= begins:
+        raise Http404("Statement not found.")
+
+    # the PDF is built page by page from a DB cursor as the client reads it;
+    # each page is produced in a worker thread so the event loop stays free
+    chunks = statement_chunks(chama, statement_month)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+
+    async def stream():
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    response = StreamingHttpResponse(stream(), content_type='application/pdf')
+    response["Content-Disposition"] = f'attachment; filename="statement_{chama.id}_{year}-{month:02d}.pdf"'
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 # Phone number formatting and validation
@@ -54,69 +124,41 @@ def format_phone_number(phone):
     else:
         raise ValueError("Invalid phone number format")
 
-# Generate M-Pesa access token
+# Get a (cached) M-Pesa access token
 def generate_access_token():
-    try:
-        credentials = f"{CONSUMER_KEY}:{CONSUMER_SECRET}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-
-        headers = {
-            "Authorization": f"Basic {encoded_credentials}",
-            "Content-Type": "application/json",
-        }
-        response = requests.get(
-            f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
-            headers=headers,
-        ).json()
-
-        if "access_token" in response:
-            return response["access_token"]
-        else:
-            raise Exception("Access token missing in response.")
-
-    except requests.RequestException as e:
-        raise Exception(f"Failed to connect to M-Pesa: {str(e)}")
+    return get_client().access_token()
 
 # Initiate STK Push and handle response
 def initiate_stk_push(phone, amount, chama):
     try:
-        token = generate_access_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        stk_password = base64.b64encode(
-            (MPESA_SHORTCODE + MPESA_PASSKEY + timestamp).encode()
-        ).decode()
-
-        request_body = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": stk_password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",  # Paybill
-            "Amount": amount,
-            "PartyA": phone,
-            "PartyB": MPESA_SHORTCODE,
-            "PhoneNumber": phone,
-            "CallBackURL": CALLBACK_URL,
-            "AccountReference": chama.account_number,  # dynamic account number per chama
-            "TransactionDesc": f"Contribution to {chama.name}",
-        }
-
-        response = requests.post(
-            f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest",
-            json=request_body,
-            headers=headers,
-        ).json()
+        return get_client().stk_push(
+            phone,
+            amount,
+            account_reference=chama.account_number,  # dynamic account number per chama
+            description=f"Contribution to {chama.name}",
+        )
 
-        return response
+    except Exception as e:
+        print(f"Failed to initiate STK Push: {str(e)}")
+        return {"errorMessage": str(e)}
+
+# Async twin of initiate_stk_push used by the payment view
+async def ainitiate_stk_push(phone, amount, chama):
+    try:
+        return await get_async_client().stk_push(
+            phone,
+            amount,
+            account_reference=chama.account_number,
+            description=f"Contribution to {chama.name}",
+        )
 
     except Exception as e:
         print(f"Failed to initiate STK Push: {str(e)}")
-        return e
+        return {"errorMessage": str(e)}
 
-# Payment View
-def payment_view(request, chama_id):
-    chama = Chama.objects.get(id=chama_id) # get chama
+# Payment View (async, so a slow STK push doesn't hold a worker)
+async def payment_view(request, chama_id):
+    chama = await Chama.objects.aget(id=chama_id) # get chama
     if request.method == "POST":
         form = PaymentForm(request.POST)
         if form.is_valid():
@@ -125,73 +167,80 @@ def payment_view(request, chama_id):
                 amount = form.cleaned_data["amount"]
 
                 # use chama’s account number
-                response = initiate_stk_push(phone, amount, chama)
+                response = await ainitiate_stk_push(phone, amount, chama)
                 print(response)
 
                 if response.get("ResponseCode") == "0":
                     checkout_request_id = response["CheckoutRequestID"]
-                    return render(
+                    # recorded so a lost callback can be reconciled later
+                    await PendingPayment.objects.acreate(
+                        chama=chama,
+                        checkout_request_id=checkout_request_id,
+                        merchant_request_id=response.get("MerchantRequestID", ""),
+                        phone_number=phone,
+                        amount=amount,
+                    )
+                    # status polls are answered locally until the grace period ends
+                    await amark_started(checkout_request_id)
+                    # a held long-poll only frees the worker under ASGI; a
+                    # sync worker would be tied up for the whole wait
+                    return await arender(
                         request,
                         "payments/pending.html",
-                        {"checkout_request_id": checkout_request_id, "chama": chama},
+                        {
+                            "checkout_request_id": checkout_request_id,
+                            "chama": chama,
+                            "long_poll": isinstance(request, ASGIRequest),
+                        },
                     )
                 else:
                     error_message = response.get("errorMessage", "Failed to send STK push. Please try again.")
-                    return render(request, "payments/payment_form.html", {"form": form, "error_message": error_message, "chama": chama})
+                    return await arender(request, "payments/payment_form.html", {"form": form, "error_message": error_message, "chama": chama})
 
             except ValueError as e:
-                return render(request, "payments/payment_form.html", {"form": form, "error_message": str(e), "chama": chama})
+                return await arender(request, "payments/payment_form.html", {"form": form, "error_message": str(e), "chama": chama})
             except Exception as e:
-                return render(request, "payments/payment_form.html", {"form": form, "error_message": f"An unexpected error occurred: {str(e)}", "chama": chama})
+                return await arender(request, "payments/payment_form.html", {"form": form, "error_message": f"An unexpected error occurred: {str(e)}", "chama": chama})
 
     else:
         form = PaymentForm()
 
-    return render(request, "payments/payment_form.html", {"form": form, "chama": chama})
+    return await arender(request, "payments/payment_form.html", {"form": form, "chama": chama})
 
 
 # Query STK Push status
 def query_stk_push(checkout_request_id):
     print("Quering...")
     try:
-        token = generate_access_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password = base64.b64encode(
-            (MPESA_SHORTCODE + MPESA_PASSKEY + timestamp).encode()
-        ).decode()
-
-        request_body = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id
-        }
-
-        response = requests.post(
-            f"{MPESA_BASE_URL}/mpesa/stkpushquery/v1/query",
-            json=request_body,
-            headers=headers,
-        )
-        print(response.json())
-        return response.json()
+        response = get_client().stk_query(checkout_request_id)
+        print(response)
+        return response
 
-    except requests.RequestException as e:
+    except DarajaError as e:
+        print(f"Error querying STK status: {str(e)}")
+        return {"error": str(e)}
+
+# Async twin of query_stk_push
+async def aquery_stk_push(checkout_request_id):
+    try:
+        return await get_async_client().stk_query(checkout_request_id)
+
+    except DarajaError as e:
         print(f"Error querying STK status: {str(e)}")
         return {"error": str(e)}
 
 # View to query the STK status and return it to the frontend
-def stk_status_view(request):
+async def stk_status_view(request):
     if request.method == 'POST':
         try:
             # Parse the JSON body
             data = json.loads(request.body)
             checkout_request_id = data.get('checkout_request_id')
-            print("CheckoutRequestID:", checkout_request_id)
+            if not checkout_request_id:
+                return JsonResponse({"error": "checkout_request_id is required"}, status=400)
 
-            # Query the STK push status using your backend function
-            status = query_stk_push(checkout_request_id)
+            # DB and cache first, Daraja (one query for all pollers) only when still unknown
+            status = await resolve_stk_status(checkout_request_id, aquery_stk_push)
 
             # Return the status as a JSON response
             return JsonResponse({"status": status})
@@ -200,62 +249,110 @@ def stk_status_view(request):
 
     return JsonResponse({"error": "Invalid request method"}, status=405)
 
+# Long-poll: held open until the callback records the result (or the timeout passes)
+async def stk_status_wait(request, checkout_request_id):
+    if request.method != 'GET':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
+    try:
+        timeout = float(request.GET.get('timeout', settings.MPESA_STATUS_WAIT_TIMEOUT))
+    except ValueError:
+        return JsonResponse({"error": "Invalid timeout"}, status=400)
+    # min() passes NaN straight through, which would never time out
+    if not math.isfinite(timeout) or timeout < 0:
+        return JsonResponse({"error": "Invalid timeout"}, status=400)
+    timeout = min(timeout, settings.MPESA_STATUS_WAIT_TIMEOUT)
+
+    status = await wait_for_stk_status(checkout_request_id, aquery_stk_push, timeout)
+    return JsonResponse({"status": status})
+
+# Record a confirmed M-Pesa deposit and credit the chama account
+def record_deposit(chama, member, amount, checkout_id, mpesa_code, phone):
+    with transaction.atomic():
+        # Record transaction
+        txn = Transaction.objects.create(
+            chama=chama,
+            member=member if member else None,
+            initiated_by=member.user.username if member else "phone",
+            amount=amount,
+            checkout_id=checkout_id,
+            mpesa_code=mpesa_code,
+            phone_number=phone,
+            status="Success",
+            transaction_type="deposit",
+        )
+
+        PendingPayment.objects.filter(checkout_request_id=checkout_id).update(
+            status="success", result_code="0", result_desc="Payment successful",
+        )
+
+        # the receipt is rendered by a worker; the job commits with the deposit
+        enqueue(render_receipt, transaction_id=txn.id)
+
+        # journal entry + in-database balance increment, then the chama's
+        # running totals: the hot rows last, so they're locked as briefly as possible
+        post_transactions([txn])
+        record_transactions([txn])
+
+    return txn
+
 @csrf_exempt
-def payment_callback(request):
+async def payment_callback(request):
     print("Received callback:", request.body)
     if request.method != "POST":
         return HttpResponseBadRequest("Only POST requests are allowed")
 
     try:
         callback_data = json.loads(request.body)
-        result_code = callback_data["Body"]["stkCallback"]["ResultCode"]
+
+        # spool mode: store the raw callback and ACK, drain_callback_spool applies it
+        if settings.MPESA_CALLBACK_MODE == "spool":
+            try:
+                checkout_id = str(callback_data["Body"]["stkCallback"]["CheckoutRequestID"])[:100]
+            except (KeyError, TypeError):
+                checkout_id = ""  # rejected when drained
+            await CallbackSpool.objects.acreate(body=request.body.decode(), checkout_request_id=checkout_id)
+            return JsonResponse({"ResultCode": 0, "ResultDesc": "Accepted"})
+
+        callback = parse_stk_callback(callback_data)
+        checkout_id = callback["checkout_id"]
+        result_code = callback["result_code"]
 
         # Only process successful payments
         if result_code == 0:
-            stk_data = callback_data["Body"]["stkCallback"]
-            checkout_id = stk_data["CheckoutRequestID"]
-            metadata = stk_data["CallbackMetadata"]["Item"]
-
-            amount = Decimal(next(item["Value"] for item in metadata if item["Name"] == "Amount"))
-            mpesa_code = next(item["Value"] for item in metadata if item["Name"] == "MpesaReceiptNumber")
-            phone = next(item["Value"] for item in metadata if item["Name"] == "PhoneNumber")
-            account_ref = next(item["Value"] for item in metadata if item["Name"] == "AccountReference")
+            # Daraja re-delivers callbacks: answer replays like the original
+            if await ais_duplicate_callback(checkout_id, callback["mpesa_code"]):
+                return JsonResponse({"ResultCode": 0, "ResultDesc": "Payment successful"})
 
             # Get chama using the account reference
             try:
-                chama = Chama.objects.get(account_number=account_ref)
+                chama = await Chama.objects.aget(account_number=callback["account_ref"])
             except Chama.DoesNotExist:
                 return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid account reference"})
 
             # Find member (optional)
-            member = Member.objects.filter(chama=chama, user__phone_number=phone).first()
-
-            with transaction.atomic():
-                # Record transaction
-                txn = Transaction.objects.create(
-                    chama=chama,
-                    member=member if member else None,
-                    initiated_by=member.user.username if member else "phone",
-                    amount=amount,
-                    checkout_id=checkout_id,
-                    mpesa_code=mpesa_code,
-                    phone_number=phone,
-                    status="Success",
-                    transaction_type="deposit",
-                )
-
-                # Access chama’s one-to-one virtual account
-                account = chama.virtual_accounts
-                account.balance += amount
-                account.save()
+            member = await Member.objects.select_related("user").filter(chama=chama, user__phone_number=callback["phone"]).afirst()
 
-                # generate receipt immediately after successful transaction
-                file_path = generate_transaction_receipt(txn)
-                print(f"Receipts generated at: {file_path}")
+            # the atomic block (and receipt rendering) is sync-only
+            try:
+                await sync_to_async(record_deposit)(
+                    chama, member, callback["amount"], checkout_id, callback["mpesa_code"], callback["phone"],
+                )
+            except IntegrityError:
+                # a concurrent delivery of the same callback won the insert
+                await counters.aincr(CALLBACK_STATS_KEYS["duplicate_races"])
+                return JsonResponse({"ResultCode": 0, "ResultDesc": "Payment successful"})
+            notify_stk_result(checkout_id)
 
             return JsonResponse({"ResultCode": 0, "ResultDesc": "Payment successful"})
 
-        # If not successful
+        # If not successful, let the pending page know without asking Daraja
+        result_desc = callback["result_desc"]
+        await PendingPayment.objects.filter(checkout_request_id=checkout_id, status="pending").aupdate(
+            status="failed", result_code=str(result_code), result_desc=result_desc[:255],
+        )
+        await aremember_result(checkout_id, result_code, result_desc)
+        notify_stk_result(checkout_id)
         return JsonResponse({
             "ResultCode": result_code,
             "ResultDesc": "Payment failed or cancelled"